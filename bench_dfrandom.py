@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+
+"""Benchmarks for dfrandom.
+
+python3 bench_dfrandom.py runs all of them; pass names to run just some.
+"""
+
+
+import argparse
+import multiprocessing
+import os
+import random
+import time
+from typing import Callable, Dict, List, Tuple
+import xml.etree.ElementTree as et
+
+import dfrandom
+
+
+def _spell_prereq_elements() -> Dict[str, et.Element]:
+    """Return a dict of spell name to its <prereq_list> element, or None."""
+    dirname = os.path.dirname(os.path.abspath(dfrandom.__file__))
+    path = os.path.join(dirname, "Library__L.glb")
+    root_el = et.parse(path).getroot()
+    spell_to_colleges = dfrandom.get_spell_library().spell_to_colleges
+    name_to_el = {}
+    for spell_el in root_el.find("spell_list").findall("spell"):
+        name = spell_el.find("name").text
+        if name in spell_to_colleges:
+            name_to_el[name] = spell_el.find("prereq_list")
+    return name_to_el
+
+
+def _time_wizard_spells(spells: dfrandom.SpellSet, repeats: int) -> float:
+    """Return the mean seconds taken to add 30 spells to a new wizard."""
+    rng = random.Random(0)
+    start = time.perf_counter()
+    for unused in range(repeats):
+        traits = [
+            ("IQ 15", 100, dfrandom.PA),
+            ("Magery 3", 35, dfrandom.AD),
+        ]
+        trait_names = set(trait[0] for trait in traits)
+        for unused2 in range(30):
+            dfrandom.add_spell(traits, trait_names, spells, rng=rng)
+    return (time.perf_counter() - start) / repeats
+
+
+def bench_prereq_order(repeats: int) -> None:
+    """Compare prereq trees in document and cost order on a 30-spell
+    wizard."""
+    spell_to_colleges = dfrandom.get_spell_library().spell_to_colleges
+    name_to_el = _spell_prereq_elements()
+    variants = [
+        (
+            "tree, document order",
+            dict(
+                (name, dfrandom._build_prereq_list(el, cost_ordered=False))
+                for name, el in name_to_el.items()
+            ),
+        ),
+        (
+            "tree, cost order",
+            dict(
+                (name, dfrandom._build_prereq_list(el))
+                for name, el in name_to_el.items()
+            ),
+        ),
+    ]
+    for label, spell_to_prereq in variants:
+        spells = dfrandom.SpellSet(
+            spell_to_colleges, spell_to_prereq  # type: ignore
+        )
+        seconds = _time_wizard_spells(spells, repeats)
+        print("%-24s %8.2f ms per wizard" % (label, seconds * 1000))
+
+
+def bench_add_spell(repeats: int) -> None:
+    """Compare add_spell with and without a SpellFrontier."""
+    spells = dfrandom.get_spell_library().wizard_spells()
+    for num_spells in [30, 400]:
+        for use_frontier in [False, True]:
+            rng = random.Random(0)
+            start = time.perf_counter()
+            for unused in range(repeats):
+                traits = [
+                    ("IQ 15", 100, dfrandom.PA),
+                    ("Magery 3", 35, dfrandom.AD),
+                ]
+                trait_names = set(trait[0] for trait in traits)
+                frontier = None
+                if use_frontier:
+                    frontier = dfrandom.SpellFrontier(traits, spells)
+                for unused2 in range(num_spells):
+                    dfrandom.add_spell(
+                        traits, trait_names, spells, frontier, rng
+                    )
+            seconds = (time.perf_counter() - start) / repeats
+            label = "%d spells, %s" % (
+                num_spells,
+                "frontier" if use_frontier else "no frontier",
+            )
+            print("%-24s %8.2f ms per wizard" % (label, seconds * 1000))
+
+
+def bench_jobs(repeats: int) -> None:
+    """Time 10 * repeats wizards over 1, 2 and all cores' processes."""
+    num = 10 * repeats
+    for jobs in sorted(set([1, 2, os.cpu_count() or 1])):
+        start = time.perf_counter()
+        if jobs == 1:
+            characters = dfrandom.generate_named("wizard", num, seed=0)
+        else:
+            characters = dfrandom.generate_parallel(
+                "wizard", num, seed=0, jobs=jobs
+            )
+        for unused in characters:
+            pass
+        seconds = (time.perf_counter() - start) / num
+        label = "%d jobs" % jobs
+        print("%-24s %8.2f ms per wizard" % (label, seconds * 1000))
+    print("(at small -n, 2 jobs can be slower than 1: starting workers costs")
+    print(" more than it saves)")
+
+
+def bench_count_space(repeats: int) -> None:
+    """Time count_template_space for each template."""
+    for template in dfrandom.templates:
+        start = time.perf_counter()
+        for unused in range(repeats):
+            dfrandom.count_template_space(template)
+        seconds = (time.perf_counter() - start) / repeats
+        print("%-24s %8.2f ms" % (template, seconds * 1000))
+
+
+def _worker_memory() -> Tuple[int, int, int]:
+    """Make a wizard in a worker, then return its (pid, resident kB,
+    private kB), or zeros for the sizes without /proc."""
+    dfrandom.generate_character("wizard")
+    sizes = {}
+    try:
+        with open("/proc/self/smaps_rollup") as fil:
+            for line in fil:
+                fields = line.split()
+                if len(fields) == 3 and fields[2] == "kB":
+                    sizes[fields[0].rstrip(":")] = int(fields[1])
+    except OSError:
+        pass
+    private = sizes.get("Private_Clean", 0) + sizes.get("Private_Dirty", 0)
+    return os.getpid(), sizes.get("Rss", 0), private
+
+
+def bench_start_method(repeats: int) -> None:
+    """Compare worker start-up time and memory for fork and spawn pools."""
+    jobs = 2
+    # Start cold, as the first fork pool in a process does; the spell
+    # library still comes from its disk cache.
+    dfrandom._spell_library = None
+    dfrandom.option_table.cache_clear()
+    for compiled in dfrandom.template_to_compiled.values():
+        compiled._spell_groups.clear()
+    start = time.perf_counter()
+    dfrandom._preload()
+    print(
+        "%-24s %8.2f ms"
+        % ("fork preload, cold", (time.perf_counter() - start) * 1000)
+    )
+    methods = [
+        method
+        for method in ["spawn", "fork"]
+        if method in multiprocessing.get_all_start_methods()
+    ]
+    for method in methods:
+        start = time.perf_counter()
+        for unused in range(min(repeats, 5)):
+            # Each worker makes one wizard, so this is mostly start-up.
+            for unused2 in dfrandom.generate_parallel(
+                "wizard",
+                jobs,
+                seed=0,
+                jobs=jobs,
+                chunk_size=1,
+                start_method=method,
+            ):
+                pass
+        seconds = (time.perf_counter() - start) / min(repeats, 5)
+        label = "%s, %d workers" % (method, jobs)
+        print("%-24s %8.2f ms per pool" % (label, seconds * 1000))
+        with dfrandom._worker_pool(jobs, method) as executor:
+            futures = [
+                executor.submit(_worker_memory) for unused in range(4 * jobs)
+            ]
+            pid_to_sizes = dict(
+                (pid, (rss, private))
+                for pid, rss, private in (
+                    future.result() for future in futures
+                )
+            )
+        rss = sum(sizes[0] for sizes in pid_to_sizes.values())
+        private = sum(sizes[1] for sizes in pid_to_sizes.values())
+        print(
+            "%-24s %8d kB resident, %d kB private per worker"
+            % (method, rss // len(pid_to_sizes), private // len(pid_to_sizes))
+        )
+
+
+benchmarks: Dict[str, Callable[[int], None]] = {
+    "prereq_order": bench_prereq_order,
+    "add_spell": bench_add_spell,
+    "count_space": bench_count_space,
+    "jobs": bench_jobs,
+    "start_method": bench_start_method,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark dfrandom")
+    parser.add_argument(
+        "names",
+        nargs="*",
+        help="Benchmarks to run (%s); default all" % ", ".join(benchmarks),
+    )
+    parser.add_argument(
+        "--repeats",
+        "-n",
+        type=int,
+        default=20,
+        help="Number of repetitions per measurement",
+    )
+    args = parser.parse_args()
+    names: List[str] = args.names or list(benchmarks)
+    for name in names:
+        print("== %s" % name)
+        benchmarks[name](args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,25 @@
 """Generate a random GURPS Dungeon Fantasy character."""
 
 
+import abc
 import argparse
-from collections import Counter
-import copy
+from array import array
+from collections import Counter, deque
+import concurrent.futures
 from enum import Enum, auto
+from fractions import Fraction
+import functools
+import gc
+import hashlib
+import multiprocessing
 import os
+import pickle
 import random
 import re
-from typing import Dict, List, Set, Tuple
+import sys
+import threading
+from types import MappingProxyType
+from typing import AbstractSet, Dict, List, Mapping, Set, Tuple
 import typing
 import xml.etree.ElementTree as et
 
@@ -35,6 +46,160 @@ SK = TraitType.SKILL
 SP = TraitType.SPELL
 
 
+# Trait names like "ST +2" or "Basic Speed +0.5"
+plus_pat = re.compile(r"(.*) \+([0-9.]+)$")
+# Trait names like "Magery 3" or "Basic Speed 6.5"
+level_pat = re.compile(r"(.*) ([0-9.]+)$")
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_level(name: str) -> typing.Optional[Tuple[str, float, bool]]:
+    """Parse a trait name like "Magery 3" or "IQ +1".
+
+    Return a tuple of (bare name, level, relative), or None if name does
+    not have a level.
+    """
+    match = plus_pat.search(name)
+    relative = match is not None
+    if not relative:
+        match = level_pat.search(name)
+    if match:
+        str_level = match.group(2)
+        if "." in str_level:
+            level: float = float(str_level)
+        else:
+            level = int(str_level)
+        return (match.group(1), level, relative)
+    return None
+
+
+class TraitRegistry:
+    """Interns trait names as small integer IDs.
+
+    names[trait_id] is the trait's name and levels[trait_id] is its (bare
+    name, level, relative) tuple from _parse_level(), or None if it has no
+    level.
+
+    It is safe to use from several threads.  Looking up a name takes no
+    lock; giving one a new ID does, so each name gets exactly one.
+    """
+
+    def __init__(self) -> None:
+        self.names: List[str] = []
+        self.levels: List[typing.Optional[Tuple[str, float, bool]]] = []
+        self._ids: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def intern(self, name: str) -> int:
+        """Return name's ID, giving it the next one if it does not have
+        one yet."""
+        trait_id = self._ids.get(name)
+        if trait_id is None:
+            with self._lock:
+                # Another thread may have added name since it was looked up.
+                trait_id = self._ids.get(name)
+                if trait_id is None:
+                    trait_id = len(self.names)
+                    self.names.append(name)
+                    self.levels.append(_parse_level(name))
+                    # Published last, so a name is never found before its
+                    # level is recorded.
+                    self._ids[name] = trait_id
+        return trait_id
+
+    def lookup(self, name: str) -> typing.Optional[int]:
+        """Return name's ID, or None if it has not been interned."""
+        return self._ids.get(name)
+
+
+_value_to_trait_type = dict(
+    (trait_type.value, trait_type) for trait_type in TraitType
+)
+
+
+class CharacterBatch:
+    """The traits of many characters, stored compactly.
+
+    Each character's traits are kept as runs of three parallel arrays: trait
+    IDs from the batch's own TraitRegistry, costs, and TraitType values.
+    starts[ii] is where character ii's run begins.  That is a few bytes per
+    trait rather than a tuple, and looking for a trait compares integers.
+
+    The batch is not safe to add to from several threads at once.
+    """
+
+    def __init__(
+        self,
+        characters: typing.Iterable[List[Tuple[str, int, TraitType]]] = (),
+    ) -> None:
+        self.registry = TraitRegistry()
+        self.ids = array("H")
+        self.costs = array("h")
+        self.types = array("B")
+        self.starts = array("L", [0])
+        for traits in characters:
+            self.append(traits)
+
+    def __len__(self) -> int:
+        return len(self.starts) - 1
+
+    def append(self, traits: List[Tuple[str, int, TraitType]]) -> None:
+        """Add a character with traits to the end of the batch."""
+        for name, cost, trait_type in traits:
+            self.ids.append(self.registry.intern(name))
+            self.costs.append(cost)
+            self.types.append(trait_type.value)
+        self.starts.append(len(self.ids))
+
+    def _run(self, index: int) -> Tuple[int, int]:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("character index out of range")
+        return self.starts[index], self.starts[index + 1]
+
+    def __getitem__(self, index: int) -> List[Tuple[str, int, TraitType]]:
+        """Return character index's traits as (name, cost, trait_type)."""
+        start, stop = self._run(index)
+        names = self.registry.names
+        return [
+            (names[trait_id], cost, _value_to_trait_type[value])
+            for trait_id, cost, value in zip(
+                self.ids[start:stop],
+                self.costs[start:stop],
+                self.types[start:stop],
+            )
+        ]
+
+    def __iter__(self) -> typing.Iterator[List[Tuple[str, int, TraitType]]]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def trait_ids(self, index: int) -> "array[int]":
+        """Return the IDs of character index's traits."""
+        start, stop = self._run(index)
+        return self.ids[start:stop]
+
+    def has_trait(self, index: int, name: str) -> bool:
+        """Return True iff character index has a trait called name."""
+        trait_id = self.registry.lookup(name)
+        return trait_id is not None and trait_id in self.trait_ids(index)
+
+    def count_with(self, name: str) -> int:
+        """Return the number of characters with a trait called name."""
+        trait_id = self.registry.lookup(name)
+        if trait_id is None:
+            return 0
+        return sum(
+            1
+            for index in range(len(self))
+            if trait_id in self.trait_ids(index)
+        )
+
+
 def list_levels(
     name: str,
     cost: int,
@@ -83,65 +248,458 @@ def list_self_control_levels2(
     ) + list_self_control_levels(name2, base_cost2)
 
 
-def pick_from_list(
-    lst: List[List[Tuple[str, int, TraitType]]], points: int
-) -> List[Tuple[str, int, TraitType]]:
-    """Pick traits totaling exactly points from the list.
+def _multiply(
+    counts: List[int], factor: List[Tuple[int, int]]
+) -> List[int]:
+    """Return the polynomial counts times factor, truncated to the length
+    of counts.
 
-    chosen traits are removed from lst
+    counts is dense; factor is a list of (exponent, coefficient) pairs.
     """
-    original_lst = copy.deepcopy(lst)
-    traits = []
-    points_left = points
-    while lst and points_left != 0:
-        lst2 = random.choice(lst)
-        lst.remove(lst2)
-        while lst2:
-            tup = random.choice(lst2)
-            trait, cost, trait_type = tup
-            if abs(cost) <= abs(points_left):
-                traits.append((trait, cost, trait_type))
-                points_left -= cost
+    result = [0] * len(counts)
+    for exponent, coefficient in factor:
+        for ii in range(len(counts) - exponent):
+            result[ii + exponent] += coefficient * counts[ii]
+    return result
+
+
+def _divide(counts: List[int], factor: List[Tuple[int, int]]) -> List[int]:
+    """Return the polynomial counts divided by factor, truncated to the
+    length of counts.
+
+    factor must divide counts exactly, and have a constant term first.
+    Integer counts stay integers; weighted ones, like Fractions or floats,
+    are divided with true division.
+    """
+    head = factor[0][1]
+    rest = factor[1:]
+    result = list(counts)
+    for ii in range(len(result)):
+        count = result[ii]
+        for exponent, coefficient in rest:
+            if exponent > ii:
                 break
+            count -= coefficient * result[ii - exponent]
+        if head != 1:
+            if isinstance(head, int):
+                count //= head
             else:
-                lst2.remove(tup)
-    if points_left != 0:
-        # If we made a pick that couldn't get the points right, retry.
-        return pick_from_list(original_lst, points)
+                count /= head
+        result[ii] = count
+    return result
+
+
+class OptionTable:
+    """Counts of the ways to pick at most one cost from each group of a
+    list, by total.
+
+    The counts are the coefficients of a polynomial with one factor per
+    group: counts[ii] is the number of selections whose total, times sign,
+    is offset + ii.  sign makes the totals we care about positive, and
+    totals past limit are dropped since they can never be reached.
+    without() divides out one group's factor, giving the counts for the
+    groups that are left, so samplers can visit groups in any order.
+
+    If weights are given, each selection counts as the product of the
+    weights of the groups it picks from, rather than as 1.
+
+    Use option_table() to get a cached one.
+    """
+
+    def __init__(
+        self,
+        costs: Tuple[Tuple[int, ...], ...],
+        points: int,
+        weights: Tuple[float, ...] = None,
+    ) -> None:
+        self.costs = costs
+        self.points = points
+        self.weights = weights
+        self.sign = -1 if points < 0 else 1
+        signed = [[cost * self.sign for cost in group] for group in costs]
+        # Each factor's lowest exponent stands for this many points.
+        self.lows = [min([0] + group) for group in signed]
+        self.offset = sum(self.lows)
+        if self.offset == 0:
+            self.limit = points * self.sign
+        else:
+            # Mixed signs, so any total might be passed through.
+            self.limit = (
+                sum(max([0] + group) for group in signed) - self.offset
+            )
+        self.factors: List[List[Tuple[int, typing.Any]]] = []
+        for ii, group in enumerate(signed):
+            low = self.lows[ii]
+            weight = 1 if weights is None else weights[ii]
+            coefficients: Dict[int, typing.Any] = {-low: 1}
+            for cost in group:
+                coefficients[cost - low] = (
+                    coefficients.get(cost - low, 0) + weight
+                )
+            self.factors.append(
+                sorted(
+                    (exponent, coefficient)
+                    for exponent, coefficient in coefficients.items()
+                    if exponent <= self.limit
+                )
+            )
+        self._suffixes: typing.Optional[List[Tuple[List[int], int]]] = None
+        self.counts = tuple(self.suffixes()[0][0])
+
+    def suffixes(self) -> List[Tuple[List[int], int]]:
+        """Return a list of (counts, offset), one for each group and one
+        for no groups, for the groups from that one to the end."""
+        if self._suffixes is None:
+            counts = [0] * (self.limit + 1)
+            counts[0] = 1
+            offset = 0
+            suffixes = [(counts, offset)]
+            for factor, low in zip(
+                reversed(self.factors), reversed(self.lows)
+            ):
+                counts = _multiply(counts, factor)
+                offset += low
+                suffixes.append((counts, offset))
+            suffixes.reverse()
+            self._suffixes = suffixes
+        return self._suffixes
+
+    def ways(
+        self, counts: typing.Sequence[int], offset: int, total: int
+    ) -> int:
+        """Return the number of selections in counts, with offset, that
+        total exactly total points."""
+        ii = total * self.sign - offset
+        if 0 <= ii < len(counts):
+            return counts[ii]
+        return 0
+
+    def without(
+        self, counts: typing.Sequence[int], offset: int, group: int
+    ) -> Tuple[List[int], int]:
+        """Return counts and offset with group's factor divided out."""
+        return (
+            _divide(list(counts), self.factors[group]),
+            offset - self.lows[group],
+        )
+
+
+@functools.lru_cache(maxsize=1024)
+def option_table(
+    costs: Tuple[Tuple[int, ...], ...],
+    points: int,
+    weights: Tuple[float, ...] = None,
+) -> OptionTable:
+    """Return the OptionTable for groups with these costs, points and
+    weights.
+
+    Templates pick from the same lists over and over, so tables are
+    cached by their costs; option_table.cache_info() has the hit and miss
+    counts.
+    """
+    return OptionTable(costs, points, weights)
+
+
+def _option_costs(
+    lst: typing.Sequence[typing.Sequence[Tuple[str, int, TraitType]]]
+) -> Tuple[Tuple[int, ...], ...]:
+    """Return the costs of the traits in lst, the key for option_table."""
+    return tuple(tuple(tup[1] for tup in group) for group in lst)
+
+
+# How pick_from_list picks.  "greedy" visits groups in random order and
+# picks from each one it can, so cheap single traits and multi-level
+# traits are picked about as often as each other.  "uniform" picks every
+# valid selection equally often.
+SAMPLING_MODES = ("greedy", "uniform")
+
+# The sampling mode used when pick_from_list is not told one.  It is never
+# changed; give a GenerationContext a sampling mode to use another.
+default_sampling = "greedy"
+
+# The generator used when no other is given.  It is seeded from the
+# system at import; pass a random.Random to repeat a run.
+_default_rng = random.Random()
+
+
+class GenerationContext:
+    """What generating a character draws on.
+
+    rng is a random.Random, or anything with its methods, that every
+    random choice is made with; by default one shared by this module.
+    sampling is passed to pick_from_list; None means default_sampling.
+    """
+
+    def __init__(
+        self, rng: random.Random = None, sampling: str = None
+    ) -> None:
+        self.rng = _default_rng if rng is None else rng
+        self.sampling = sampling
+
+
+class _Trace:
+    """What a template did while it was traced with nothing picked.
+
+    lists holds each (list, points) given to pick_from_list, and
+    uncounted describes each pick that was not from an option list.
+    """
+
+    def __init__(self) -> None:
+        self.lists: List[
+            Tuple[
+                typing.Sequence[typing.Sequence[Tuple[str, int, TraitType]]],
+                int,
+            ]
+        ] = []
+        self.uncounted: List[str] = []
+
+
+class _Tracing(threading.local):
+    """The _Trace of the template being traced in this thread, if any."""
+
+    trace: typing.Optional[_Trace] = None
+
+
+# While _trace_template() traces a template, picks in its thread are
+# recorded in _tracing.trace and nothing is picked.  Other threads keep
+# generating characters as usual.
+_tracing = _Tracing()
+
+
+def _pick_greedy(
+    lst: typing.Sequence[typing.Sequence[Tuple[str, int, TraitType]]],
+    points: int,
+    rng: random.Random,
+) -> List[Tuple[str, int, TraitType]]:
+    table = option_table(_option_costs(lst), points)
+    counts: typing.Sequence[int] = table.counts
+    offset = table.offset
+    if not table.ways(counts, offset, points):
+        raise ValueError("no traits from list total %d points" % points)
+    order = list(range(len(lst)))
+    rng.shuffle(order)
+    traits = []
+    points_left = points
+    pos = 0
+    while points_left != 0:
+        counts, offset = table.without(counts, offset, order[pos])
+        group = lst[order[pos]]
+        pos += 1
+        options = [
+            tup
+            for tup in group
+            if table.ways(counts, offset, points_left - tup[1])
+        ]
+        if options:
+            tup = rng.choice(options)
+            traits.append(tup)
+            points_left -= tup[1]
+    return traits
+
+
+def _pick_counting(
+    lst: typing.Sequence[typing.Sequence[Tuple[str, int, TraitType]]],
+    points: int,
+    weights: typing.Optional[Tuple[float, ...]],
+    rng: random.Random,
+) -> List[Tuple[str, int, TraitType]]:
+    table = option_table(_option_costs(lst), points, weights)
+    suffixes = table.suffixes()
+    if not table.ways(table.counts, table.offset, points):
+        raise ValueError("no traits from list total %d points" % points)
+    traits = []
+    points_left = points
+    for ii, group in enumerate(lst):
+        counts, offset = suffixes[ii + 1]
+        weight = 1 if weights is None else weights[ii]
+        options: List[typing.Optional[Tuple[str, int, TraitType]]] = [None]
+        option_weights = [table.ways(counts, offset, points_left)]
+        for tup in group:
+            options.append(tup)
+            option_weights.append(
+                weight * table.ways(counts, offset, points_left - tup[1])
+            )
+        picked = rng.choices(options, option_weights)[0]
+        if picked is not None:
+            traits.append(picked)
+            points_left -= picked[1]
     return traits
 
 
+def pick_from_list(
+    lst: typing.Sequence[typing.Sequence[Tuple[str, int, TraitType]]],
+    points: int,
+    sampling: str = None,
+    weights: typing.Sequence[float] = None,
+    rng: random.Random = None,
+) -> List[Tuple[str, int, TraitType]]:
+    """Pick traits totaling exactly points from the list, at most one from
+    each group, making random choices with rng.
+
+    sampling is one of SAMPLING_MODES, default default_sampling.  In
+    "greedy" mode groups are visited in random order, and a random trait
+    is picked from each one unless that would make points unreachable
+    with the groups that are left.  In "uniform" mode each valid selection
+    is equally likely, or, if weights has one weight per group, as likely
+    as the product of the weights of the groups it picks from.  Either way
+    this finishes in one pass.  Raise ValueError if no selection totals
+    points, or if weights are given in "greedy" mode, which has no use for
+    them.
+
+    lst is not modified; use unpicked_groups() to pick from it again.
+    """
+    trace = _tracing.trace
+    if trace is not None:
+        trace.lists.append((lst, points))
+        return []
+    if sampling is None:
+        sampling = default_sampling
+    if rng is None:
+        rng = _default_rng
+    if sampling == "greedy":
+        if weights is not None:
+            raise ValueError('weights need "uniform" sampling')
+        return _pick_greedy(lst, points, rng)
+    if sampling == "uniform":
+        if weights is not None:
+            if len(weights) != len(lst):
+                raise ValueError("need one weight per group")
+            weights = tuple(weights)
+        return _pick_counting(lst, points, weights, rng)
+    raise ValueError("unknown sampling mode %r" % sampling)
+
+
+def _pick_enforcing_prereqs(
+    lst: typing.Sequence[typing.Sequence[Tuple[str, int, TraitType]]],
+    order: List[int],
+    table: OptionTable,
+    remaining: List[Tuple[List[int], int]],
+    pos: int,
+    points_left: int,
+    index: "CharacterIndex",
+    spells: "SpellSet",
+    budget: List[int],
+    rng: random.Random,
+) -> bool:
+    """Depth-first search for pick_from_list_enforcing_prereqs.
+
+    Pick from the groups at order[pos:], adding picks to index, until
+    points_left is used up.  remaining[pos] is the counts and offset from
+    table for those groups.  Return True on success.  Return False, with
+    index as it was, on failure or once budget[0] nodes have been tried.
+    """
+    if points_left == 0:
+        return True
+    if pos == len(order) or budget[0] <= 0:
+        return False
+    budget[0] -= 1
+    if len(remaining) == pos + 1:
+        remaining.append(table.without(*remaining[pos], order[pos]))
+    counts, offset = remaining[pos + 1]
+    options = [
+        tup
+        for tup in lst[order[pos]]
+        if table.ways(counts, offset, points_left - tup[1])
+    ]
+    rng.shuffle(options)
+    for tup in options:
+        if not spells.satisfied(tup[0], index):
+            continue
+        index.add(tup)
+        if _pick_enforcing_prereqs(
+            lst,
+            order,
+            table,
+            remaining,
+            pos + 1,
+            points_left - tup[1],
+            index,
+            spells,
+            budget,
+            rng,
+        ):
+            return True
+        index.pop()
+    if table.ways(counts, offset, points_left):
+        return _pick_enforcing_prereqs(
+            lst,
+            order,
+            table,
+            remaining,
+            pos + 1,
+            points_left,
+            index,
+            spells,
+            budget,
+            rng,
+        )
+    return False
+
+
 def pick_from_list_enforcing_prereqs(
-    lst: List[List[Tuple[str, int, TraitType]]],
+    lst: typing.Sequence[typing.Sequence[Tuple[str, int, TraitType]]],
     points: int,
     original_traits: List[Tuple[str, int, TraitType]],
+    spells: "SpellSet",
+    max_nodes: int = 2000,
+    max_tries: int = 20,
+    rng: random.Random = None,
 ) -> List[Tuple[str, int, TraitType]]:
-    """Pick traits totaling exactly points from the list.
+    """Pick traits totaling exactly points from the list, at most one from
+    each group, only picking traits whose prereqs in spells are satisfied
+    by original_traits and the traits picked before them.
+
+    This is a backtracking search over a random group order, pruned with
+    the same OptionTable as pick_from_list.  Each try gives up after
+    max_nodes groups, and a new random order is tried, up to max_tries
+    times.  Random choices are made with rng.  Raise ValueError if no
+    selection is found.
 
     Return a list of tuples (trait name, cost, trait_type)
-    chosen traits are removed from lst
+    lst is not modified.
     """
-    original_lst = copy.deepcopy(lst)
-    traits: List[Tuple[str, int, TraitType]] = []
-    points_left = points
-    while lst and points_left != 0:
-        lst2 = random.choice(lst)
-        lst.remove(lst2)
-        while lst2:
-            tup = random.choice(lst2)
-            trait, cost, trait_type = tup
-            if abs(cost) <= abs(points_left) and prereq_satisfied(
-                trait, original_traits + traits
-            ):
-                traits.append((trait, cost, trait_type))
-                points_left -= cost
-                break
-            else:
-                lst2.remove(tup)
-    if points_left != 0:
-        # If we made a pick that couldn't get the points right, retry.
-        return pick_from_list(original_lst, points)
-    return traits
+    trace = _tracing.trace
+    if trace is not None:
+        trace.uncounted.append("%d points of picks with prereqs" % points)
+        return []
+    if rng is None:
+        rng = _default_rng
+    index = CharacterIndex(original_traits, spells.spell_to_colleges)
+    table = option_table(_option_costs(lst), points)
+    for unused in range(max_tries):
+        if not table.ways(table.counts, table.offset, points):
+            break
+        order = list(range(len(lst)))
+        rng.shuffle(order)
+        if _pick_enforcing_prereqs(
+            lst,
+            order,
+            table,
+            [(list(table.counts), table.offset)],
+            0,
+            points,
+            index,
+            spells,
+            [max_nodes],
+            rng,
+        ):
+            return index.traits[len(original_traits) :]
+    raise ValueError(
+        "no traits from list total %d points with prereqs met" % points
+    )
+
+
+def unpicked_groups(
+    lst: typing.Sequence[typing.Sequence[Tuple[str, int, TraitType]]],
+    traits: List[Tuple[str, int, TraitType]],
+) -> List[typing.Sequence[Tuple[str, int, TraitType]]]:
+    """Return the groups in lst that have no trait named in traits."""
+    trait_names = set(trait[0] for trait in traits)
+    return [
+        group
+        for group in lst
+        if not any(tup[0] in trait_names for tup in group)
+    ]
 
 
 def next_skill_cost(cost: int) -> int:
@@ -157,22 +715,29 @@ def next_skill_cost(cost: int) -> int:
 
 
 def pick_or_improve_skills_from_list(
-    skills: Set[str],
+    skills: typing.Collection[str],
     points: int,
     traits: List[Tuple[str, int, TraitType]],
     min_cost: int = 1,
+    rng: random.Random = None,
 ) -> None:
     """Add points to skills, and modify traits in place.
 
     If a skill is already in traits then bring it up to the next
     level, if enough points remain.
 
-    Otherwise add it at the 1-point level.
+    Otherwise add it at the 1-point level.  Skills are chosen with rng.
     """
+    trace = _tracing.trace
+    if trace is not None:
+        trace.uncounted.append("%d points of skill improvements" % points)
+        return
+    if rng is None:
+        rng = _default_rng
     points_left = points
     skills_lst = list(skills)
     while skills_lst and points_left > 0:
-        skill_name = random.choice(skills_lst)
+        skill_name = rng.choice(skills_lst)
         for ii, skill_tup in enumerate(traits):
             (skill_name2, cost, trait_type) = skill_tup
             if skill_name2 == skill_name:
@@ -217,58 +782,312 @@ def fix_language_talent(traits: List[Tuple[str, int, TraitType]]) -> None:
             traits[ii] = (trait_name, cost, trait_type)
 
 
-def print_traits(traits: List[Tuple[str, int, TraitType]]) -> None:
+def format_traits(traits: List[Tuple[str, int, TraitType]]) -> str:
+    """Return the text print_traits() prints for traits."""
     total_cost = 0
+    lines = []
 
-    # Print primary and secondary attributes in fixed order
+    # Primary and secondary attributes in fixed order
 
-    print("\nPrimary Attributes")
+    lines.append("\nPrimary Attributes")
     for name, cost, trait_type in traits:
         if trait_type == PA:
             total_cost += cost
-            print("%s [%d]" % (name, cost))
+            lines.append("%s [%d]" % (name, cost))
 
-    print("\nSecondary Attributes")
+    lines.append("\nSecondary Attributes")
     for name, cost, trait_type in traits:
         if trait_type == SA:
             total_cost += cost
-            print("%s [%d]" % (name, cost))
+            lines.append("%s [%d]" % (name, cost))
 
-    # Print the rest in sorted order
+    # The rest in sorted order
     traits = sorted(traits)
 
-    print("\nAdvantages")
-    for name, cost, trait_type in traits:
-        if trait_type == AD:
-            total_cost += cost
-            print("%s [%d]" % (name, cost))
-
-    print("\nDisadvantages")
-    for name, cost, trait_type in traits:
-        if trait_type == DI:
-            total_cost += cost
-            print("%s [%d]" % (name, cost))
-
-    print("\nSkills")
-    for name, cost, trait_type in traits:
-        if trait_type == SK:
-            total_cost += cost
-            print("%s [%d]" % (name, cost))
+    for header, header_type in [
+        ("Advantages", AD),
+        ("Disadvantages", DI),
+        ("Skills", SK),
+    ]:
+        lines.append("\n" + header)
+        for name, cost, trait_type in traits:
+            if trait_type == header_type:
+                total_cost += cost
+                lines.append("%s [%d]" % (name, cost))
 
     printed_spells_header = False
     for name, cost, trait_type in traits:
         if trait_type == SP:
             if not printed_spells_header:
-                print("\nSpells")
+                lines.append("\nSpells")
                 printed_spells_header = True
             total_cost += cost
-            print("%s [%d]" % (name, cost))
+            lines.append("%s [%d]" % (name, cost))
+
+    lines.append("\ntotal points: %d\n" % total_cost)
+    return "\n".join(lines)
+
+
+def print_traits(traits: List[Tuple[str, int, TraitType]]) -> None:
+    sys.stdout.write(format_traits(traits))
+
+
+def write_characters(
+    characters: typing.Iterable[Tuple[str, List[Tuple[str, int, TraitType]]]],
+    out: typing.TextIO,
+    chunk_size: int = 256,
+) -> None:
+    """Write each (template, traits) in characters to out, with its
+    template's name, chunk_size characters per write."""
+    chunk: List[str] = []
+    for ii, (template, traits) in enumerate(characters):
+        if ii:
+            chunk.append("\n")
+        chunk.append(template.title() + "\n")
+        chunk.append(format_traits(traits))
+        if len(chunk) >= 3 * chunk_size:
+            out.write("".join(chunk))
+            chunk = []
+    out.write("".join(chunk))
+
+
+class Stage(typing.NamedTuple):
+    """One list of options in a template's data.
+
+    points is how many points to pick from the list, or None for a list
+    that is only there to be reused by later ones.  The list is groups,
+    then a group for each spell in the SpellSet given by the SpellLibrary
+    method named by spells, then the unpicked groups of the earlier lists
+    named in reuse.  A list with only_with is only reused if the
+    character has one of those traits.  skip_known drops groups with a
+    trait the character already has.  If prereqs is true, picks must have
+    their prereqs in the spells SpellSet met.  after is called with the
+    traits once the pick is made.  weights, if given, has one weight per
+    group in groups, for pick_from_list in "uniform" mode, here and in the
+    lists that reuse them; other groups weigh 1.  Greedy sampling and
+    template_probabilities() ignore them.
+    """
 
-    print("\ntotal points: %d" % total_cost)
+    name: str
+    points: typing.Optional[int]
+    groups: typing.Sequence[typing.Sequence[Tuple[str, int, TraitType]]] = ()
+    reuse: Tuple[str, ...] = ()
+    spells: str = ""
+    skip_known: bool = False
+    prereqs: bool = False
+    only_with: typing.Collection[str] = ()
+    after: typing.Optional[
+        typing.Callable[[List[Tuple[str, int, TraitType]]], None]
+    ] = None
+    weights: typing.Optional[typing.Sequence[float]] = None
 
 
-def generate_barbarian() -> List[Tuple[str, int, TraitType]]:
-    traits = [
+class Improve(typing.NamedTuple):
+    """Points to spend with pick_or_improve_skills_from_list on the skills
+    in the named lists."""
+
+    points: int
+    lists: Tuple[str, ...]
+    min_cost: int = 1
+
+
+class TemplateData(typing.NamedTuple):
+    """A template as data: its fixed traits, then its lists of options in
+    the order they are picked.
+
+    The first trait of each group in the lists named in fixed is added to
+    the fixed traits.  improve, if given, is done after the last pick.
+    """
+
+    traits: typing.Sequence[Tuple[str, int, TraitType]]
+    stages: typing.Sequence[Stage]
+    fixed: Tuple[str, ...] = ()
+    improve: typing.Optional[Improve] = None
+
+
+class CompiledTemplate:
+    """A TemplateData frozen into tuples, with its lists indexed by name.
+
+    Templates are compiled once, at import, into template_to_compiled, so
+    generating a character only picks.
+    """
+
+    def __init__(self, data: TemplateData) -> None:
+        self.index: Dict[str, int] = {}
+        stages = []
+        for stage in data.stages:
+            for name in stage.reuse:
+                if name not in self.index:
+                    raise ValueError(
+                        "list %s reuses unknown list %s" % (stage.name, name)
+                    )
+            if stage.weights is not None and len(stage.weights) != len(
+                stage.groups
+            ):
+                raise ValueError(
+                    "list %s needs one weight per group" % stage.name
+                )
+            self.index[stage.name] = len(stages)
+            stages.append(
+                stage._replace(
+                    groups=tuple(tuple(group) for group in stage.groups),
+                    reuse=tuple(stage.reuse),
+                    only_with=frozenset(stage.only_with),
+                    weights=None
+                    if stage.weights is None
+                    else tuple(stage.weights),
+                )
+            )
+        self.stages: Tuple[Stage, ...] = tuple(stages)
+        # Weighted groups' weights, by id, so they follow the groups into
+        # the lists that reuse them.
+        self._group_weights: Dict[int, float] = {}
+        for stage in self.stages:
+            if stage.weights is not None:
+                for group, weight in zip(stage.groups, stage.weights):
+                    self._group_weights[id(group)] = weight
+        self.traits: Tuple[Tuple[str, int, TraitType], ...] = tuple(
+            data.traits
+        ) + tuple(
+            group[0]
+            for name in data.fixed
+            for group in self.stages[self.index[name]].groups
+        )
+        self.improve = data.improve
+        # Skill names to improve, in a fixed order so seeded runs repeat.
+        names: Dict[str, None] = {}
+        if data.improve is not None:
+            for name in data.improve.lists:
+                for group in self.stages[self.index[name]].groups:
+                    for tup in group:
+                        names[tup[0]] = None
+        self.improve_names: Tuple[str, ...] = tuple(names)
+        self._spell_groups: Dict[
+            str, Tuple[Tuple[Tuple[str, int, TraitType]], ...]
+        ] = {}
+
+    def spell_groups(
+        self, spells: str
+    ) -> Tuple[Tuple[Tuple[str, int, TraitType]], ...]:
+        """Return a one-point group for each spell in the SpellSet given by
+        the SpellLibrary method named spells, and for each skill with
+        prereqs in it, like the special bard skills.
+
+        The spell library is only loaded when a template needs it, so
+        these are made on first use rather than at import.  If two threads
+        make them at once, both use whichever is stored first.
+        """
+        groups = self._spell_groups.get(spells)
+        if groups is None:
+            spell_set = getattr(get_spell_library(), spells)()
+            groups = self._spell_groups.setdefault(
+                spells,
+                tuple(
+                    (
+                        (
+                            spell,
+                            1,
+                            SP if spell in spell_set.spell_to_colleges else SK,
+                        ),
+                    )
+                    for spell in spell_set.spell_to_prereq
+                ),
+            )
+        return groups
+
+    def pick(
+        self,
+        name: str,
+        traits: List[Tuple[str, int, TraitType]],
+        lists: Dict[str, List[typing.Sequence[Tuple[str, int, TraitType]]]],
+        context: GenerationContext = None,
+    ) -> None:
+        """Pick from the list named name, adding the picks to traits.
+
+        lists holds the lists picked from so far, by name, for later lists
+        to reuse; this one is added to it.  context defaults to a new
+        GenerationContext().
+        """
+        if context is None:
+            context = GenerationContext()
+        stage = self.stages[self.index[name]]
+        lst: List[typing.Sequence[Tuple[str, int, TraitType]]] = list(
+            stage.groups
+        )
+        if stage.spells:
+            lst.extend(self.spell_groups(stage.spells))
+        for reused_name in stage.reuse:
+            reused = self.stages[self.index[reused_name]]
+            if reused.only_with:
+                trait_names = set(trait[0] for trait in traits)
+                if not reused.only_with & trait_names:
+                    continue
+            lst.extend(unpicked_groups(lists[reused_name], traits))
+        if stage.skip_known:
+            lst = unpicked_groups(lst, traits)
+        lists[name] = lst
+        if stage.points is None:
+            return
+        if stage.prereqs:
+            spell_set = getattr(get_spell_library(), stage.spells)()
+            traits.extend(
+                pick_from_list_enforcing_prereqs(
+                    lst, stage.points, traits, spell_set, rng=context.rng
+                )
+            )
+        else:
+            weights = None
+            sampling = context.sampling or default_sampling
+            if sampling == "uniform" and any(
+                id(group) in self._group_weights for group in lst
+            ):
+                weights = [
+                    self._group_weights.get(id(group), 1) for group in lst
+                ]
+            traits.extend(
+                pick_from_list(
+                    lst, stage.points, sampling, weights, context.rng
+                )
+            )
+        if stage.after is not None:
+            stage.after(traits)
+
+    def improve_skills(
+        self,
+        traits: List[Tuple[str, int, TraitType]],
+        context: GenerationContext = None,
+    ) -> None:
+        """Spend the improve points, if any, on traits."""
+        if context is None:
+            context = GenerationContext()
+        if self.improve is not None:
+            pick_or_improve_skills_from_list(
+                self.improve_names,
+                self.improve.points,
+                traits,
+                min_cost=self.improve.min_cost,
+                rng=context.rng,
+            )
+
+    def generate(
+        self, context: GenerationContext = None
+    ) -> List[Tuple[str, int, TraitType]]:
+        """Return a new character's traits, picked from every list in
+        order."""
+        if context is None:
+            context = GenerationContext()
+        traits = list(self.traits)
+        lists: Dict[
+            str, List[typing.Sequence[Tuple[str, int, TraitType]]]
+        ] = {}
+        for stage in self.stages:
+            self.pick(stage.name, traits, lists, context)
+        self.improve_skills(traits, context)
+        return traits
+
+
+barbarian_data = TemplateData(
+    traits=[
         ("ST 17", 63, PA),
         ("DX 13", 60, PA),
         ("IQ 10", 0, PA),
@@ -298,129 +1117,160 @@ def generate_barbarian() -> List[Tuple[str, int, TraitType]]:
         ("Disguise (Animals)", 2, SK),
         ("Weather Sense", 2, SK),
         ("Intimidation", 2, SK),
-    ]
-    ads1 = [
-        list_levels("ST +%d", 9, PA, 3),
-        list_levels("HT +%d", 10, PA, 3),
-        list_levels("Per +%d", 5, SA, 6),
-        [("Absolute Direction", 5, AD)],
-        list_levels("Acute Hearing %d", 2, AD, 5),
-        list_levels("Acute Taste and Smell %d", 2, AD, 5),
-        list_levels("Acute Touch %d", 2, AD, 5),
-        list_levels("Acute Vision %d", 2, AD, 5),
-        [("Alcohol Tolerance", 1, AD)],
-        [("Animal Empathy", 5, AD)],
-        list_levels("Animal Friend %d", 5, AD, 4),
-        [("Combat Reflexes", 15, AD)],
-        [("Fit", 5, AD), ("Very Fit", 15, AD)],
-        list_levels("Hard to Kill %d", 2, AD, 5),
-        list_levels("Hard to Subdue %d", 2, AD, 5),
-        list_levels("Lifting ST %d", 3, AD, 3),
-        [("Luck", 15, AD), ("Extraordinary Luck", 30, AD)],
-        list_levels("Magic Resistance %d", 2, AD, 5),
-        [("Rapid Healing", 5, AD), ("Very Rapid Healing", 15, AD)],
-        [("Recovery", 10, AD)],
-        [("Resistant to Disease 3", 3, AD), ("Resistant to Disease 8", 5, AD)],
-        [("Resistant to Poison 3", 5, AD)],
-        list_levels("Signature Gear %d", 1, AD, 10),
-        [("Striking ST 1", 5, SA), ("Striking ST 2", 9, SA)],
-        list_levels("Temperature Tolerance %d", 1, AD, 2),
-        [("Weapon Bond", 1, AD)],
-    ]
-    traits.extend(pick_from_list(ads1, 30))
-
-    disads1 = [
-        [("Easy to Read", -10, DI)],
-        list_self_control_levels("Gullibility", -10),
-        [("Language: Spoken (Native) / Written (None)", -3, DI)],
-        list_levels("Low TL %d", -5, DI, 2),
-        [("Odious Personal Habit (Unrefined manners)", -5, DI)],
-        list_self_control_levels("Phobia (Machinery)", -5),
-        [("Wealth (Struggling)", -10, DI)],
-    ]
-    traits.extend(pick_from_list(disads1, -10))
-
-    disads2 = [
-        [("Appearance: Unattractive", -4, DI), ("Appearance: Ugly", -8, DI)],
-        list_self_control_levels("Bad Temper", -10),
-        list_self_control_levels("Berserk", -10),
-        list_self_control_levels("Bloodlust", -10),
-        list_self_control_levels2(
-            "Compulsive Carousing", -5, "Phobia (Crowds)", -15
-        ),
-        list_self_control_levels("Gluttony", -5),
-        list_levels("Ham-Fisted %d", -5, DI, 2),
-        [("Horrible Hangovers", -1, DI)],
-        list_self_control_levels("Impulsiveness", -10),
-        list_self_control_levels("Overconfidence", -5),
-        [("Sense of Duty (Adventuring companions)", -5, DI)],
-    ]
-    disads2.extend(disads1)
-    traits.extend(pick_from_list(disads2, -20))
-
-    skills1 = [
-        [("Survival (Arctic)", 1, SK)],
-        [("Survival (Desert)", 1, SK)],
-        [("Survival (Island/Beach)", 1, SK)],
-        [("Survival (Jungle)", 1, SK)],
-        [("Survival (Mountain)", 1, SK)],
-        [("Survival (Plains)", 1, SK)],
-        [("Survival (Swampland)", 1, SK)],
-        [("Survival (Woodlands)", 1, SK)],
-    ]
-    traits.extend(pick_from_list(skills1, 1))
-
-    skills2 = [
-        [("Thrown Weapon (Axe/Mace)", 4, SK)],
-        [("Thrown Weapon (Harpoon)", 4, SK)],
-        [("Thrown Weapon (Spear)", 4, SK)],
-        [("Thrown Weapon (Stick)", 4, SK)],
-        [("Bolas", 4, SK)],
-        [("Bow", 4, SK)],
-        [("Spear Thrower", 4, SK)],
-        [("Throwing", 4, SK)],
-    ]
-    traits.extend(pick_from_list(skills2, 4))
-
-    skills3 = [
-        [
-            ("Axe/Mace", 8, SK),
-            ("Broadsword", 8, SK),
-            ("Spear", 8, SK),
-            ("Flail", 8, SK),
-        ],
-        [("Shield", 8, SK)],
-        [("Polearm", 16, SK)],
-        [("Spear", 16, SK)],
-        [("Two-Handed Axe/Mace", 16, SK)],
-        [("Two-Handed Sword", 16, SK)],
-        [("Two-Handed Flail", 16, SK)],
-    ]
-    traits.extend(pick_from_list(skills3, 16))
+    ],
+    stages=[
+        Stage(
+            "ads1",
+            30,
+            [
+                list_levels("ST +%d", 9, PA, 3),
+                list_levels("HT +%d", 10, PA, 3),
+                list_levels("Per +%d", 5, SA, 6),
+                [("Absolute Direction", 5, AD)],
+                list_levels("Acute Hearing %d", 2, AD, 5),
+                list_levels("Acute Taste and Smell %d", 2, AD, 5),
+                list_levels("Acute Touch %d", 2, AD, 5),
+                list_levels("Acute Vision %d", 2, AD, 5),
+                [("Alcohol Tolerance", 1, AD)],
+                [("Animal Empathy", 5, AD)],
+                list_levels("Animal Friend %d", 5, AD, 4),
+                [("Combat Reflexes", 15, AD)],
+                [("Fit", 5, AD), ("Very Fit", 15, AD)],
+                list_levels("Hard to Kill %d", 2, AD, 5),
+                list_levels("Hard to Subdue %d", 2, AD, 5),
+                list_levels("Lifting ST %d", 3, AD, 3),
+                [("Luck", 15, AD), ("Extraordinary Luck", 30, AD)],
+                list_levels("Magic Resistance %d", 2, AD, 5),
+                [("Rapid Healing", 5, AD), ("Very Rapid Healing", 15, AD)],
+                [("Recovery", 10, AD)],
+                [
+                    ("Resistant to Disease 3", 3, AD),
+                    ("Resistant to Disease 8", 5, AD),
+                ],
+                [("Resistant to Poison 3", 5, AD)],
+                list_levels("Signature Gear %d", 1, AD, 10),
+                [("Striking ST 1", 5, SA), ("Striking ST 2", 9, SA)],
+                list_levels("Temperature Tolerance %d", 1, AD, 2),
+                [("Weapon Bond", 1, AD)],
+            ],
+        ),
+        Stage(
+            "disads1",
+            -10,
+            [
+                [("Easy to Read", -10, DI)],
+                list_self_control_levels("Gullibility", -10),
+                [("Language: Spoken (Native) / Written (None)", -3, DI)],
+                list_levels("Low TL %d", -5, DI, 2),
+                [("Odious Personal Habit (Unrefined manners)", -5, DI)],
+                list_self_control_levels("Phobia (Machinery)", -5),
+                [("Wealth (Struggling)", -10, DI)],
+            ],
+        ),
+        Stage(
+            "disads2",
+            -20,
+            [
+                [
+                    ("Appearance: Unattractive", -4, DI),
+                    ("Appearance: Ugly", -8, DI),
+                ],
+                list_self_control_levels("Bad Temper", -10),
+                list_self_control_levels("Berserk", -10),
+                list_self_control_levels("Bloodlust", -10),
+                list_self_control_levels2(
+                    "Compulsive Carousing", -5, "Phobia (Crowds)", -15
+                ),
+                list_self_control_levels("Gluttony", -5),
+                list_levels("Ham-Fisted %d", -5, DI, 2),
+                [("Horrible Hangovers", -1, DI)],
+                list_self_control_levels("Impulsiveness", -10),
+                list_self_control_levels("Overconfidence", -5),
+                [("Sense of Duty (Adventuring companions)", -5, DI)],
+            ],
+            reuse=("disads1",),
+        ),
+        Stage(
+            "skills1",
+            1,
+            [
+                [("Survival (Arctic)", 1, SK)],
+                [("Survival (Desert)", 1, SK)],
+                [("Survival (Island/Beach)", 1, SK)],
+                [("Survival (Jungle)", 1, SK)],
+                [("Survival (Mountain)", 1, SK)],
+                [("Survival (Plains)", 1, SK)],
+                [("Survival (Swampland)", 1, SK)],
+                [("Survival (Woodlands)", 1, SK)],
+            ],
+        ),
+        Stage(
+            "skills2",
+            4,
+            [
+                [("Thrown Weapon (Axe/Mace)", 4, SK)],
+                [("Thrown Weapon (Harpoon)", 4, SK)],
+                [("Thrown Weapon (Spear)", 4, SK)],
+                [("Thrown Weapon (Stick)", 4, SK)],
+                [("Bolas", 4, SK)],
+                [("Bow", 4, SK)],
+                [("Spear Thrower", 4, SK)],
+                [("Throwing", 4, SK)],
+            ],
+        ),
+        Stage(
+            "skills3",
+            16,
+            [
+                [
+                    ("Axe/Mace", 8, SK),
+                    ("Broadsword", 8, SK),
+                    ("Spear", 8, SK),
+                    ("Flail", 8, SK),
+                ],
+                [("Shield", 8, SK)],
+                [("Polearm", 16, SK)],
+                [("Spear", 16, SK)],
+                [("Two-Handed Axe/Mace", 16, SK)],
+                [("Two-Handed Sword", 16, SK)],
+                [("Two-Handed Flail", 16, SK)],
+            ],
+        ),
+        Stage(
+            "skills4",
+            1,
+            [
+                [("Mimicry (Animal Sounds)", 1, SK)],
+                [("Mimicry (Bird Calls)", 1, SK)],
+            ],
+        ),
+        Stage(
+            "skills5",
+            4,
+            [
+                [("Forced Entry", 1, SK)],
+                [("Climbing", 1, SK)],
+                [("First Aid", 1, SK)],
+                [("Gesture", 1, SK)],
+                [("Seamanship", 1, SK)],
+                [("Carousing", 1, SK)],
+                [("Lifting", 1, SK)],
+                [("Skiing", 1, SK)],
+                [("Observation", 1, SK)],
+            ],
+        ),
+    ],
+)
 
-    skills4 = [
-        [("Mimicry (Animal Sounds)", 1, SK)],
-        [("Mimicry (Bird Calls)", 1, SK)],
-    ]
-    traits.extend(pick_from_list(skills4, 1))
-
-    skills5 = [
-        [("Forced Entry", 1, SK)],
-        [("Climbing", 1, SK)],
-        [("First Aid", 1, SK)],
-        [("Gesture", 1, SK)],
-        [("Seamanship", 1, SK)],
-        [("Carousing", 1, SK)],
-        [("Lifting", 1, SK)],
-        [("Skiing", 1, SK)],
-        [("Observation", 1, SK)],
-    ]
-    traits.extend(pick_from_list(skills5, 4))
-    return traits
+
+def generate_barbarian(
+    context: GenerationContext = None,
+) -> List[Tuple[str, int, TraitType]]:
+    return template_to_compiled["barbarian"].generate(context)
 
 
-def generate_bard() -> List[Tuple[str, int, TraitType]]:
-    traits = [
+bard_data = TemplateData(
+    traits=[
         ("ST 11", 10, PA),
         ("DX 12", 40, PA),
         ("IQ 14", 80, PA),
@@ -456,157 +1306,194 @@ def generate_bard() -> List[Tuple[str, int, TraitType]]:
         ("Detect Lies", 1, SK),
         ("Heraldry", 1, SK),
         ("Poetry", 1, SK),
-    ]
-
-    build_spell_prereqs(allowed_colleges=allowed_bard_colleges)
-    convert_magery_to_bardic_talent()
-    add_special_bard_skills_to_spell_prereqs()
-
-    ads1 = [
-        [("Empathy (PM)", 11, AD)],
-        [("Mimicry (PM)", 7, AD)],
-        [("Mind Control (PM)", 35, AD)],
-        [("Rapier Wit (PM)", 4, AD)],
-        [("Speak With Animals (PM)", 18, AD)],
-        [("Subsonic Speech (PM)", 7, AD)],
-        [("Telecommunication (Telesend, PM)", 21, AD)],
-        [("Terror (PM)", 21, AD)],
-        [("Ultrasonic Speech (PM)", 7, AD)],
-    ]
-    for spell in spell_to_prereq_function:
-        ads1.append([(spell, 1, SP)])
-    traits.extend(pick_from_list_enforcing_prereqs(ads1, 25, traits))
-
-    ads2 = [
-        [("DX +1", 20, PA)],
-        [("IQ +1", 20, PA)],
-        list_levels("FP +%d", 3, SA, 8),
-        [("Basic Speed +1", 20, SA)],
-        list_levels("Acute Hearing %d", 2, AD, 5),
-        [
-            ("Appearance: Attractive", 4, AD),
-            ("Appearance: Handsome", 12, AD),
-            ("Appearance: Very Handsome", 16, AD),
-        ],
-        list_levels("Bardic Talent %d", 8, AD, 2, min_level=3),
-        list_levels("Charisma %d", 5, AD, 5, min_level=2),
-        [("Cultural Adaptability", 10, AD)],
-        [("Eidetic Memory", 5, AD), ("Photographic Memory", 10, AD)],
-        [("Honest Face", 1, AD)],
-        [("Language Talent", 10, AD)],
-        [("Language (Spoken: Broken / Written: None)", 1, AD)],
-        [("Language (Spoken: None / Written: Broken)", 1, AD)],
-        [("Language (Spoken: Accented / Written: None)", 2, AD)],
-        [("Language (Spoken: Broken / Written: Broken)", 2, AD)],
-        [("Language (Spoken: None / Written: Accented)", 2, AD)],
-        [("Language (Spoken: Native / Written: None)", 3, AD)],
-        [("Language (Spoken: Accented / Written: Broken)", 3, AD)],
-        [("Language (Spoken: Broken / Written: Accented)", 3, AD)],
-        [("Language (Spoken: None / Written: Native)", 3, AD)],
-        [("Language (Spoken: Native / Written: Broken)", 4, AD)],
-        [("Language (Spoken: Accented / Written: Accented)", 4, AD)],
-        [("Language (Spoken: Broken / Written: Native)", 4, AD)],
-        [("Language (Spoken: Native / Written: Accented)", 5, AD)],
-        [("Language (Spoken: Accented / Written: Native)", 5, AD)],
-        [("Language (Spoken: Native / Written: Native)", 6, AD)],
-        [("Luck", 15, AD), ("Extraordinary Luck", 30, AD)],
-        list_levels("Musical Ability %d", 5, AD, 2, min_level=3),
-        [("No Hangover", 1, AD)],
-        [("Penetrating Voice", 1, AD)],
-        list_levels("Signature Gear %d", 1, AD, 10),
-        [("Smooth Operator 1", 15, AD)],
-        [("Social Chameleon", 5, AD)],
-        [("Wealth (Comfortable)", 10, AD), ("Wealth (Wealthy)", 20, AD)],
-        [("Wild Talent 1", 20, AD)],
-    ]
-    ads2.extend(ads1)
-    traits.extend(pick_from_list(ads2, 25))
-
-    fix_language_talent(traits)
-    # TODO If that lowered any costs take more advantages
-
-    disads1 = [
-        list_self_control_levels2("Chummy", -5, "Gregarious", -10),
-        list_self_control_levels("Compulsive Carousing", -5),
-        list_self_control_levels("Lecherousness", -15),
-        [("Sense of Duty (Adventuring companions)", -5, DI)],
-        list_self_control_levels("Xenophilia", -10),
-    ]
-    traits.extend(pick_from_list(disads1, -15))
+    ],
+    stages=[
+        Stage(
+            "ads1",
+            25,
+            [
+                [("Empathy (PM)", 11, AD)],
+                [("Mimicry (PM)", 7, AD)],
+                [("Mind Control (PM)", 35, AD)],
+                [("Rapier Wit (PM)", 4, AD)],
+                [("Speak With Animals (PM)", 18, AD)],
+                [("Subsonic Speech (PM)", 7, AD)],
+                [("Telecommunication (Telesend, PM)", 21, AD)],
+                [("Terror (PM)", 21, AD)],
+                [("Ultrasonic Speech (PM)", 7, AD)],
+            ],
+            spells="bard_spells",
+            prereqs=True,
+        ),
+        Stage(
+            "ads2",
+            25,
+            [
+                [("DX +1", 20, PA)],
+                [("IQ +1", 20, PA)],
+                list_levels("FP +%d", 3, SA, 8),
+                [("Basic Speed +1", 20, SA)],
+                list_levels("Acute Hearing %d", 2, AD, 5),
+                [
+                    ("Appearance: Attractive", 4, AD),
+                    ("Appearance: Handsome", 12, AD),
+                    ("Appearance: Very Handsome", 16, AD),
+                ],
+                list_levels("Bardic Talent %d", 8, AD, 2, min_level=3),
+                list_levels("Charisma %d", 5, AD, 5, min_level=2),
+                [("Cultural Adaptability", 10, AD)],
+                [("Eidetic Memory", 5, AD), ("Photographic Memory", 10, AD)],
+                [("Honest Face", 1, AD)],
+                [("Language Talent", 10, AD)],
+                [("Language (Spoken: Broken / Written: None)", 1, AD)],
+                [("Language (Spoken: None / Written: Broken)", 1, AD)],
+                [("Language (Spoken: Accented / Written: None)", 2, AD)],
+                [("Language (Spoken: Broken / Written: Broken)", 2, AD)],
+                [("Language (Spoken: None / Written: Accented)", 2, AD)],
+                [("Language (Spoken: Native / Written: None)", 3, AD)],
+                [("Language (Spoken: Accented / Written: Broken)", 3, AD)],
+                [("Language (Spoken: Broken / Written: Accented)", 3, AD)],
+                [("Language (Spoken: None / Written: Native)", 3, AD)],
+                [("Language (Spoken: Native / Written: Broken)", 4, AD)],
+                [("Language (Spoken: Accented / Written: Accented)", 4, AD)],
+                [("Language (Spoken: Broken / Written: Native)", 4, AD)],
+                [("Language (Spoken: Native / Written: Accented)", 5, AD)],
+                [("Language (Spoken: Accented / Written: Native)", 5, AD)],
+                [("Language (Spoken: Native / Written: Native)", 6, AD)],
+                [("Luck", 15, AD), ("Extraordinary Luck", 30, AD)],
+                list_levels("Musical Ability %d", 5, AD, 2, min_level=3),
+                [("No Hangover", 1, AD)],
+                [("Penetrating Voice", 1, AD)],
+                list_levels("Signature Gear %d", 1, AD, 10),
+                [("Smooth Operator 1", 15, AD)],
+                [("Social Chameleon", 5, AD)],
+                [
+                    ("Wealth (Comfortable)", 10, AD),
+                    ("Wealth (Wealthy)", 20, AD),
+                ],
+                [("Wild Talent 1", 20, AD)],
+            ],
+            reuse=("ads1",),
+            after=fix_language_talent,
+            # TODO If that lowered any costs take more advantages
+        ),
+        Stage(
+            "disads1",
+            -15,
+            [
+                list_self_control_levels2("Chummy", -5, "Gregarious", -10),
+                list_self_control_levels("Compulsive Carousing", -5),
+                list_self_control_levels("Lecherousness", -15),
+                [("Sense of Duty (Adventuring companions)", -5, DI)],
+                list_self_control_levels("Xenophilia", -10),
+            ],
+        ),
+        Stage(
+            "disads2",
+            -15,
+            [
+                list_self_control_levels("Curious", -5),
+                list_self_control_levels("Impulsiveness", -10),
+                list_self_control_levels("Overconfidence", -5),
+                list_self_control_levels("Trickster", -15),
+            ],
+            reuse=("disads1",),
+        ),
+        Stage(
+            "disads3",
+            -20,
+            [
+                [("Code of Honor (Gentleman's)", -10, DI)],
+                list_self_control_levels("Compulsive Lying", -15),
+                [
+                    (
+                        "Odious Personal Habit (Continuous singing or strumming)",
+                        -5,
+                        DI,
+                    )
+                ],
+                list_self_control_levels("Post-Combat Shakes", -5),
+            ],
+            reuse=("disads2",),
+        ),
+        Stage(
+            "skills1",
+            12,
+            [
+                [
+                    ("Rapier", 12, SK),
+                    ("Saber", 12, SK),
+                    ("Shortsword", 12, SK),
+                    ("Smallsword", 12, SK),
+                ],
+                [
+                    ("Rapier", 8, SK),
+                    ("Saber", 8, SK),
+                    ("Shortsword", 8, SK),
+                    ("Smallsword", 8, SK),
+                ],
+                [
+                    ("Shield (Buckler)", 4, SK),
+                    ("Cloak", 4, SK),
+                    ("Main-Gauche", 4, SK),
+                ],
+            ],
+        ),
+        Stage(
+            "skills2",
+            2,
+            [
+                [("Thrown Weapon (Knife)", 2, SK)],
+                [("Bow", 2, SK)],
+                [("Throwing", 2, SK)],
+            ],
+        ),
+        Stage(
+            "skills3",
+            6,
+            [
+                [("Climbing", 1, SK)],
+                [("Dancing", 1, SK)],
+                [("Acrobatics", 1, SK)],
+                [("Slight of Hand", 1, SK)],
+                [("First Aid", 1, SK)],
+                [("Gesture", 1, SK)],
+                [("Connoisseur (any)", 1, SK)],
+                [("Disguise", 1, SK)],
+                [("Teaching", 1, SK)],
+                [("Writing", 1, SK)],
+                [("Mimicry (Speech)", 1, SK)],
+                [("Ventriloquism", 1, SK)],
+                [("Hiking", 1, SK)],
+                [("Sex Appeal", 1, SK)],
+                [("Scrounging", 1, SK)],
+                [("Observation", 1, SK)],
+            ],
+        ),
+        Stage(
+            "special_skills",
+            20,
+            [],
+            spells="bard_spells",
+            skip_known=True,
+            prereqs=True,
+        ),
+    ],
+)
 
-    disads2 = [
-        list_self_control_levels("Curious", -5),
-        list_self_control_levels("Impulsiveness", -10),
-        list_self_control_levels("Overconfidence", -5),
-        list_self_control_levels("Trickster", -15),
-    ]
-    disads2.extend(disads1)
-    traits.extend(pick_from_list(disads2, -15))
-
-    disads3 = [
-        [("Code of Honor (Gentleman's)", -10, DI)],
-        list_self_control_levels("Compulsive Lying", -15),
-        [("Odious Personal Habit (Continuous singing or strumming)", -5, DI)],
-        list_self_control_levels("Post-Combat Shakes", -5),
-    ]
-    disads3.extend(disads2)
-    traits.extend(pick_from_list(disads3, -20))
-
-    skills1 = [
-        [
-            ("Rapier", 12, SK),
-            ("Saber", 12, SK),
-            ("Shortsword", 12, SK),
-            ("Smallsword", 12, SK),
-        ],
-        [
-            ("Rapier", 8, SK),
-            ("Saber", 8, SK),
-            ("Shortsword", 8, SK),
-            ("Smallsword", 8, SK),
-        ],
-        [
-            ("Shield (Buckler)", 4, SK),
-            ("Cloak", 4, SK),
-            ("Main-Gauche", 4, SK),
-        ],
-    ]
-    traits.extend(pick_from_list(skills1, 12))
 
-    skills2 = [
-        [("Thrown Weapon (Knife)", 2, SK)],
-        [("Bow", 2, SK)],
-        [("Throwing", 2, SK)],
-    ]
-    traits.extend(pick_from_list(skills2, 2))
-
-    skills3 = [
-        [("Climbing", 1, SK)],
-        [("Dancing", 1, SK)],
-        [("Acrobatics", 1, SK)],
-        [("Slight of Hand", 1, SK)],
-        [("First Aid", 1, SK)],
-        [("Gesture", 1, SK)],
-        [("Connoisseur (any)", 1, SK)],
-        [("Disguise", 1, SK)],
-        [("Teaching", 1, SK)],
-        [("Writing", 1, SK)],
-        [("Mimicry (Speech)", 1, SK)],
-        [("Ventriloquism", 1, SK)],
-        [("Hiking", 1, SK)],
-        [("Sex Appeal", 1, SK)],
-        [("Scrounging", 1, SK)],
-        [("Observation", 1, SK)],
-    ]
-    traits.extend(pick_from_list(skills3, 6))
+def generate_bard(
+    context: GenerationContext = None,
+) -> List[Tuple[str, int, TraitType]]:
+    return template_to_compiled["bard"].generate(context)
 
-    special_skills = []
-    for spell in spell_to_prereq_function:
-        if (spell, 1, SP) not in traits:
-            special_skills.append([(spell, 1, SP)])
-    traits.extend(pick_from_list_enforcing_prereqs(special_skills, 20, traits))
 
-    return traits
+def _format_level(level: float) -> str:
+    """Return level as text: whole levels, like 6.0, without a fraction,
+    and others, like 6.5, with one."""
+    if level == int(level):
+        return "%d" % level
+    return "%s" % level
 
 
 def merge_traits(
@@ -614,59 +1501,55 @@ def merge_traits(
 ) -> List[Tuple[str, int, TraitType]]:
     """Merge traits like "ST 12" and "ST +2" or "Magery 3" and "Magery 4".
 
-    Return a new traits list of (name, cost) tuples.
+    Levels are parsed with _parse_level().  The merged level is the
+    highest absolute level plus the relative ones, and costs add up.  The
+    merged trait goes where the first one was, with its trait_type.
+
+    Return a new traits list of (name, cost, trait_type) tuples.
     """
     bare_name_to_level: Dict[str, float] = {}
+    bare_name_to_plus: Dict[str, float] = {}
     bare_name_to_cost: Dict[str, int] = {}
-    trait_name_to_bare_name = {}
-    plus_pat = "(.*) \+(\d+)$"
-    level_pat = "(.*) ([0-9.]+)$"
+    parsed = []
     for trait_name, cost, trait_type in traits:
-        # Look for trait names like "ST +2"
-        match = re.search(plus_pat, trait_name)
-        if match:
-            bare_name = match.group(1)
-            plus_level = int(match.group(2))
-            bare_name_to_level[bare_name] += plus_level
-            bare_name_to_cost[bare_name] += cost
-            trait_name_to_bare_name[trait_name] = bare_name
-        else:
-            # Look for trait names like "Magery 3" or "Basic Speed 6.5"
-            match = re.search(level_pat, trait_name)
-            if match:
-                bare_name = match.group(1)
-                str_level = match.group(2)
-                if "." in str_level:
-                    level = float(str_level)
-                else:
-                    level = int(str_level)
-                bare_name_to_level[bare_name] = max(
-                    bare_name_to_level.get(bare_name, 0), level
+        level_tuple = _parse_level(trait_name)
+        parsed.append(level_tuple)
+        if level_tuple is not None:
+            bare_name, level, relative = level_tuple
+            if relative:
+                bare_name_to_plus[bare_name] = (
+                    bare_name_to_plus.get(bare_name, 0) + level
                 )
-                bare_name_to_cost[bare_name] = (
-                    bare_name_to_cost.get(bare_name, 0) + cost
+            else:
+                bare_name_to_level[bare_name] = max(
+                    bare_name_to_level.get(bare_name, level), level
                 )
-                trait_name_to_bare_name[trait_name] = bare_name
+            bare_name_to_cost[bare_name] = (
+                bare_name_to_cost.get(bare_name, 0) + cost
+            )
 
     traits2 = []
     bare_names_done: Set[str] = set()
-    for trait_name, cost, trait_type in traits:
-        bare_name = trait_name_to_bare_name.get(trait_name)
-        if bare_name in bare_names_done:
-            pass
-        elif bare_name is None:
+    for (trait_name, cost, trait_type), level_tuple in zip(traits, parsed):
+        if level_tuple is None:
             traits2.append((trait_name, cost, trait_type))
+            continue
+        bare_name = level_tuple[0]
+        if bare_name in bare_names_done:
+            continue
+        plus = bare_name_to_plus.get(bare_name, 0)
+        if bare_name in bare_name_to_level:
+            level = bare_name_to_level[bare_name] + plus
+            trait_name2 = "%s %s" % (bare_name, _format_level(level))
         else:
-            level = bare_name_to_level[bare_name]
-            trait_name2 = "%s %d" % (bare_name, level)
-            cost2 = bare_name_to_cost[bare_name]
-            traits2.append((trait_name2, cost2, trait_type))
-            bare_names_done.add(bare_name)
+            trait_name2 = "%s +%s" % (bare_name, _format_level(plus))
+        traits2.append((trait_name2, bare_name_to_cost[bare_name], trait_type))
+        bare_names_done.add(bare_name)
     return traits2
 
 
-def generate_cleric() -> List[Tuple[str, int, TraitType]]:
-    traits = [
+cleric_data = TemplateData(
+    traits=[
         ("ST 12", 20, PA),
         ("DX 12", 40, PA),
         ("IQ 14", 80, PA),
@@ -690,259 +1573,280 @@ def generate_cleric() -> List[Tuple[str, int, TraitType]]:
         ("Religious Ritual", 1, SK),
         ("Surgery", 2, SK),
         ("Meditation", 1, SK),
-    ]
-    spells = [
-        # PI 1
-        [("Armor", 1, SP)],
-        [("Aura", 1, SP)],
-        [("Body-Reading", 1, SP)],
-        [("Bravery", 1, SP)],
-        [("Cleansing", 1, SP)],
-        [("Coolness", 1, SP)],
-        [("Detect Magic", 1, SP)],
-        [("Detect Poison", 1, SP)],
-        [("Final Rest", 1, SP)],
-        [("Lend Energy", 1, SP)],
-        [("Lend Vitality", 1, SP)],
-        [("Light", 1, SP)],
-        [("Might", 1, SP)],
-        [("Minor Healing", 1, SP)],
-        [("Purify Air", 1, SP)],
-        [("Purify Water", 1, SP)],
-        [("Recover Energy", 1, SP)],
-        [("Sense Life", 1, SP)],
-        [("Sense Spirit", 1, SP)],
-        [("Share Vitality", 1, SP)],
-        [("Shield", 1, SP)],
-        [("Silence", 1, SP)],
-        [("Stop Bleeding", 1, SP)],
-        [("Test Food", 1, SP)],
-        [("Thunderclap", 1, SP)],
-        [("Umbrella", 1, SP)],
-        [("Vigor", 1, SP)],
-        [("Warmth", 1, SP)],
-        [("Watchdog", 1, SP)],
-        # PI 2
-        [("Awaken", 1, SP)],
-        [("Clean", 1, SP)],
-        [("Command", 1, SP)],
-        [("Compel Truth", 1, SP)],
-        [("Continual Light", 1, SP)],
-        [("Create Water", 1, SP)],
-        [("Glow", 1, SP)],
-        [("Great Voice", 1, SP)],
-        [("Healing Slumber", 1, SP)],
-        [("Major Healing", 1, SP)],
-        [("Peaceful Sleep", 1, SP)],
-        [("Persuasion", 1, SP)],
-        [("Purify Food", 1, SP)],
-        [("Relieve Sickness", 1, SP)],
-        [("Remove Contagion", 1, SP)],
-        [("Resist Acid", 1, SP)],
-        [("Resist Cold", 1, SP)],
-        [("Resist Disease", 1, SP)],
-        [("Resist Fire", 1, SP)],
-        [("Resist Lightning", 1, SP)],
-        [("Resist Pain", 1, SP)],
-        [("Resist Poison", 1, SP)],
-        [("Resist Pressure", 1, SP)],
-        [("Restore Hearing", 1, SP)],
-        [("Restore Memory", 1, SP)],
-        [("Restore Sight", 1, SP)],
-        [("Restore Speech", 1, SP)],
-        [("Seeker", 1, SP)],
-        [("Soilproof", 1, SP)],
-        [("Stop Spasm", 1, SP)],
-        [("Summon Spirit", 1, SP)],
-        [("Truthsayer", 1, SP)],
-        [("Turn Spirit", 1, SP)],
-        [("Turn Zombie", 1, SP)],
-        [("Wall of Light", 1, SP)],
-        # PI 3
-        [("Affect Spirits", 1, SP)],
-        [("Astral Vision", 1, SP)],
-        [("Breathe Water", 1, SP)],
-        [("Command Spirit", 1, SP)],
-        [("Create Food", 1, SP)],
-        [("Cure Disease", 1, SP)],
-        [("Dispel Possession", 1, SP)],
-        [("Flaming Weapon", 1, SP)],
-        [("Great Healing", 1, SP)],
-        [("Magic Resistance", 1, SP)],
-        [("Neutralize Poison", 1, SP)],
-        [("Oath", 1, SP)],
-        [("Relieve Madness", 1, SP)],
-        [("Relieve Paralysis", 1, SP)],
-        [("Repel Spirits", 1, SP)],
-        [("Restoration", 1, SP)],
-        [("See Secrets", 1, SP)],
-        [("Silver Tongue", 1, SP)],
-        [("Stone to Flesh", 1, SP)],
-        [("Stop Paralysis", 1, SP)],
-        [("Strengthen Will", 1, SP)],
-        [("Sunbolt", 1, SP)],
-        [("Sunlight", 1, SP)],
-        [("Suspended Animation", 1, SP)],
-        [("Water to Wine", 1, SP)],
-        [("Wisdom", 1, SP)],
-    ]
-    ads1 = [
-        [
-            ("Ally (Divine servent, PM, Summonable, 12-)", 19, AD),
-            ("Ally (Divine servent, PM, Summonable, 15-)", 29, AD),
-        ],
-        [
-            ("Detect evil (PM)", 18, AD),
-            ("Detect good (PM)", 18, AD),
-            ("Detect supernatural beings (PM)", 18, AD),
-            ("Ally (Divine servent, PM, Summonable, 15-)", 29, AD),
-        ],
-        [("Healing (Faith Healing, PM)", 33, AD)],
-        [("Intuition (PM)", 14, AD)],
-        [("Oracle (PM)", 14, AD)],
-        [
-            (
-                "Patron (Deity, PM, Special Abilities, Highly Accessible, 6-)",
-                36,
-                AD,
-            ),
-            (
-                "Patron (Deity, PM, Special Abilities, Highly Accessible, 9-)",
-                72,
-                AD,
-            ),
-        ],
-        [
-            ("Resistant to Evil Supernatural Powers (PM) 3", 5, AD),
-            ("Resistant to Evil Supernatural Powers (PM) 8", 7, AD),
-        ],
-        [("Spirit Empathy (PM)", 9, AD)],
-        [("True Faith (PM, Turning)", 24, AD)],
-    ]
-    ads1.extend(spells)
-    # TODO Add PI 4 spells if PI 4 is selected.  (No points left after PI 5.)
-    traits.extend(pick_from_list(ads1, 25))
-
-    ads2 = [
-        list_levels("ST +%d", 10, PA, 2),
-        [("DX +1", 20, PA)],
-        [("IQ +1", 20, PA)],
-        list_levels("HT +%d", 10, PA, 2),
-        list_levels("Will +%d", 5, SA, 4),
-        list_levels("FP +%d", 3, SA, 6),
-        list_levels("Fearlessness %d", 2, AD, 5),
-        [("Unfazeable", 15, AD)],
-        list_levels("Healer %d", 10, AD, 2),
-        [("Language (Spoken: Broken / Written: None)", 1, AD)],
-        [("Language (Spoken: None / Written: Broken)", 1, AD)],
-        [("Language (Spoken: Accented / Written: None)", 2, AD)],
-        [("Language (Spoken: Broken / Written: Broken)", 2, AD)],
-        [("Language (Spoken: None / Written: Accented)", 2, AD)],
-        [("Language (Spoken: Native / Written: None)", 3, AD)],
-        [("Language (Spoken: Accented / Written: Broken)", 3, AD)],
-        [("Language (Spoken: Broken / Written: Accented)", 3, AD)],
-        [("Language (Spoken: None / Written: Native)", 3, AD)],
-        [("Language (Spoken: Native / Written: Broken)", 4, AD)],
-        [("Language (Spoken: Accented / Written: Accented)", 4, AD)],
-        [("Language (Spoken: Broken / Written: Native)", 4, AD)],
-        [("Language (Spoken: Native / Written: Accented)", 5, AD)],
-        [("Language (Spoken: Accented / Written: Native)", 5, AD)],
-        [("Language (Spoken: Native / Written: Native)", 6, AD)],
-        [("Luck", 15, AD)],
-        list_levels("Mind Shield %d", 4, AD, 5),
-        list_levels("Power Investiture %d", 10, AD, 2, min_level=4),
-        [
-            ("Resistant to Disease (PM) 3", 3, AD),
-            ("Resistant to Disease (PM) 8", 5, AD),
-        ],
-        list_levels("Signature Gear %d", 1, AD, 10),
-    ]
-    ads2.extend(ads1)
-    traits.extend(pick_from_list(ads2, 20))
-
-    disads1 = [
-        [("Honesty (12)", -10, DI)],
-        [("Sense of Duty (Coreligionists)", -10, DI)],
-        [("Vow (No edged weapons)", -10, DI)],
-    ]
-    traits.extend(pick_from_list(disads1, -10))
-
-    disads2 = [
-        [
-            ("Disciplines of Faith (Ritualism)", -5, DI),
-            ("Disciplines of Faith (Ritualism)", -10, DI),
-            ("Disciplines of Faith (Mysticism)", -5, DI),
-            ("Disciplines of Faith (Mysticism)", -10, DI),
-        ],
-        [("Fanaticism", -15, DI)],
-        [
-            ("Intolerance (Evil religions)", -5, DI),
-            ("Intolerance (All other religions)", -10, DI),
-        ],
-        [("Vow (Chastity)", -5, DI), ("Vow (Vegetarianism)", -5, DI)],
-        [("Wealth (Struggling)", -10, DI), ("Wealth (Poor)", -15, DI)],
-    ]
-    disads2.extend(disads1)
-    traits.extend(pick_from_list(disads2, -15))
-
-    disads3 = [
-        list_self_control_levels("Charitable", -15),
-        list_self_control_levels("Compulsive Generosity", -5)
-        + list_self_control_levels("Miserliness", -10),
-        list_self_control_levels("Gluttony", -5),
-        list_self_control_levels("Overconfidence", -5),
-        [("Overweight", -1, DI), ("Fat", -3, DI)],
-        list_self_control_levels("Selfless", -5),
-        [("Sense of Duty (Adventuring companions)", -5, DI)],
-        [("Stubbornness", -5, DI)],
-        list_self_control_levels("Truthfulness", -5),
-        [("Weirdness Magnet", -15, DI)],
-    ]
-    disads3.extend(disads2)
-    traits.extend(pick_from_list(disads3, -25))
-
-    skills1 = [
-        [("Innate Attack", 4, SK)],
-        [("Throwing", 4, SK)],
-        [("Sling", 4, SK)],
-    ]
-    traits.extend(pick_from_list(skills1, 4))
-
-    skills2 = [
-        [("Axe/Mace", 8, SK), ("Broadsword", 8, SK), ("Flail", 8, SK)],
-        [("Shield", 4, SK)],
-        [("Staff", 12, SK)],
-    ]
-    traits.extend(pick_from_list(skills2, 12))
-
-    skills3 = [
-        [("Hidden Lore (Demons)", 1, SK)],
-        [("Hidden Lore (Spirits)", 1, SK)],
-        [("Hidden Lore (Undead)", 1, SK)],
-    ]
-    traits.extend(pick_from_list(skills3, 1))
-
-    skills4 = [
-        [("Climbing", 1, SK)],
-        [("Stealth", 1, SK)],
-        [("Gesture", 1, SK)],
-        [("Panhandling", 1, SK)],
-        [("Savoir-Faire (High Society)", 1, SK)],
-        [("Research", 1, SK)],
-        [("Writing", 1, SK)],
-        [("Hiking", 1, SK)],
-        [("Scrounging", 1, SK)],
-        [("Observation", 1, SK)],
-        [("Search", 1, SK)],
-    ]
-    traits.extend(pick_from_list(skills4, 5))
-
-    trait_names = set((trait[0] for trait in traits))
-    if (
-        "Power Investiture 4" in trait_names
-        or "Power Investiture 5" in trait_names
-    ):
-        spells.extend(
+    ],
+    stages=[
+        Stage(
+            "spells",
+            None,
+            [
+                # PI 1
+                [("Armor", 1, SP)],
+                [("Aura", 1, SP)],
+                [("Body-Reading", 1, SP)],
+                [("Bravery", 1, SP)],
+                [("Cleansing", 1, SP)],
+                [("Coolness", 1, SP)],
+                [("Detect Magic", 1, SP)],
+                [("Detect Poison", 1, SP)],
+                [("Final Rest", 1, SP)],
+                [("Lend Energy", 1, SP)],
+                [("Lend Vitality", 1, SP)],
+                [("Light", 1, SP)],
+                [("Might", 1, SP)],
+                [("Minor Healing", 1, SP)],
+                [("Purify Air", 1, SP)],
+                [("Purify Water", 1, SP)],
+                [("Recover Energy", 1, SP)],
+                [("Sense Life", 1, SP)],
+                [("Sense Spirit", 1, SP)],
+                [("Share Vitality", 1, SP)],
+                [("Shield", 1, SP)],
+                [("Silence", 1, SP)],
+                [("Stop Bleeding", 1, SP)],
+                [("Test Food", 1, SP)],
+                [("Thunderclap", 1, SP)],
+                [("Umbrella", 1, SP)],
+                [("Vigor", 1, SP)],
+                [("Warmth", 1, SP)],
+                [("Watchdog", 1, SP)],
+                # PI 2
+                [("Awaken", 1, SP)],
+                [("Clean", 1, SP)],
+                [("Command", 1, SP)],
+                [("Compel Truth", 1, SP)],
+                [("Continual Light", 1, SP)],
+                [("Create Water", 1, SP)],
+                [("Glow", 1, SP)],
+                [("Great Voice", 1, SP)],
+                [("Healing Slumber", 1, SP)],
+                [("Major Healing", 1, SP)],
+                [("Peaceful Sleep", 1, SP)],
+                [("Persuasion", 1, SP)],
+                [("Purify Food", 1, SP)],
+                [("Relieve Sickness", 1, SP)],
+                [("Remove Contagion", 1, SP)],
+                [("Resist Acid", 1, SP)],
+                [("Resist Cold", 1, SP)],
+                [("Resist Disease", 1, SP)],
+                [("Resist Fire", 1, SP)],
+                [("Resist Lightning", 1, SP)],
+                [("Resist Pain", 1, SP)],
+                [("Resist Poison", 1, SP)],
+                [("Resist Pressure", 1, SP)],
+                [("Restore Hearing", 1, SP)],
+                [("Restore Memory", 1, SP)],
+                [("Restore Sight", 1, SP)],
+                [("Restore Speech", 1, SP)],
+                [("Seeker", 1, SP)],
+                [("Soilproof", 1, SP)],
+                [("Stop Spasm", 1, SP)],
+                [("Summon Spirit", 1, SP)],
+                [("Truthsayer", 1, SP)],
+                [("Turn Spirit", 1, SP)],
+                [("Turn Zombie", 1, SP)],
+                [("Wall of Light", 1, SP)],
+                # PI 3
+                [("Affect Spirits", 1, SP)],
+                [("Astral Vision", 1, SP)],
+                [("Breathe Water", 1, SP)],
+                [("Command Spirit", 1, SP)],
+                [("Create Food", 1, SP)],
+                [("Cure Disease", 1, SP)],
+                [("Dispel Possession", 1, SP)],
+                [("Flaming Weapon", 1, SP)],
+                [("Great Healing", 1, SP)],
+                [("Magic Resistance", 1, SP)],
+                [("Neutralize Poison", 1, SP)],
+                [("Oath", 1, SP)],
+                [("Relieve Madness", 1, SP)],
+                [("Relieve Paralysis", 1, SP)],
+                [("Repel Spirits", 1, SP)],
+                [("Restoration", 1, SP)],
+                [("See Secrets", 1, SP)],
+                [("Silver Tongue", 1, SP)],
+                [("Stone to Flesh", 1, SP)],
+                [("Stop Paralysis", 1, SP)],
+                [("Strengthen Will", 1, SP)],
+                [("Sunbolt", 1, SP)],
+                [("Sunlight", 1, SP)],
+                [("Suspended Animation", 1, SP)],
+                [("Water to Wine", 1, SP)],
+                [("Wisdom", 1, SP)],
+            ],
+        ),
+        # TODO Add PI 4 spells if PI 4 is selected.  (No points left after
+        # PI 5.)
+        Stage(
+            "ads1",
+            25,
+            [
+                [
+                    ("Ally (Divine servent, PM, Summonable, 12-)", 19, AD),
+                    ("Ally (Divine servent, PM, Summonable, 15-)", 29, AD),
+                ],
+                [
+                    ("Detect evil (PM)", 18, AD),
+                    ("Detect good (PM)", 18, AD),
+                    ("Detect supernatural beings (PM)", 18, AD),
+                    ("Ally (Divine servent, PM, Summonable, 15-)", 29, AD),
+                ],
+                [("Healing (Faith Healing, PM)", 33, AD)],
+                [("Intuition (PM)", 14, AD)],
+                [("Oracle (PM)", 14, AD)],
+                [
+                    (
+                        "Patron (Deity, PM, Special Abilities, Highly Accessible, 6-)",
+                        36,
+                        AD,
+                    ),
+                    (
+                        "Patron (Deity, PM, Special Abilities, Highly Accessible, 9-)",
+                        72,
+                        AD,
+                    ),
+                ],
+                [
+                    ("Resistant to Evil Supernatural Powers (PM) 3", 5, AD),
+                    ("Resistant to Evil Supernatural Powers (PM) 8", 7, AD),
+                ],
+                [("Spirit Empathy (PM)", 9, AD)],
+                [("True Faith (PM, Turning)", 24, AD)],
+            ],
+            reuse=("spells",),
+        ),
+        Stage(
+            "ads2",
+            20,
+            [
+                list_levels("ST +%d", 10, PA, 2),
+                [("DX +1", 20, PA)],
+                [("IQ +1", 20, PA)],
+                list_levels("HT +%d", 10, PA, 2),
+                list_levels("Will +%d", 5, SA, 4),
+                list_levels("FP +%d", 3, SA, 6),
+                list_levels("Fearlessness %d", 2, AD, 5),
+                [("Unfazeable", 15, AD)],
+                list_levels("Healer %d", 10, AD, 2),
+                [("Language (Spoken: Broken / Written: None)", 1, AD)],
+                [("Language (Spoken: None / Written: Broken)", 1, AD)],
+                [("Language (Spoken: Accented / Written: None)", 2, AD)],
+                [("Language (Spoken: Broken / Written: Broken)", 2, AD)],
+                [("Language (Spoken: None / Written: Accented)", 2, AD)],
+                [("Language (Spoken: Native / Written: None)", 3, AD)],
+                [("Language (Spoken: Accented / Written: Broken)", 3, AD)],
+                [("Language (Spoken: Broken / Written: Accented)", 3, AD)],
+                [("Language (Spoken: None / Written: Native)", 3, AD)],
+                [("Language (Spoken: Native / Written: Broken)", 4, AD)],
+                [("Language (Spoken: Accented / Written: Accented)", 4, AD)],
+                [("Language (Spoken: Broken / Written: Native)", 4, AD)],
+                [("Language (Spoken: Native / Written: Accented)", 5, AD)],
+                [("Language (Spoken: Accented / Written: Native)", 5, AD)],
+                [("Language (Spoken: Native / Written: Native)", 6, AD)],
+                [("Luck", 15, AD)],
+                list_levels("Mind Shield %d", 4, AD, 5),
+                list_levels("Power Investiture %d", 10, AD, 2, min_level=4),
+                [
+                    ("Resistant to Disease (PM) 3", 3, AD),
+                    ("Resistant to Disease (PM) 8", 5, AD),
+                ],
+                list_levels("Signature Gear %d", 1, AD, 10),
+            ],
+            reuse=("ads1",),
+        ),
+        Stage(
+            "disads1",
+            -10,
+            [
+                [("Honesty (12)", -10, DI)],
+                [("Sense of Duty (Coreligionists)", -10, DI)],
+                [("Vow (No edged weapons)", -10, DI)],
+            ],
+        ),
+        Stage(
+            "disads2",
+            -15,
+            [
+                [
+                    ("Disciplines of Faith (Ritualism)", -5, DI),
+                    ("Disciplines of Faith (Ritualism)", -10, DI),
+                    ("Disciplines of Faith (Mysticism)", -5, DI),
+                    ("Disciplines of Faith (Mysticism)", -10, DI),
+                ],
+                [("Fanaticism", -15, DI)],
+                [
+                    ("Intolerance (Evil religions)", -5, DI),
+                    ("Intolerance (All other religions)", -10, DI),
+                ],
+                [("Vow (Chastity)", -5, DI), ("Vow (Vegetarianism)", -5, DI)],
+                [("Wealth (Struggling)", -10, DI), ("Wealth (Poor)", -15, DI)],
+            ],
+            reuse=("disads1",),
+        ),
+        Stage(
+            "disads3",
+            -25,
+            [
+                list_self_control_levels("Charitable", -15),
+                list_self_control_levels("Compulsive Generosity", -5)
+                + list_self_control_levels("Miserliness", -10),
+                list_self_control_levels("Gluttony", -5),
+                list_self_control_levels("Overconfidence", -5),
+                [("Overweight", -1, DI), ("Fat", -3, DI)],
+                list_self_control_levels("Selfless", -5),
+                [("Sense of Duty (Adventuring companions)", -5, DI)],
+                [("Stubbornness", -5, DI)],
+                list_self_control_levels("Truthfulness", -5),
+                [("Weirdness Magnet", -15, DI)],
+            ],
+            reuse=("disads2",),
+        ),
+        Stage(
+            "skills1",
+            4,
+            [
+                [("Innate Attack", 4, SK)],
+                [("Throwing", 4, SK)],
+                [("Sling", 4, SK)],
+            ],
+        ),
+        Stage(
+            "skills2",
+            12,
+            [
+                [("Axe/Mace", 8, SK), ("Broadsword", 8, SK), ("Flail", 8, SK)],
+                [("Shield", 4, SK)],
+                [("Staff", 12, SK)],
+            ],
+        ),
+        Stage(
+            "skills3",
+            1,
+            [
+                [("Hidden Lore (Demons)", 1, SK)],
+                [("Hidden Lore (Spirits)", 1, SK)],
+                [("Hidden Lore (Undead)", 1, SK)],
+            ],
+        ),
+        Stage(
+            "skills4",
+            5,
+            [
+                [("Climbing", 1, SK)],
+                [("Stealth", 1, SK)],
+                [("Gesture", 1, SK)],
+                [("Panhandling", 1, SK)],
+                [("Savoir-Faire (High Society)", 1, SK)],
+                [("Research", 1, SK)],
+                [("Writing", 1, SK)],
+                [("Hiking", 1, SK)],
+                [("Scrounging", 1, SK)],
+                [("Observation", 1, SK)],
+                [("Search", 1, SK)],
+            ],
+        ),
+        Stage(
+            "pi4_spells",
+            None,
             [
                 [("Astral Block", 1, SP)],
                 [("Banish", 1, SP)],
@@ -958,28 +1862,43 @@ def generate_cleric() -> List[Tuple[str, int, TraitType]]:
                 [("Regeneration", 1, SP)],
                 [("Suspend Curse", 1, SP)],
                 [("Vigil", 1, SP)],
-            ]
-        )
-        if "Power Investiture 5" in trait_names:
-            spells.extend(
-                [
-                    [("Bless", 1, SP)],
-                    [("Curse", 1, SP)],
-                    [("Earthquake", 1, SP)],
-                    [("Entrap Spirit", 1, SP)],
-                    [("Instant Regeneration", 1, SP)],
-                    [("Pentagram", 1, SP)],
-                    [("Remove Curse", 1, SP)],
-                    [("Storm", 1, SP)],
-                    [("Suspend Mana", 1, SP)],
-                ]
-            )
-    traits.extend(pick_from_list(spells, 20))
-    return traits
+            ],
+            only_with=("Power Investiture 4", "Power Investiture 5"),
+        ),
+        Stage(
+            "pi5_spells",
+            None,
+            [
+                [("Bless", 1, SP)],
+                [("Curse", 1, SP)],
+                [("Earthquake", 1, SP)],
+                [("Entrap Spirit", 1, SP)],
+                [("Instant Regeneration", 1, SP)],
+                [("Pentagram", 1, SP)],
+                [("Remove Curse", 1, SP)],
+                [("Storm", 1, SP)],
+                [("Suspend Mana", 1, SP)],
+            ],
+            only_with=("Power Investiture 5",),
+        ),
+        Stage(
+            "spells2",
+            20,
+            [],
+            reuse=("spells", "pi4_spells", "pi5_spells"),
+        ),
+    ],
+)
 
 
-def generate_druid() -> List[Tuple[str, int, TraitType]]:
-    traits = [
+def generate_cleric(
+    context: GenerationContext = None,
+) -> List[Tuple[str, int, TraitType]]:
+    return template_to_compiled["cleric"].generate(context)
+
+
+druid_data = TemplateData(
+    traits=[
         ("ST 11", 10, PA),
         ("DX 12", 40, PA),
         ("IQ 14", 80, PA),
@@ -1006,270 +1925,290 @@ def generate_druid() -> List[Tuple[str, int, TraitType]]:
         ("Climbing", 2, SK),
         ("Stealth", 2, SK),
         ("Hiking", 1, SK),
-    ]
-
-    spells = [
-        # PI 1
-        [("Beast-Rouser", 1, SP)],
-        [("Beast-Soother", 1, SP)],
-        [("Detect Magic", 1, SP)],
-        [("Detect Poison", 1, SP)],
-        [("Extinguish Fire", 1, SP)],
-        [("Find Direction", 1, SP)],
-        [("Hawk Vision", 1, SP)],
-        [("Identify Plant", 1, SP)],
-        [("Master", 1, SP)],
-        [("No-Smell", 1, SP)],
-        [("Purify Air", 1, SP)],
-        [("Purify Earth", 1, SP)],
-        [("Purify Water", 1, SP)],
-        [("Quick March", 1, SP)],
-        [("Recover Energy", 1, SP)],
-        [("Seek Coastline", 1, SP)],
-        [("Seek Earth", 1, SP)],
-        [("Seek Food", 1, SP)],
-        [("Seek Pass", 1, SP)],
-        [("Seek Plant", 1, SP)],
-        [("Seek Water", 1, SP)],
-        [("Sense Life", 1, SP)],
-        [("Tell Position", 1, SP)],
-        [("Umbrella", 1, SP)],
-        # PI 2
-        [("Animal Control", 1, SP)],
-        [("Beast Link", 1, SP)],
-        [("Beast Seeker", 1, SP)],
-        [("Beast Speech", 1, SP)],
-        [("Bless Plants", 1, SP)],
-        [("Cure Disease", 1, SP)],
-        [("Fog", 1, SP)],
-        [("Frost", 1, SP)],
-        [("Heal Plant", 1, SP)],
-        [("Hide Path", 1, SP)],
-        [("Know Location", 1, SP)],
-        [("Light Tread", 1, SP)],
-        [("Mystic Mist", 1, SP)],
-        [("Neutralize Poison", 1, SP)],
-        [("Pathfinder", 1, SP)],
-        [("Plant Growth", 1, SP)],
-        [("Plant Vision", 1, SP)],
-        [("Pollen Cloud", 1, SP)],
-        [("Predict Earth Movement", 1, SP)],
-        [("Predict Weather", 1, SP)],
-        [("Purify Food", 1, SP)],
-        [("Repel Animal", 1, SP)],
-        [("Rider", 1, SP)],
-        [("Rider Within", 1, SP)],
-        [("Shape Air", 1, SP)],
-        [("Shape Earth", 1, SP)],
-        [("Shape Plant", 1, SP)],
-        [("Shape Water", 1, SP)],
-        [("Spider Silk", 1, SP)],
-        [("Wall of Wind", 1, SP)],
-        [("Weather Dome", 1, SP)],
-        [("Windstorm", 1, SP)],
-        # PI 3
-        [("Animate Plant", 1, SP)],
-        [("Beast Summoning", 1, SP)],
-        [("Blossom", 1, SP)],
-        [("Breathe Water", 1, SP)],
-        [("Clouds", 1, SP)],
-        [("Conceal", 1, SP)],
-        [("Create Plant", 1, SP)],
-        [("False Tracks", 1, SP)],
-        [("Forest Warning", 1, SP)],
-        [("Freeze", 1, SP)],
-        [("Instant Neutralize Poison", 1, SP)],
-        [("Melt Ice", 1, SP)],
-        [("Plant Control", 1, SP)],
-        [("Plant Sense", 1, SP)],
-        [("Plant Speech", 1, SP)],
-        [("Protect Animal", 1, SP)],
-        [("Rain", 1, SP)],
-        [("Rain of Nuts", 1, SP)],
-        [("Rejuvenate Plant", 1, SP)],
-        [("Remember Path", 1, SP)],
-        [("Resist Cold", 1, SP)],
-        [("Resist Lightning", 1, SP)],
-        [("Resist Pressure", 1, SP)],
-        [("Snow", 1, SP)],
-        [("Snow Shoes", 1, SP)],
-        [("Summon Elemental", 1, SP)],
-        [("Tangle Growth", 1, SP)],
-        [("Walk Through Plants", 1, SP)],
-        [("Walk Through Wood", 1, SP)],
-        [("Water Vision", 1, SP)],
-        [("Waves", 1, SP)],
-        [("Whirlpool", 1, SP)],
-        [("Wind", 1, SP)],
-    ]
-    ads1 = [
-        [
-            (
-                "Ally (Nature spirit or totem beast, PM, Summonable, 12-)",
-                19,
-                AD,
-            ),
-            (
-                "Ally (Nature spirit or totem beast, PM, Summonable, 15-)",
-                29,
-                AD,
-            ),
-        ],
-        [("Animal Empathy (PM)", 5, AD)],
-        [("Channeling (PM, Nature Spirits)", 4, AD)],
-        [
-            ("Damage Resistance 1 (Limited Elemental, PM)", 4, AD),
-            ("Damage Resistance 2 (Limited Elemental, PM)", 7, AD),
-        ],
-        [
-            ("Detect (Plants, PM)", 18, AD),
-            ("Detect (Animals, PM)", 18, AD),
-            ("Detect (Anything Alive, PM)", 27, AD),
-        ],
-        [("Medium (PM, Nature Spirits)", 4, AD)],
-        [("Mind Control (Animals Only, PM)", 33, AD)],
-        [("Plant Empathy (PM)", 5, AD)],
-        [("Speak With Animals (PM)", 23, AD)],
-        [("Speak With Plants (PM)", 14, AD)],
-        [
-            ("Terrain Adaptation (Ice, PM)", 5, AD),
-            ("Terrain Adaptation (Mud, PM)", 5, AD),
-            ("Terrain Adaptation (Snow, PM)", 5, AD),
-        ],
-    ]
-    ads1.extend(spells)
-    # TODO Add PI 4 spells if PI 4 is selected.  (No points left after PI 5.)
-    traits.extend(pick_from_list(ads1, 20))
-
-    ads2 = [
-        [("IQ +1", 20, PA)],
-        list_levels("HT +%d", 10, PA, 2),
-        list_levels("Per +%d", 5, SA, 4),
-        list_levels("FP +%d", 3, SA, 6),
-        list_levels("Animal Friend %d", 5, AD, 4),
-        list_levels("Green Thumb %d", 5, AD, 3, min_level=2),
-        list_levels("Healer %d", 10, AD, 2),
-        [("Intuition", 15, AD)],
-        [("Luck", 15, AD)],
-        list_levels("Mind Shield %d", 4, AD, 5),
-        list_levels("Outdoorsman %d", 10, AD, 2),
-        list_levels("Power Investiture (Druidic) %d", 10, AD, 2, min_level=4),
-        [
-            ("Resistant to Disease (PM) 3", 3, AD),
-            ("Resistant to Disease (PM) 8", 5, AD),
-        ],
-        list_levels("Signature Gear %d", 1, AD, 10),
-        [("Spirit Empathy", 10, AD)],
-    ]
-    ads2.extend(ads1)
-    traits.extend(pick_from_list(ads2, 20))
-
-    disads1 = [
-        [
-            ("Disciplines of Faith (Ritualism)", -5, DI),
-            ("Disciplines of Faith (Ritualism)", -10, DI),
-            ("Disciplines of Faith (Mysticism)", -5, DI),
-            ("Disciplines of Faith (Mysticism)", -10, DI),
-        ],
-        [("Sense of Duty (Wild Nature)", -15, DI)],
-        [("Vow (Vegetarianism)", -5, DI)],
-        [("Vow (Never Sleep Indoors)", -10, DI)],
-        [("Wealth (Struggling)", -10, DI), ("Wealth (Poor)", -15, DI)],
-    ]
-    traits.extend(pick_from_list(disads1, -20))
-
-    disads2 = [
-        [("Intolerance (Urbanites)", -5, DI)],
-        list_self_control_levels("Loner", -5),
-        [("No Sense of Humor", -10, DI)],
-        [("Odious Personal Habit (Dirty Hippy)", -5, DI)],
-        list_self_control_levels("Overconfidence", -5),
-        list_self_control_levels("Phobia (Crowds)", -15),
-        list_self_control_levels("Phobia (Fire)", -5),
-        list_self_control_levels("Phobia (Machinery)", -5),
-        [("Stubbornness", -5, DI)],
-        [("Weirdness Magnet", -15, DI)],
-    ]
-    disads2.extend(disads1)
-    traits.extend(pick_from_list(disads2, -25))
-
-    skills1 = [
-        [("Innate Attack", 4, SK)],
-        [("Thrown Weapon (Spear)", 4, SK)],
-        [("Thrown Weapon (Stick)", 4, SK)],
-        [("Bolas", 4, SK)],
-        [("Lasso", 4, SK)],
-        [("Throwing", 4, SK)],
-        [("Blowpipe", 4, SK)],
-        [("Net", 4, SK)],
-        [("Sling", 4, SK)],
-    ]
-    traits.extend(pick_from_list(skills1, 4))
-
-    skills2 = [
-        [
-            ("Axe/Mace", 8, SK),
-            ("Broadsword", 8, SK),
-            ("Shortsword", 8, SK),
-            ("Spear", 8, SK),
-        ],
-        [("Shield", 4, SK)],
-        [("Spear", 12, SK)],
-        [("Staff", 12, SK)],
-    ]
-    traits.extend(pick_from_list(skills2, 12))
-
-    skills3 = [
-        [("Hidden Lore (Elementals)", 1, SK)],
-        [("Hidden Lore (Faeries)", 1, SK)],
-        [("Hidden Lore (Nature Spirits)", 1, SK)],
-    ]
-    traits.extend(pick_from_list(skills3, 1))
-
-    skills4 = [
-        [("Mimicry (Animal Sounds)", 1, SK)],
-        [("Mimicry (Bird Calls)", 1, SK)],
-    ]
-    traits.extend(pick_from_list(skills4, 1))
-
-    skills5 = [
-        [("Survival (Arctic)", 1, SK)],
-        [("Survival (Desert)", 1, SK)],
-        [("Survival (Island/Beach)", 1, SK)],
-        [("Survival (Jungle)", 1, SK)],
-        [("Survival (Mountain)", 1, SK)],
-        [("Survival (Plains)", 1, SK)],
-        [("Survival (Swampland)", 1, SK)],
-        [("Survival (Woodlands)", 1, SK)],
-    ]
-    traits.extend(pick_from_list(skills5, 1))
-
-    skills5 = [
-        [("Knife", 1, SK)],
-        [("First Aid", 1, SK)],
-        [("Gesture", 1, SK)],
-        [("Animal Handling (any other)", 1, SK)],
-        [("Hidden Lore (Elementals)", 1, SK)],
-        [("Hidden Lore (Faeries)", 1, SK)],
-        [("Hidden Lore (Nature Spirits)", 1, SK)],
-        [("Teaching", 1, SK)],
-        [("Diagnosis", 1, SK)],
-        [("Poisons", 1, SK)],
-    ]
-    # Avoid duplicate Hidden Lore
-    trait_names = set((trait[0] for trait in traits))
-    for trait_name in trait_names:
-        if [(trait_name, 1, SK)] in skills5:
-            skills5.remove([(trait_name, 1, SK)])
-
-    traits.extend(pick_from_list(skills5, 3))
-
-    trait_names = set((trait[0] for trait in traits))
-    if (
-        "Power Investiture (Druidic) 4" in trait_names
-        or "Power Investiture (Druidic) 5" in trait_names
-    ):
-        spells.extend(
+    ],
+    stages=[
+        Stage(
+            "spells",
+            None,
+            [
+                # PI 1
+                [("Beast-Rouser", 1, SP)],
+                [("Beast-Soother", 1, SP)],
+                [("Detect Magic", 1, SP)],
+                [("Detect Poison", 1, SP)],
+                [("Extinguish Fire", 1, SP)],
+                [("Find Direction", 1, SP)],
+                [("Hawk Vision", 1, SP)],
+                [("Identify Plant", 1, SP)],
+                [("Master", 1, SP)],
+                [("No-Smell", 1, SP)],
+                [("Purify Air", 1, SP)],
+                [("Purify Earth", 1, SP)],
+                [("Purify Water", 1, SP)],
+                [("Quick March", 1, SP)],
+                [("Recover Energy", 1, SP)],
+                [("Seek Coastline", 1, SP)],
+                [("Seek Earth", 1, SP)],
+                [("Seek Food", 1, SP)],
+                [("Seek Pass", 1, SP)],
+                [("Seek Plant", 1, SP)],
+                [("Seek Water", 1, SP)],
+                [("Sense Life", 1, SP)],
+                [("Tell Position", 1, SP)],
+                [("Umbrella", 1, SP)],
+                # PI 2
+                [("Animal Control", 1, SP)],
+                [("Beast Link", 1, SP)],
+                [("Beast Seeker", 1, SP)],
+                [("Beast Speech", 1, SP)],
+                [("Bless Plants", 1, SP)],
+                [("Cure Disease", 1, SP)],
+                [("Fog", 1, SP)],
+                [("Frost", 1, SP)],
+                [("Heal Plant", 1, SP)],
+                [("Hide Path", 1, SP)],
+                [("Know Location", 1, SP)],
+                [("Light Tread", 1, SP)],
+                [("Mystic Mist", 1, SP)],
+                [("Neutralize Poison", 1, SP)],
+                [("Pathfinder", 1, SP)],
+                [("Plant Growth", 1, SP)],
+                [("Plant Vision", 1, SP)],
+                [("Pollen Cloud", 1, SP)],
+                [("Predict Earth Movement", 1, SP)],
+                [("Predict Weather", 1, SP)],
+                [("Purify Food", 1, SP)],
+                [("Repel Animal", 1, SP)],
+                [("Rider", 1, SP)],
+                [("Rider Within", 1, SP)],
+                [("Shape Air", 1, SP)],
+                [("Shape Earth", 1, SP)],
+                [("Shape Plant", 1, SP)],
+                [("Shape Water", 1, SP)],
+                [("Spider Silk", 1, SP)],
+                [("Wall of Wind", 1, SP)],
+                [("Weather Dome", 1, SP)],
+                [("Windstorm", 1, SP)],
+                # PI 3
+                [("Animate Plant", 1, SP)],
+                [("Beast Summoning", 1, SP)],
+                [("Blossom", 1, SP)],
+                [("Breathe Water", 1, SP)],
+                [("Clouds", 1, SP)],
+                [("Conceal", 1, SP)],
+                [("Create Plant", 1, SP)],
+                [("False Tracks", 1, SP)],
+                [("Forest Warning", 1, SP)],
+                [("Freeze", 1, SP)],
+                [("Instant Neutralize Poison", 1, SP)],
+                [("Melt Ice", 1, SP)],
+                [("Plant Control", 1, SP)],
+                [("Plant Sense", 1, SP)],
+                [("Plant Speech", 1, SP)],
+                [("Protect Animal", 1, SP)],
+                [("Rain", 1, SP)],
+                [("Rain of Nuts", 1, SP)],
+                [("Rejuvenate Plant", 1, SP)],
+                [("Remember Path", 1, SP)],
+                [("Resist Cold", 1, SP)],
+                [("Resist Lightning", 1, SP)],
+                [("Resist Pressure", 1, SP)],
+                [("Snow", 1, SP)],
+                [("Snow Shoes", 1, SP)],
+                [("Summon Elemental", 1, SP)],
+                [("Tangle Growth", 1, SP)],
+                [("Walk Through Plants", 1, SP)],
+                [("Walk Through Wood", 1, SP)],
+                [("Water Vision", 1, SP)],
+                [("Waves", 1, SP)],
+                [("Whirlpool", 1, SP)],
+                [("Wind", 1, SP)],
+            ],
+        ),
+        # TODO Add PI 4 spells if PI 4 is selected.  (No points left after
+        # PI 5.)
+        Stage(
+            "ads1",
+            20,
+            [
+                [
+                    (
+                        "Ally (Nature spirit or totem beast, PM, Summonable, 12-)",
+                        19,
+                        AD,
+                    ),
+                    (
+                        "Ally (Nature spirit or totem beast, PM, Summonable, 15-)",
+                        29,
+                        AD,
+                    ),
+                ],
+                [("Animal Empathy (PM)", 5, AD)],
+                [("Channeling (PM, Nature Spirits)", 4, AD)],
+                [
+                    ("Damage Resistance 1 (Limited Elemental, PM)", 4, AD),
+                    ("Damage Resistance 2 (Limited Elemental, PM)", 7, AD),
+                ],
+                [
+                    ("Detect (Plants, PM)", 18, AD),
+                    ("Detect (Animals, PM)", 18, AD),
+                    ("Detect (Anything Alive, PM)", 27, AD),
+                ],
+                [("Medium (PM, Nature Spirits)", 4, AD)],
+                [("Mind Control (Animals Only, PM)", 33, AD)],
+                [("Plant Empathy (PM)", 5, AD)],
+                [("Speak With Animals (PM)", 23, AD)],
+                [("Speak With Plants (PM)", 14, AD)],
+                [
+                    ("Terrain Adaptation (Ice, PM)", 5, AD),
+                    ("Terrain Adaptation (Mud, PM)", 5, AD),
+                    ("Terrain Adaptation (Snow, PM)", 5, AD),
+                ],
+            ],
+            reuse=("spells",),
+        ),
+        Stage(
+            "ads2",
+            20,
+            [
+                [("IQ +1", 20, PA)],
+                list_levels("HT +%d", 10, PA, 2),
+                list_levels("Per +%d", 5, SA, 4),
+                list_levels("FP +%d", 3, SA, 6),
+                list_levels("Animal Friend %d", 5, AD, 4),
+                list_levels("Green Thumb %d", 5, AD, 3, min_level=2),
+                list_levels("Healer %d", 10, AD, 2),
+                [("Intuition", 15, AD)],
+                [("Luck", 15, AD)],
+                list_levels("Mind Shield %d", 4, AD, 5),
+                list_levels("Outdoorsman %d", 10, AD, 2),
+                list_levels(
+                    "Power Investiture (Druidic) %d", 10, AD, 2, min_level=4
+                ),
+                [
+                    ("Resistant to Disease (PM) 3", 3, AD),
+                    ("Resistant to Disease (PM) 8", 5, AD),
+                ],
+                list_levels("Signature Gear %d", 1, AD, 10),
+                [("Spirit Empathy", 10, AD)],
+            ],
+            reuse=("ads1",),
+        ),
+        Stage(
+            "disads1",
+            -20,
+            [
+                [
+                    ("Disciplines of Faith (Ritualism)", -5, DI),
+                    ("Disciplines of Faith (Ritualism)", -10, DI),
+                    ("Disciplines of Faith (Mysticism)", -5, DI),
+                    ("Disciplines of Faith (Mysticism)", -10, DI),
+                ],
+                [("Sense of Duty (Wild Nature)", -15, DI)],
+                [("Vow (Vegetarianism)", -5, DI)],
+                [("Vow (Never Sleep Indoors)", -10, DI)],
+                [("Wealth (Struggling)", -10, DI), ("Wealth (Poor)", -15, DI)],
+            ],
+        ),
+        Stage(
+            "disads2",
+            -25,
+            [
+                [("Intolerance (Urbanites)", -5, DI)],
+                list_self_control_levels("Loner", -5),
+                [("No Sense of Humor", -10, DI)],
+                [("Odious Personal Habit (Dirty Hippy)", -5, DI)],
+                list_self_control_levels("Overconfidence", -5),
+                list_self_control_levels("Phobia (Crowds)", -15),
+                list_self_control_levels("Phobia (Fire)", -5),
+                list_self_control_levels("Phobia (Machinery)", -5),
+                [("Stubbornness", -5, DI)],
+                [("Weirdness Magnet", -15, DI)],
+            ],
+            reuse=("disads1",),
+        ),
+        Stage(
+            "skills1",
+            4,
+            [
+                [("Innate Attack", 4, SK)],
+                [("Thrown Weapon (Spear)", 4, SK)],
+                [("Thrown Weapon (Stick)", 4, SK)],
+                [("Bolas", 4, SK)],
+                [("Lasso", 4, SK)],
+                [("Throwing", 4, SK)],
+                [("Blowpipe", 4, SK)],
+                [("Net", 4, SK)],
+                [("Sling", 4, SK)],
+            ],
+        ),
+        Stage(
+            "skills2",
+            12,
+            [
+                [
+                    ("Axe/Mace", 8, SK),
+                    ("Broadsword", 8, SK),
+                    ("Shortsword", 8, SK),
+                    ("Spear", 8, SK),
+                ],
+                [("Shield", 4, SK)],
+                [("Spear", 12, SK)],
+                [("Staff", 12, SK)],
+            ],
+        ),
+        Stage(
+            "skills3",
+            1,
+            [
+                [("Hidden Lore (Elementals)", 1, SK)],
+                [("Hidden Lore (Faeries)", 1, SK)],
+                [("Hidden Lore (Nature Spirits)", 1, SK)],
+            ],
+        ),
+        Stage(
+            "skills4",
+            1,
+            [
+                [("Mimicry (Animal Sounds)", 1, SK)],
+                [("Mimicry (Bird Calls)", 1, SK)],
+            ],
+        ),
+        Stage(
+            "skills5",
+            1,
+            [
+                [("Survival (Arctic)", 1, SK)],
+                [("Survival (Desert)", 1, SK)],
+                [("Survival (Island/Beach)", 1, SK)],
+                [("Survival (Jungle)", 1, SK)],
+                [("Survival (Mountain)", 1, SK)],
+                [("Survival (Plains)", 1, SK)],
+                [("Survival (Swampland)", 1, SK)],
+                [("Survival (Woodlands)", 1, SK)],
+            ],
+        ),
+        Stage(
+            "skills6",
+            3,
+            [
+                [("Knife", 1, SK)],
+                [("First Aid", 1, SK)],
+                [("Gesture", 1, SK)],
+                [("Animal Handling (any other)", 1, SK)],
+                [("Hidden Lore (Elementals)", 1, SK)],
+                [("Hidden Lore (Faeries)", 1, SK)],
+                [("Hidden Lore (Nature Spirits)", 1, SK)],
+                [("Teaching", 1, SK)],
+                [("Diagnosis", 1, SK)],
+                [("Poisons", 1, SK)],
+            ],
+            # Avoid duplicate Hidden Lore
+            skip_known=True,
+        ),
+        Stage(
+            "pi4_spells",
+            None,
             [
                 [("Beast Possession", 1, SP)],
                 [("Blight", 1, SP)],
@@ -1292,28 +2231,46 @@ def generate_druid() -> List[Tuple[str, int, TraitType]]:
                 [("Strike Barren", 1, SP)],
                 [("Tide", 1, SP)],
                 [("Wither Plant", 1, SP)],
-            ]
-        )
-        if "Power Investiture (Druidic) 5" in trait_names:
-            spells.extend(
-                [
-                    [("Alter Terrain", 1, SP)],
-                    [("Arboreal Immurement", 1, SP)],
-                    [("Create Elemental", 1, SP)],
-                    [("Entombment", 1, SP)],
-                    [("Partial Shapeshifting", 1, SP)],
-                    [("Permanent Beast Possession", 1, SP)],
-                    [("Permanent Shapeshifting", 1, SP)],
-                    [("Plant Form Other", 1, SP)],
-                    [("Shapeshift Others", 1, SP)],
-                ]
-            )
-    traits.extend(pick_from_list(spells, 20))
-    return traits
+            ],
+            only_with=(
+                "Power Investiture (Druidic) 4",
+                "Power Investiture (Druidic) 5",
+            ),
+        ),
+        Stage(
+            "pi5_spells",
+            None,
+            [
+                [("Alter Terrain", 1, SP)],
+                [("Arboreal Immurement", 1, SP)],
+                [("Create Elemental", 1, SP)],
+                [("Entombment", 1, SP)],
+                [("Partial Shapeshifting", 1, SP)],
+                [("Permanent Beast Possession", 1, SP)],
+                [("Permanent Shapeshifting", 1, SP)],
+                [("Plant Form Other", 1, SP)],
+                [("Shapeshift Others", 1, SP)],
+            ],
+            only_with=("Power Investiture (Druidic) 5",),
+        ),
+        Stage(
+            "spells2",
+            20,
+            [],
+            reuse=("spells", "pi4_spells", "pi5_spells"),
+        ),
+    ],
+)
+
+
+def generate_druid(
+    context: GenerationContext = None,
+) -> List[Tuple[str, int, TraitType]]:
+    return template_to_compiled["druid"].generate(context)
 
 
-def generate_holy_warrior() -> List[Tuple[str, int, TraitType]]:
-    traits = [
+holy_warrior_data = TemplateData(
+    traits=[
         ("ST 13", 30, PA),
         ("DX 13", 60, PA),
         ("IQ 12", 40, PA),
@@ -1340,174 +2297,201 @@ def generate_holy_warrior() -> List[Tuple[str, int, TraitType]]:
         ("Theology", 1, SK),
         ("Meditation", 1, SK),
         ("Esoteric Medicine (Holy)", 1, SK),
-    ]
-
-    ads1 = [
-        [
-            ("Higher Purpose (Slay Demons)", 5, SK),
-            ("Higher Purpose (Slay Undead)", 5, SK),
-        ]
-    ]
-    traits.extend(pick_from_list(ads1, 5))
-
-    # Merge the two lists since extra points can go either way.
-    ads2 = [
-        [
-            ("Ally (Divine servent, PM, Summonable, 12-)", 19, AD),
-            ("Ally (Divine servent, PM, Summonable, 15-)", 29, AD),
-        ],
-        [
-            ("Detect evil (PM)", 18, AD),
-            ("Detect good (PM)", 18, AD),
-            ("Detect supernatural beings (PM)", 18, AD),
-            ("Ally (Divine servent, PM, Summonable, 15-)", 29, AD),
-        ],
-        [("Healing (Faith Healing, PM)", 33, AD)],
-        [("Intuition (PM)", 14, AD)],
-        [("Oracle (PM)", 14, AD)],
-        [
-            (
-                "Patron (Deity, PM, Special Abilities, Highly Accessible, 6-)",
-                36,
-                AD,
-            ),
-            (
-                "Patron (Deity, PM, Special Abilities, Highly Accessible, 9-)",
-                72,
-                AD,
-            ),
-        ],
-        [
-            ("Resistant to Evil Supernatural Powers (PM) 3", 5, AD),
-            ("Resistant to Evil Supernatural Powers (PM) 8", 7, AD),
-        ],
-        [("Spirit Empathy (PM)", 9, AD)],
-        [("True Faith (PM, Turning)", 24, AD)],
-        list_levels("ST +%d", 10, PA, 2),
-        [("DX +1", 20, PA)],
-        list_levels("HT +%d", 10, PA, 2),
-        list_levels("HP +%d", 2, PA, 3),
-        list_levels("Will +%d", 5, SA, 5),
-        list_levels("Born War Leader %d", 5, AD, 3, min_level=2),
-        [("Combat Reflexes", 15, AD)],
-        [("Enhanced Block 1", 5, AD)],
-        [("Enhanced Parry 1 (One Melee Weapon Skill)", 5, AD)],
-        list_levels("Fearlessness %d", 2, AD, 5),
-        [("Unfazeable", 15, AD)],
-        list_levels("Hard to Kill %d", 2, AD, 5),
-        list_levels("Hard to Subdue %d", 2, AD, 5),
-        [("High Pain Threshold", 10, AD)],
-        [
-            ("Higher Purpose (Slay Demons)", 5, AD),
-            ("Higher Purpose (Slay Undead)", 5, AD),
-        ],
-        list_levels("Holiness %d", 5, AD, 2, min_level=3),
-        [("Luck", 15, AD)],
-        list_levels("Magic Resistance %d", 2, AD, 5),
-        [("Rapid Healing", 5, AD)],
-        [("Recovery", 10, AD)],
-        [("Resistant to Disease 3", 3, AD), ("Resistant to Disease 8", 5, AD)],
-        [("Resistant to Poison 3", 5, AD)],
-        list_levels("Signature Gear %d", 1, AD, 10),
-        list_levels("Striking ST %d", 5, AD, 2),
-        [("Weapon Bond", 1, AD)],
-    ]
-    ads2.extend(ads1)
-    # Avoid duplicate Higher Purpose
-    for trait in traits:
-        if [trait] in ads2:
-            ads2.remove([trait])
-    traits.extend(pick_from_list(ads2, 50))
-
-    disads1 = [
-        [("Honesty (12)", -10, DI)],
-        [("Sense of Duty (Good entities)", -10, DI)],
-        [("Vow (Own no more than horse can carry)", -10, DI)],
-    ]
-    traits.extend(pick_from_list(disads1, -10))
-
-    disads2 = [
-        list_self_control_levels("Charitable", -15),
-        list_self_control_levels("Compulsive Generosity", -5),
-        list_self_control_levels("Compulsive Vowing", -5),
-        [
-            ("Disciplines of Faith (Ritualism)", -5, DI),
-            ("Disciplines of Faith (Ritualism)", -10, DI),
-            ("Disciplines of Faith (Mysticism)", -5, DI),
-            ("Disciplines of Faith (Mysticism)", -10, DI),
-        ],
-        [("Fanaticism", -15, DI)],
-        [
-            ("Intolerance (Evil religions)", -5, DI),
-            ("Intolerance (All other religions)", -10, DI),
-        ],
-        list_self_control_levels("Selfless", -5),
-        list_self_control_levels("Truthfulness", -5),
-        [("Vow (Chastity)", -5, DI)],
-    ]
-    disads2.extend(disads1)
-    traits.extend(pick_from_list(disads2, -15))
-
-    disads3 = [
-        list_self_control_levels("Bloodlust", -10),
-        [("Code of Honor (Chivalry)", -15, DI)],
-        [("Easy to Read", -10, DI)],
-        [("No Sense of Humor", -10, DI)],
-        list_self_control_levels("Overconfidence", -5),
-        [("Sense of Duty (Adventuring companions)", -5, DI)],
-        [("Stubbornness", -5, DI)],
-    ]
-    disads3.extend(disads2)
-    traits.extend(pick_from_list(disads3, -15))
+    ],
+    stages=[
+        Stage(
+            "ads1",
+            5,
+            [
+                [
+                    ("Higher Purpose (Slay Demons)", 5, SK),
+                    ("Higher Purpose (Slay Undead)", 5, SK),
+                ]
+            ],
+        ),
+        # Merge the two lists since extra points can go either way.
+        Stage(
+            "ads2",
+            50,
+            [
+                [
+                    ("Ally (Divine servent, PM, Summonable, 12-)", 19, AD),
+                    ("Ally (Divine servent, PM, Summonable, 15-)", 29, AD),
+                ],
+                [
+                    ("Detect evil (PM)", 18, AD),
+                    ("Detect good (PM)", 18, AD),
+                    ("Detect supernatural beings (PM)", 18, AD),
+                    ("Ally (Divine servent, PM, Summonable, 15-)", 29, AD),
+                ],
+                [("Healing (Faith Healing, PM)", 33, AD)],
+                [("Intuition (PM)", 14, AD)],
+                [("Oracle (PM)", 14, AD)],
+                [
+                    (
+                        "Patron (Deity, PM, Special Abilities, Highly Accessible, 6-)",
+                        36,
+                        AD,
+                    ),
+                    (
+                        "Patron (Deity, PM, Special Abilities, Highly Accessible, 9-)",
+                        72,
+                        AD,
+                    ),
+                ],
+                [
+                    ("Resistant to Evil Supernatural Powers (PM) 3", 5, AD),
+                    ("Resistant to Evil Supernatural Powers (PM) 8", 7, AD),
+                ],
+                [("Spirit Empathy (PM)", 9, AD)],
+                [("True Faith (PM, Turning)", 24, AD)],
+                list_levels("ST +%d", 10, PA, 2),
+                [("DX +1", 20, PA)],
+                list_levels("HT +%d", 10, PA, 2),
+                list_levels("HP +%d", 2, PA, 3),
+                list_levels("Will +%d", 5, SA, 5),
+                list_levels("Born War Leader %d", 5, AD, 3, min_level=2),
+                [("Combat Reflexes", 15, AD)],
+                [("Enhanced Block 1", 5, AD)],
+                [("Enhanced Parry 1 (One Melee Weapon Skill)", 5, AD)],
+                list_levels("Fearlessness %d", 2, AD, 5),
+                [("Unfazeable", 15, AD)],
+                list_levels("Hard to Kill %d", 2, AD, 5),
+                list_levels("Hard to Subdue %d", 2, AD, 5),
+                [("High Pain Threshold", 10, AD)],
+                [
+                    ("Higher Purpose (Slay Demons)", 5, AD),
+                    ("Higher Purpose (Slay Undead)", 5, AD),
+                ],
+                list_levels("Holiness %d", 5, AD, 2, min_level=3),
+                [("Luck", 15, AD)],
+                list_levels("Magic Resistance %d", 2, AD, 5),
+                [("Rapid Healing", 5, AD)],
+                [("Recovery", 10, AD)],
+                [
+                    ("Resistant to Disease 3", 3, AD),
+                    ("Resistant to Disease 8", 5, AD),
+                ],
+                [("Resistant to Poison 3", 5, AD)],
+                list_levels("Signature Gear %d", 1, AD, 10),
+                list_levels("Striking ST %d", 5, AD, 2),
+                [("Weapon Bond", 1, AD)],
+            ],
+            reuse=("ads1",),
+            # Avoid duplicate Higher Purpose
+            skip_known=True,
+        ),
+        Stage(
+            "disads1",
+            -10,
+            [
+                [("Honesty (12)", -10, DI)],
+                [("Sense of Duty (Good entities)", -10, DI)],
+                [("Vow (Own no more than horse can carry)", -10, DI)],
+            ],
+        ),
+        Stage(
+            "disads2",
+            -15,
+            [
+                list_self_control_levels("Charitable", -15),
+                list_self_control_levels("Compulsive Generosity", -5),
+                list_self_control_levels("Compulsive Vowing", -5),
+                [
+                    ("Disciplines of Faith (Ritualism)", -5, DI),
+                    ("Disciplines of Faith (Ritualism)", -10, DI),
+                    ("Disciplines of Faith (Mysticism)", -5, DI),
+                    ("Disciplines of Faith (Mysticism)", -10, DI),
+                ],
+                [("Fanaticism", -15, DI)],
+                [
+                    ("Intolerance (Evil religions)", -5, DI),
+                    ("Intolerance (All other religions)", -10, DI),
+                ],
+                list_self_control_levels("Selfless", -5),
+                list_self_control_levels("Truthfulness", -5),
+                [("Vow (Chastity)", -5, DI)],
+            ],
+            reuse=("disads1",),
+        ),
+        Stage(
+            "disads3",
+            -15,
+            [
+                list_self_control_levels("Bloodlust", -10),
+                [("Code of Honor (Chivalry)", -15, DI)],
+                [("Easy to Read", -10, DI)],
+                [("No Sense of Humor", -10, DI)],
+                list_self_control_levels("Overconfidence", -5),
+                [("Sense of Duty (Adventuring companions)", -5, DI)],
+                [("Stubbornness", -5, DI)],
+            ],
+            reuse=("disads2",),
+        ),
+        Stage(
+            "skills1",
+            2,
+            [
+                [("Hidden Lore (Demons)", 2, SK)],
+                [("Hidden Lore (Undead)", 2, SK)],
+            ],
+        ),
+        Stage(
+            "skills2",
+            4,
+            [
+                [("Crossbow", 4, SK)],
+                [("Thrown Weapon (Axe/Mace)", 4, SK)],
+                [("Thrown Weapon (Spear)", 4, SK)],
+                [("Throwing", 4, SK)],
+            ],
+        ),
+        Stage(
+            "skills3",
+            20,
+            [
+                [
+                    ("Axe/Mace", 12, SK),
+                    ("Broadsword", 12, SK),
+                    ("Spear", 12, SK),
+                    ("Flail", 12, SK),
+                ],
+                [("Shield", 8, SK)],
+                [("Polearm", 20, SK)],
+                [("Spear", 20, SK)],
+                [("Two-Handed Sword", 20, SK)],
+            ],
+        ),
+        Stage(
+            "skills4",
+            5,
+            [
+                [("Fast-Draw (any)", 1, SK)],
+                [("Climbing", 1, SK)],
+                [("Lance", 1, SK)],
+                [("Riding (Horse)", 1, SK)],
+                [("Stealth", 1, SK)],
+                [("First Aid", 1, SK)],
+                [("Gesture", 1, SK)],
+                [("Interrogation", 1, SK)],
+                [("Physiology (other monster type)", 1, SK)],
+                [("Psychology (other monster type)", 1, SK)],
+                [("Hiking", 1, SK)],
+                [("Observation", 1, SK)],
+            ],
+        ),
+    ],
+)
 
-    skills1 = [
-        [("Hidden Lore (Demons)", 2, SK)],
-        [("Hidden Lore (Undead)", 2, SK)],
-    ]
-    traits.extend(pick_from_list(skills1, 2))
 
-    skills2 = [
-        [("Crossbow", 4, SK)],
-        [("Thrown Weapon (Axe/Mace)", 4, SK)],
-        [("Thrown Weapon (Spear)", 4, SK)],
-        [("Throwing", 4, SK)],
-    ]
-    traits.extend(pick_from_list(skills2, 4))
-
-    skills3 = [
-        [
-            ("Axe/Mace", 12, SK),
-            ("Broadsword", 12, SK),
-            ("Spear", 12, SK),
-            ("Flail", 12, SK),
-        ],
-        [("Shield", 8, SK)],
-        [("Polearm", 20, SK)],
-        [("Spear", 20, SK)],
-        [("Two-Handed Sword", 20, SK)],
-    ]
-    traits.extend(pick_from_list(skills3, 20))
-
-    skills4 = [
-        [("Fast-Draw (any)", 1, SK)],
-        [("Climbing", 1, SK)],
-        [("Lance", 1, SK)],
-        [("Riding (Horse)", 1, SK)],
-        [("Stealth", 1, SK)],
-        [("First Aid", 1, SK)],
-        [("Gesture", 1, SK)],
-        [("Interrogation", 1, SK)],
-        [("Physiology (other monster type)", 1, SK)],
-        [("Psychology (other monster type)", 1, SK)],
-        [("Hiking", 1, SK)],
-        [("Observation", 1, SK)],
-    ]
-    traits.extend(pick_from_list(skills4, 5))
-    return traits
+def generate_holy_warrior(
+    context: GenerationContext = None,
+) -> List[Tuple[str, int, TraitType]]:
+    return template_to_compiled["holy_warrior"].generate(context)
 
 
-def generate_knight() -> List[Tuple[str, int, TraitType]]:
-    traits = [
+knight_data = TemplateData(
+    traits=[
         ("ST 14", 40, PA),
         ("DX 14", 80, PA),
         ("IQ 10", 0, PA),
@@ -1528,141 +2512,165 @@ def generate_knight() -> List[Tuple[str, int, TraitType]]:
         ("Leadership", 1, SK),
         ("Strategy", 2, SK),
         ("Tactics", 2, SK),
-    ]
+    ],
+    stages=[
+        Stage(
+            "ads1",
+            60,
+            [
+                list_levels("ST +%d", 10, PA, 6),
+                list_levels("DX +%d", 20, PA, 3),
+                list_levels("HT +%d", 10, PA, 6),
+                list_levels("HP +%d", 2, SA, 4),
+                list_levels("Basic Speed +%d", 20, SA, 2),
+                [("Alcohol Tolerance", 1, AD)],
+                list_levels("Born War Leader %d", 5, AD, 2, min_level=3),
+                [("Enhanced Block 1", 5, AD)],
+                [("Enhanced Parry 1 (One Melee Weapon Skill)", 5, AD)],
+                list_levels("Fearlessness %d", 2, AD, 5),
+                [("Fit", 5, AD), ("Very Fit", 15, AD)],
+                list_levels("Hard to Kill %d", 2, AD, 5),
+                list_levels("Hard to Subdue %d", 2, AD, 5),
+                [("Luck", 15, AD), ("Extraordinary Luck", 30, AD)],
+                [("Penetrating Voice", 1, AD)],
+                [("Rapid Healing", 5, AD)],
+                [("Recovery", 10, AD)],
+                list_levels("Signature Gear %d", 1, AD, 10),
+                list_levels("Striking ST %d", 5, AD, 2),
+                [("Weapon Bond", 1, AD)],
+                [
+                    ("Weapon Master (One weapon)", 20, AD),
+                    (
+                        "Weapon Master (Two weapons normally used together)",
+                        25,
+                        AD,
+                    ),
+                    ("Weapon Master (Small class of weapons)", 30, AD),
+                    ("Weapon Master (Medium class of weapons)", 35, AD),
+                    ("Weapon Master (Large class of weapons)", 40, AD),
+                    ("Weapon Master (All muscle-powered weapons)", 45, AD),
+                ],
+            ],
+        ),
+        Stage(
+            "disads1",
+            -20,
+            [
+                list_self_control_levels("Bad Temper", -10),
+                list_self_control_levels("Bloodlust", -10),
+                [
+                    ("Code of Honor (Pirate's)", -5, DI),
+                    ("Code of Honor (Soldier's)", -10, DI),
+                    ("Code of Honor (Chivalry)", -15, DI),
+                ],
+                list_self_control_levels(
+                    "Obsession (Slay some specific type of monster)", -5
+                ),
+                [("One Eye", -15, DI)],
+                [("Sense of Duty (Nation)", -10, DI)],
+                [("Vow (Never resist a challenge to combat)", -10, DI)],
+                [("Wounded", -5, DI)],
+            ],
+        ),
+        Stage(
+            "disads2",
+            -15,
+            [
+                list_self_control_levels("Bully", -10),
+                list_self_control_levels("Compulsive Carousing", -5),
+                list_self_control_levels("Greed", -15),
+                list_self_control_levels("Honesty", -10),
+                list_self_control_levels("Lecherousness", -15),
+                list_self_control_levels("Overconfidence", -5),
+                [("Sense of Duty (Adventuring companions)", -5, DI)],
+            ],
+            reuse=("disads1",),
+        ),
+        Stage("skills1", 2, [[("Brawling", 2, SK)], [("Boxing", 2, SK)]]),
+        Stage(
+            "skills2", 2, [[("Sumo Wrestling", 2, SK)], [("Wrestling", 2, SK)]]
+        ),
+        Stage(
+            "skills3",
+            4,
+            [
+                [("Crossbow", 4, SK)],
+                [("Thrown Weapon (Axe/Mace)", 4, SK)],
+                [("Thrown Weapon (Spear)", 4, SK)],
+                [("Bow", 4, SK)],
+                [("Throwing", 4, SK)],
+                [("Sling", 4, SK)],
+            ],
+        ),
+        Stage(
+            "skills4",
+            24,
+            [
+                [("Axe/Mace", 24, SK)],
+                [("Broadsword", 24, SK)],
+                [("Polearm", 24, SK)],
+                [("Shortsword", 24, SK)],
+                [("Spear", 24, SK)],
+                [("Two-Handed Sword", 24, SK)],
+                [("Flail", 24, SK)],
+                [("Axe/Mace", 12, SK)],
+                [("Broadsword", 12, SK)],
+                [("Polearm", 12, SK)],
+                [("Shortsword", 12, SK)],
+                [("Spear", 12, SK)],
+                [("Two-Handed Sword", 12, SK)],
+                [("Flail", 12, SK)],
+                [("Axe/Mace", 8, SK)],
+                [("Broadsword", 8, SK)],
+                [("Lance", 8, SK)],
+                [("Polearm", 8, SK)],
+                [("Riding (Horse)", 8, SK)],
+                [("Shortsword", 8, SK)],
+                [("Spear", 8, SK)],
+                [("Two-Handed Sword", 8, SK)],
+                [("Flail", 8, SK)],
+            ],
+        ),
+        Stage(
+            "skills5",
+            4,
+            [
+                [("Armoury (Body Armor)", 4, SK)],
+                [("Armoury (Melee Weapons)", 4, SK)],
+            ],
+        ),
+        Stage(
+            "skills6",
+            4,
+            [
+                [("Forced Entry", 1, SK)],
+                [("Climbing", 1, SK)],
+                [("Stealth", 1, SK)],
+                [("First Aid", 1, SK)],
+                [("Gesture", 1, SK)],
+                [("Savoir-Faire (High Society)", 1, SK)],
+                [("Gambling", 1, SK)],
+                [("Heraldry", 1, SK)],
+                [("Streetwise", 1, SK)],
+                [("Carousing", 1, SK)],
+                [("Hiking", 1, SK)],
+                [("Intimidation", 1, SK)],
+                [("Scrounging", 1, SK)],
+                [("Observation", 1, SK)],
+            ],
+        ),
+    ],
+)
 
-    ads1 = [
-        list_levels("ST +%d", 10, PA, 6),
-        list_levels("DX +%d", 20, PA, 3),
-        list_levels("HT +%d", 10, PA, 6),
-        list_levels("HP +%d", 2, SA, 4),
-        list_levels("Basic Speed +%d", 20, SA, 2),
-        [("Alcohol Tolerance", 1, AD)],
-        list_levels("Born War Leader %d", 5, AD, 2, min_level=3),
-        [("Enhanced Block 1", 5, AD)],
-        [("Enhanced Parry 1 (One Melee Weapon Skill)", 5, AD)],
-        list_levels("Fearlessness %d", 2, AD, 5),
-        [("Fit", 5, AD), ("Very Fit", 15, AD)],
-        list_levels("Hard to Kill %d", 2, AD, 5),
-        list_levels("Hard to Subdue %d", 2, AD, 5),
-        [("Luck", 15, AD), ("Extraordinary Luck", 30, AD)],
-        [("Penetrating Voice", 1, AD)],
-        [("Rapid Healing", 5, AD)],
-        [("Recovery", 10, AD)],
-        list_levels("Signature Gear %d", 1, AD, 10),
-        list_levels("Striking ST %d", 5, AD, 2),
-        [("Weapon Bond", 1, AD)],
-        [
-            ("Weapon Master (One weapon)", 20, AD),
-            ("Weapon Master (Two weapons normally used together)", 25, AD),
-            ("Weapon Master (Small class of weapons)", 30, AD),
-            ("Weapon Master (Medium class of weapons)", 35, AD),
-            ("Weapon Master (Large class of weapons)", 40, AD),
-            ("Weapon Master (All muscle-powered weapons)", 45, AD),
-        ],
-    ]
-    traits.extend(pick_from_list(ads1, 60))
-
-    disads1 = [
-        list_self_control_levels("Bad Temper", -10),
-        list_self_control_levels("Bloodlust", -10),
-        [
-            ("Code of Honor (Pirate's)", -5, DI),
-            ("Code of Honor (Soldier's)", -10, DI),
-            ("Code of Honor (Chivalry)", -15, DI),
-        ],
-        list_self_control_levels(
-            "Obsession (Slay some specific type of monster)", -5
-        ),
-        [("One Eye", -15, DI)],
-        [("Sense of Duty (Nation)", -10, DI)],
-        [("Vow (Never resist a challenge to combat)", -10, DI)],
-        [("Wounded", -5, DI)],
-    ]
-    traits.extend(pick_from_list(disads1, -20))
-
-    disads2 = [
-        list_self_control_levels("Bully", -10),
-        list_self_control_levels("Compulsive Carousing", -5),
-        list_self_control_levels("Greed", -15),
-        list_self_control_levels("Honesty", -10),
-        list_self_control_levels("Lecherousness", -15),
-        list_self_control_levels("Overconfidence", -5),
-        [("Sense of Duty (Adventuring companions)", -5, DI)],
-    ]
-    disads2.extend(disads1)
-    traits.extend(pick_from_list(disads2, -15))
-
-    skills1 = [[("Brawling", 2, SK)], [("Boxing", 2, SK)]]
-    traits.extend(pick_from_list(skills1, 2))
-
-    skills2 = [[("Sumo Wrestling", 2, SK)], [("Wrestling", 2, SK)]]
-    traits.extend(pick_from_list(skills2, 2))
-
-    skills3 = [
-        [("Crossbow", 4, SK)],
-        [("Thrown Weapon (Axe/Mace)", 4, SK)],
-        [("Thrown Weapon (Spear)", 4, SK)],
-        [("Bow", 4, SK)],
-        [("Throwing", 4, SK)],
-        [("Sling", 4, SK)],
-    ]
-    traits.extend(pick_from_list(skills3, 4))
-
-    skills4 = [
-        [("Axe/Mace", 24, SK)],
-        [("Broadsword", 24, SK)],
-        [("Polearm", 24, SK)],
-        [("Shortsword", 24, SK)],
-        [("Spear", 24, SK)],
-        [("Two-Handed Sword", 24, SK)],
-        [("Flail", 24, SK)],
-        [("Axe/Mace", 12, SK)],
-        [("Broadsword", 12, SK)],
-        [("Polearm", 12, SK)],
-        [("Shortsword", 12, SK)],
-        [("Spear", 12, SK)],
-        [("Two-Handed Sword", 12, SK)],
-        [("Flail", 12, SK)],
-        [("Axe/Mace", 8, SK)],
-        [("Broadsword", 8, SK)],
-        [("Lance", 8, SK)],
-        [("Polearm", 8, SK)],
-        [("Riding (Horse)", 8, SK)],
-        [("Shortsword", 8, SK)],
-        [("Spear", 8, SK)],
-        [("Two-Handed Sword", 8, SK)],
-        [("Flail", 8, SK)],
-    ]
-    traits.extend(pick_from_list(skills4, 24))
 
-    skills5 = [
-        [("Armoury (Body Armor)", 4, SK)],
-        [("Armoury (Melee Weapons)", 4, SK)],
-    ]
-    traits.extend(pick_from_list(skills5, 4))
-
-    skills6 = [
-        [("Forced Entry", 1, SK)],
-        [("Climbing", 1, SK)],
-        [("Stealth", 1, SK)],
-        [("First Aid", 1, SK)],
-        [("Gesture", 1, SK)],
-        [("Savoir-Faire (High Society)", 1, SK)],
-        [("Gambling", 1, SK)],
-        [("Heraldry", 1, SK)],
-        [("Streetwise", 1, SK)],
-        [("Carousing", 1, SK)],
-        [("Hiking", 1, SK)],
-        [("Intimidation", 1, SK)],
-        [("Scrounging", 1, SK)],
-        [("Observation", 1, SK)],
-    ]
-    traits.extend(pick_from_list(skills6, 4))
-    return traits
+def generate_knight(
+    context: GenerationContext = None,
+) -> List[Tuple[str, int, TraitType]]:
+    return template_to_compiled["knight"].generate(context)
 
 
-def generate_martial_artist() -> List[Tuple[str, int, TraitType]]:
-    traits = [
+martial_artist_data = TemplateData(
+    traits=[
         ("ST 11", 10, PA),
         ("DX 16", 120, PA),
         ("IQ 10", 0, PA),
@@ -1683,162 +2691,227 @@ def generate_martial_artist() -> List[Tuple[str, int, TraitType]]:
         ("Stealth", 1, SK),
         ("Meditation", 2, SK),
         ("Tactics", 4, SK),
-    ]
-
-    special_skills = [
-        [("Immovable Stance", 2, SK)],
-        [("Light Walk", 2, SK)],
-        [("Parry Missile Weapons", 2, SK)],
-        [("Push", 2, SK)],
-        [("Breaking Blow", 2, SK)],
-        [("Flying Leap", 2, SK)],
-        [("Pressure Points", 2, SK)],
-        [("Breath Control", 2, SK)],
-        [("Kiai", 2, SK)],
-        [("Body Control", 2, SK)],
-        [("Mental Strength", 2, SK)],
-        [("Mind Block", 2, SK)],
-        [("Autohypnosis", 2, SK)],
-        [("Power Blow", 2, SK)],
-        [("Esoteric Medicine", 2, SK)],
-        [("Blind Fighting", 2, SK)],
-    ]
+    ],
+    stages=[
+        Stage(
+            "special_skills",
+            None,
+            [
+                [("Immovable Stance", 2, SK)],
+                [("Light Walk", 2, SK)],
+                [("Parry Missile Weapons", 2, SK)],
+                [("Push", 2, SK)],
+                [("Breaking Blow", 2, SK)],
+                [("Flying Leap", 2, SK)],
+                [("Pressure Points", 2, SK)],
+                [("Breath Control", 2, SK)],
+                [("Kiai", 2, SK)],
+                [("Body Control", 2, SK)],
+                [("Mental Strength", 2, SK)],
+                [("Mind Block", 2, SK)],
+                [("Autohypnosis", 2, SK)],
+                [("Power Blow", 2, SK)],
+                [("Esoteric Medicine", 2, SK)],
+                [("Blind Fighting", 2, SK)],
+            ],
+        ),
+        Stage(
+            "ads1",
+            20,
+            [
+                [("Catfall (PM)", 9, AD)],
+                [
+                    ("DR 1 (Tough Skin, PM)", 3, AD),
+                    ("DR 2 (Touch Skin, PM)", 5, AD),
+                ],
+                [("Danger Sense (PM)", 14, AD)],
+                [
+                    ("Enhanced Move 0.5 (Ground, PM)", 9, AD),
+                    ("Enhanced Move 1 (Ground, PM)", 18, AD),
+                ],
+                [
+                    ("Extra Attack 1 (PM)", 23, AD),
+                    ("Extra Attack 2 (PM)", 45, AD),
+                ],
+                [
+                    ("Metabolism Control 1 (PM)", 5, AD),
+                    ("Metabolism Control 2 (PM)", 9, AD),
+                    ("Metabolism Control 3 (PM)", 14, AD),
+                    ("Metabolism Control 4 (PM)", 18, AD),
+                    ("Metabolism Control 5 (PM)", 23, AD),
+                ],
+                [("Perfect Balance (PM)", 14, AD)],
+                [
+                    ("Regeneration (Slow, PM)", 9, AD),
+                    ("Regeneration (Regular, PM)", 23, AD),
+                    ("Regeneration (Fast, PM)", 45, AD),
+                ],
+                [
+                    ("Resistant to Metabolic Hazards +3 (PM)", 9, AD),
+                    ("Resistant to Metabolic Hazards +8 (PM)", 14, AD),
+                ],
+                [("Striking ST 1 (PM)", 5, AD), ("Striking ST 2 (PM)", 9, AD)],
+                list_levels("Super Jump %d (PM)", 9, AD, 2),
+            ],
+            reuse=("special_skills",),
+        ),
+        Stage(
+            "ads2",
+            20,
+            [
+                list_levels("ST +%d", 10, PA, 2),
+                [("DX +1", 20, PA)],
+                [("IQ +1", 20, PA)],
+                list_levels("HT +%d", 10, PA, 2),
+                list_levels("Will +%d", 5, SA, 4),
+                list_levels("Per +%d", 5, SA, 4),
+                list_levels("FP +%d", 3, SA, 6),
+                [("Basic Speed +1", 20, SA)],
+                list_levels("Basic Move +%d", 5, SA, 2),
+                [("Ambidexterity", 5, AD)],
+                [("Chi Talent 3", 15, AD)],
+                [("Combat Reflexes", 15, AD)],
+                [("Enhanced Dodge 1", 15, AD)],
+                list_levels("Enhanced Parry %d (Unarmed)", 5, AD, 2),
+                [("Fit", 5, AD), ("Very Fit", 15, AD)],
+                [("Flexibility", 5, AD), ("Double-Jointed", 15, AD)],
+                [("High Pain Threshold", 10, AD)],
+                [("Luck", 15, AD)],
+                list_levels("Magic Resistance %d", 2, AD, 5),
+                list_levels("Mind Shield %d", 4, AD, 5),
+                list_levels("Signature Gear %d", 1, AD, 10),
+                [("Unfazeable", 15, AD)],
+                [("Weapon Bond", 1, AD)],
+                [("Weapon Master (One exotic weapon)", 20, AD)],
+                [("Wild Talent 1", 20, AD)],
+            ],
+            reuse=("ads1",),
+        ),
+        Stage(
+            "disads1",
+            -25,
+            [
+                [("Code of Honor (Bushido)", -15, DI)],
+                list_self_control_levels("Compulsive Vowing", -5),
+                list_self_control_levels("Honesty", -10),
+                list_self_control_levels("Overconfidence", -5),
+                list_self_control_levels(
+                    "Obsession (Perfect my art at any cost!)", -10
+                ),
+                [("Social Stigma (Minority Group)", -10, DI)],
+                [("Vow (Vegetarianism)", -5, DI)],
+                [("Vow (Silence)", -10, DI)],
+                [("Vow (Always Fight Unarmed)", -15, DI)],
+                [
+                    ("Wealth (Struggling)", -10, DI),
+                    ("Wealth (Poor)", -15, DI),
+                    ("Wealth (Dead Broke)", -25, DI),
+                ],
+            ],
+        ),
+        Stage(
+            "disads2",
+            -15,
+            [
+                [("Callous (12)", -5, DI)],
+                list_self_control_levels("Loner", -5),
+                [("No Sense of Humor", -10, DI)],
+                list_self_control_levels("Overconfidence", -5),
+                [("Sense of Duty (Adventuring companions)", -5, DI)],
+                [("Stubbornness", -5, DI)],
+            ],
+            reuse=("disads1",),
+        ),
+        Stage(
+            "skills1",
+            1,
+            [
+                [("Thrown Weapon (Dart)", 1, SK)],
+                [("Thrown Weapon (Knife)", 1, SK)],
+                [("Thrown Weapon (Shuriken)", 1, SK)],
+                [("Throwing", 1, SK)],
+                [("Blowpipe", 1, SK)],
+                [("Sling", 1, SK)],
+            ],
+        ),
+        Stage(
+            "skills2",
+            8,
+            [
+                [("Knife", 4, SK)],
+                [("Axe/Mace", 4, SK)],
+                [("Jitte/Sai", 4, SK)],
+                [("Shortsword", 4, SK)],
+                [("Smallsword", 4, SK)],
+                [("Staff", 4, SK)],
+                [("Tonfa", 4, SK)],
+                [("Flail", 4, SK)],
+                [("Kusari", 4, SK)],
+            ],
+        ),
+        Stage(
+            "skills3",
+            4,
+            [
+                [("Knife", 4, SK)],
+                [("Axe/Mace", 4, SK)],
+                [("Jitte/Sai", 4, SK)],
+                [("Shortsword", 4, SK)],
+                [("Smallsword", 4, SK)],
+                [("Staff", 4, SK)],
+                [("Tonfa", 4, SK)],
+                [("Flail", 4, SK)],
+                [("Kusari", 4, SK)],
+            ],
+        ),
+        Stage(
+            "skills4",
+            3,
+            [
+                [("Fast-Draw (any)", 1, SK)],
+                [("Climbing", 1, SK)],
+                [("First Aid", 1, SK)],
+                [("Gesture", 1, SK)],
+                [("Teaching", 1, SK)],
+                [("Hiking", 1, SK)],
+                [("Running", 1, SK)],
+                [("Intimidation", 1, SK)],
+                [("Observation", 1, SK)],
+            ],
+        ),
+    ],
+    improve=Improve(14, ("special_skills",), min_cost=2),
+)
 
-    special_skill_names = set()
-    for lst in special_skills:
-        for tup in lst:
-            special_skill_names.add(tup[0])
-
-    ads1 = [
-        [("Catfall (PM)", 9, AD)],
-        [("DR 1 (Tough Skin, PM)", 3, AD), ("DR 2 (Touch Skin, PM)", 5, AD)],
-        [("Danger Sense (PM)", 14, AD)],
-        [
-            ("Enhanced Move 0.5 (Ground, PM)", 9, AD),
-            ("Enhanced Move 1 (Ground, PM)", 18, AD),
-        ],
-        [("Extra Attack 1 (PM)", 23, AD), ("Extra Attack 2 (PM)", 45, AD)],
-        [
-            ("Metabolism Control 1 (PM)", 5, AD),
-            ("Metabolism Control 2 (PM)", 9, AD),
-            ("Metabolism Control 3 (PM)", 14, AD),
-            ("Metabolism Control 4 (PM)", 18, AD),
-            ("Metabolism Control 5 (PM)", 23, AD),
-        ],
-        [("Perfect Balance (PM)", 14, AD)],
-        [
-            ("Regeneration (Slow, PM)", 9, AD),
-            ("Regeneration (Regular, PM)", 23, AD),
-            ("Regeneration (Fast, PM)", 45, AD),
-        ],
-        [
-            ("Resistant to Metabolic Hazards +3 (PM)", 9, AD),
-            ("Resistant to Metabolic Hazards +8 (PM)", 14, AD),
-        ],
-        [("Striking ST 1 (PM)", 5, AD), ("Striking ST 2 (PM)", 9, AD)],
-        list_levels("Super Jump %d (PM)", 9, AD, 2),
-    ]
-    ads1.extend(special_skills)
-    traits.extend(pick_from_list(ads1, 20))
-
-    ads2 = [
-        list_levels("ST +%d", 10, PA, 2),
-        [("DX +1", 20, PA)],
-        [("IQ +1", 20, PA)],
-        list_levels("HT +%d", 10, PA, 2),
-        list_levels("Will +%d", 5, SA, 4),
-        list_levels("Per +%d", 5, SA, 4),
-        list_levels("FP +%d", 3, SA, 6),
-        [("Basic Speed +1", 20, SA)],
-        list_levels("Basic Move +%d", 5, SA, 2),
-        [("Ambidexterity", 5, AD)],
-        [("Chi Talent 3", 15, AD)],
-        [("Combat Reflexes", 15, AD)],
-        [("Enhanced Dodge 1", 15, AD)],
-        list_levels("Enhanced Parry %d (Unarmed)", 5, AD, 2),
-        [("Fit", 5, AD), ("Very Fit", 15, AD)],
-        [("Flexibility", 5, AD), ("Double-Jointed", 15, AD)],
-        [("High Pain Threshold", 10, AD)],
-        [("Luck", 15, AD)],
-        list_levels("Magic Resistance %d", 2, AD, 5),
-        list_levels("Mind Shield %d", 4, AD, 5),
-        list_levels("Signature Gear %d", 1, AD, 10),
-        [("Unfazeable", 15, AD)],
-        [("Weapon Bond", 1, AD)],
-        [("Weapon Master (One exotic weapon)", 20, AD)],
-        [("Wild Talent 1", 20, AD)],
-    ]
-    ads2.extend(ads1)
-    traits.extend(pick_from_list(ads2, 20))
-
-    disads1 = [
-        [("Code of Honor (Bushido)", -15, DI)],
-        list_self_control_levels("Compulsive Vowing", -5),
-        list_self_control_levels("Honesty", -10),
-        list_self_control_levels("Overconfidence", -5),
-        list_self_control_levels(
-            "Obsession (Perfect my art at any cost!)", -10
-        ),
-        [("Social Stigma (Minority Group)", -10, DI)],
-        [("Vow (Vegetarianism)", -5, DI)],
-        [("Vow (Silence)", -10, DI)],
-        [("Vow (Always Fight Unarmed)", -15, DI)],
-        [
-            ("Wealth (Struggling)", -10, DI),
-            ("Wealth (Poor)", -15, DI),
-            ("Wealth (Dead Broke)", -25, DI),
-        ],
-    ]
-    traits.extend(pick_from_list(disads1, -25))
-
-    disads2 = [
-        [("Callous (12)", -5, DI)],
-        list_self_control_levels("Loner", -5),
-        [("No Sense of Humor", -10, DI)],
-        list_self_control_levels("Overconfidence", -5),
-        [("Sense of Duty (Adventuring companions)", -5, DI)],
-        [("Stubbornness", -5, DI)],
-    ]
-    disads2.extend(disads1)
-    traits.extend(pick_from_list(disads2, -15))
-
-    skills1 = [
-        [("Thrown Weapon (Dart)", 1, SK)],
-        [("Thrown Weapon (Knife)", 1, SK)],
-        [("Thrown Weapon (Shuriken)", 1, SK)],
-        [("Throwing", 1, SK)],
-        [("Blowpipe", 1, SK)],
-        [("Sling", 1, SK)],
-    ]
-    traits.extend(pick_from_list(skills1, 1))
 
-    melee_option = random.randrange(3)
+def generate_martial_artist(
+    melee_option: int = None, context: GenerationContext = None
+) -> List[Tuple[str, int, TraitType]]:
+    """melee_option picks the melee skill package: 0 for a weapon skill,
+    1 for a cheaper weapon skill and Judo and Karate, 2 for Judo and
+    Karate only.  By default it is random."""
+    if context is None:
+        context = GenerationContext()
+    rng = context.rng
+    template = template_to_compiled["martial_artist"]
+    traits = list(template.traits)
+    lists: Dict[str, List[typing.Sequence[Tuple[str, int, TraitType]]]] = {}
+    for name in [
+        "special_skills",
+        "ads1",
+        "ads2",
+        "disads1",
+        "disads2",
+        "skills1",
+    ]:
+        template.pick(name, traits, lists, context)
+
+    if melee_option is None:
+        melee_option = rng.randrange(3)
     if melee_option == 0:
-        skills2 = [
-            [("Knife", 4, SK)],
-            [("Axe/Mace", 4, SK)],
-            [("Jitte/Sai", 4, SK)],
-            [("Shortsword", 4, SK)],
-            [("Smallsword", 4, SK)],
-            [("Staff", 4, SK)],
-            [("Tonfa", 4, SK)],
-            [("Flail", 4, SK)],
-            [("Kusari", 4, SK)],
-        ]
-        traits.extend(pick_from_list(skills2, 8))
+        template.pick("skills2", traits, lists, context)
     elif melee_option == 1:
-        skills3 = [
-            [("Knife", 4, SK)],
-            [("Axe/Mace", 4, SK)],
-            [("Jitte/Sai", 4, SK)],
-            [("Shortsword", 4, SK)],
-            [("Smallsword", 4, SK)],
-            [("Staff", 4, SK)],
-            [("Tonfa", 4, SK)],
-            [("Flail", 4, SK)],
-            [("Kusari", 4, SK)],
-        ]
-        traits.extend(pick_from_list(skills3, 4))
+        template.pick("skills3", traits, lists, context)
         traits = [
             (name, cost, trait_type)
             for (name, cost, trait_type) in traits
@@ -1852,48 +2925,37 @@ def generate_martial_artist() -> List[Tuple[str, int, TraitType]]:
             for (name, cost, trait_type) in traits
             if name != "Judo" and name != "Karate"
         ]
-        if random.randrange(2) == 0:
+        # A traced run picks nothing, so it does not draw here either.
+        if _tracing.trace is not None or rng.randrange(2) == 0:
             traits.append(("Judo", 8, SK))
             traits.append(("Karate", 4, SK))
         else:
             traits.append(("Judo", 4, SK))
             traits.append(("Karate", 8, SK))
 
-    skills4 = [
-        [("Fast-Draw (any)", 1, SK)],
-        [("Climbing", 1, SK)],
-        [("First Aid", 1, SK)],
-        [("Gesture", 1, SK)],
-        [("Teaching", 1, SK)],
-        [("Hiking", 1, SK)],
-        [("Running", 1, SK)],
-        [("Intimidation", 1, SK)],
-        [("Observation", 1, SK)],
-    ]
-    traits.extend(pick_from_list(skills4, 3))
-
-    pick_or_improve_skills_from_list(
-        special_skill_names, 14, traits, min_cost=2
-    )
+    template.pick("skills4", traits, lists, context)
+    template.improve_skills(traits, context)
 
     # Prereq hack.
     trait_names = set((trait[0] for trait in traits))
     if "Flying Leap" in trait_names and "Power Blow" not in trait_names:
         total_cost = 0
-        for (name, cost, trait_type) in traits:
+        for (name, cost, trait_type) in list(traits):
             if name == "Flying Leap":
                 total_cost += cost
                 traits.remove((name, cost, trait_type))
-        remaining_special_skill_names = list(
-            special_skill_names - trait_names - {"Flying Leap"}
-        )
-        name2 = random.choice(remaining_special_skill_names)
+        remaining_special_skill_names = [
+            name
+            for name in template.improve_names
+            if name not in trait_names and name != "Flying Leap"
+        ]
+        name2 = rng.choice(remaining_special_skill_names)
         traits.append((name2, total_cost, SK))
     return traits
 
 
-def generate_scout() -> List[Tuple[str, int, TraitType]]:
-    traits = [
+scout_data = TemplateData(
+    traits=[
         ("ST 13", 30, PA),
         ("DX 14", 80, PA),
         ("IQ 11", 20, PA),
@@ -1906,141 +2968,164 @@ def generate_scout() -> List[Tuple[str, int, TraitType]]:
         ("Basic Move 7", 0, SA),
         ("Heroic Archer", 20, AD),
         ("Outdoorsman 2", 20, AD),
-    ]
-
-    ads1 = [
-        list_levels("ST +%d", 10, PA, 2),
-        [("DX +1", 20, PA)],
-        list_levels("HT +%d", 10, PA, 2),
-        list_levels("Per +%d", 5, SA, 4),
-        [("Basic Speed +1", 20, SA)],
-        list_levels("Basic Move +%d", 5, SA, 3),
-        [("Absolute Direction", 5, AD)],
-        list_levels("Acute Vision %d", 2, AD, 5),
-        [("Combat Reflexes", 15, AD)],
-        [("Danger Sense", 15, AD)],
-        [("Fit", 5, AD), ("Very Fit", 15, AD)],
-        [("High Pain Threshold", 10, AD)],
-        [("Luck", 15, AD)],
-        list_levels("Night Vision %d", 1, AD, 9),
-        list_levels("Outdoorsman %d", 10, AD, 2, min_level=3),
-        [("Peripheral Vision", 15, AD)],
-        [("Rapid Healing", 5, AD)],
-        list_levels("Signature Gear %d", 1, AD, 10),
-        [("Weapon Bond", 1, AD)],
-        [("Weapon Master (Bow)", 20, AD)],
-    ]
-    traits.extend(pick_from_list(ads1, 20))
-
-    disads1 = [
-        list_self_control_levels("Bloodlust", -10),
-        [("Callous (12)", -5, DI)],
-        list_self_control_levels("Greed", -15),
-        list_self_control_levels("Honesty", -10),
-        list_self_control_levels("Overconfidence", -5),
-        [("Sense of Duty (Adventuring companions)", -5, DI)],
-        [("Stubbornness", -5, DI)],
-    ]
-    traits.extend(pick_from_list(disads1, -15))
-
-    disads2 = [
-        [
-            ("Code of Honor (Pirate's)", -5, DI),
-            ("Code of Honor (Soldier's)", -10, DI),
-        ],
-        [("Intolerance (Urbanites)", -5, DI)],
-        list_self_control_levels("Loner", -5),
-        [("No Sense of Humor", -10, DI)],
-        [("Odious Personal Habit (Unwashed bushwhacker)", -5, DI)],
-        [("Paranoia", -10, DI)],
-        list_self_control_levels("Phobia (Crowds)", -15),
-        [("Social Stigma (Disowned)", -5, DI)],
-        [("Vow (Never Sleep Indoors)", -10, DI)],
-        [("Vow (Own no more than what can be carried)", -10, DI)],
-    ]
-    disads2.extend(disads1)
-    traits.extend(pick_from_list(disads2, -35))
-
-    fixed_skills = [
-        [("Bow", 16, SK)],
-        [("Camouflage", 2, SK)],
-        [("Fast-Draw (Arrow)", 1, SK)],
-        [("Observation", 2, SK)],
-        [("Tracking", 2, SK)],
-        [("Climbing", 1, SK)],
-        [("Stealth", 1, SK)],
-        [("Gesture", 2, SK)],
-        [("Cartography", 4, SK)],
-        [("Shadowing", 4, SK)],
-        [("Traps", 4, SK)],
-        [("Mimicry (Bird Calls)", 2, SK)],
-        [("Hiking", 2, SK)],
-    ]
-    for fixed_skill in fixed_skills:
-        traits.append(fixed_skill[0])
-
-    skills1 = [
-        [
-            ("Broadsword", 12, SK),
-            ("Shortsword", 12, SK),
-            ("Spear", 12, SK),
-            ("Staff", 12, SK),
-        ],
-        [("Broadsword", 8, SK), ("Shortsword", 8, SK), ("Spear", 8, SK)],
-        [("Shield", 4, SK)],
-    ]
-
-    skills2 = [[("Navigation (Land)", 1, SK)], [("Navigation (Sea)", 1, SK)]]
-
-    skills3 = [
-        [("Survival (Arctic)", 1, SK)],
-        [("Survival (Desert)", 1, SK)],
-        [("Survival (Island/Beach)", 1, SK)],
-        [("Survival (Jungle)", 1, SK)],
-        [("Survival (Mountain)", 1, SK)],
-        [("Survival (Plains)", 1, SK)],
-        [("Survival (Swampland)", 1, SK)],
-        [("Survival (Woodlands)", 1, SK)],
-    ]
-
-    skills4 = [
-        [("Brawling", 1, SK)],
-        [("Fast-Draw (any other)", 1, SK)],
-        [("Garrote", 1, SK)],
-        [("Jumping", 1, SK)],
-        [("Knife", 1, SK)],
-        [("Knot-Tying", 1, SK)],
-        [("Boating (Unpowered)", 1, SK)],
-        [("Riding (Horse)", 1, SK)],
-        [("Throwing", 1, SK)],
-        [("Wrestling", 1, SK)],
-        [("First Aid", 1, SK)],
-        [("Seamanship", 1, SK)],
-        [("Armoury (Missile Weapons)", 1, SK)],
-        [("Prospecting", 1, SK)],
-        [("Weather Sense", 1, SK)],
-        [("Swimming", 1, SK)],
-        [("Running", 1, SK)],
-        [("Skiing", 1, SK)],
-        [("Search", 1, SK)],
-    ]
-
-    all_skills = set()
-    for lst in [skills1, skills2, skills3, skills4, fixed_skills]:
-        for lst2 in lst:
-            for tup in lst2:
-                all_skills.add(tup[0])
+    ],
+    stages=[
+        Stage(
+            "fixed_skills",
+            None,
+            [
+                [("Bow", 16, SK)],
+                [("Camouflage", 2, SK)],
+                [("Fast-Draw (Arrow)", 1, SK)],
+                [("Observation", 2, SK)],
+                [("Tracking", 2, SK)],
+                [("Climbing", 1, SK)],
+                [("Stealth", 1, SK)],
+                [("Gesture", 2, SK)],
+                [("Cartography", 4, SK)],
+                [("Shadowing", 4, SK)],
+                [("Traps", 4, SK)],
+                [("Mimicry (Bird Calls)", 2, SK)],
+                [("Hiking", 2, SK)],
+            ],
+        ),
+        Stage(
+            "ads1",
+            20,
+            [
+                list_levels("ST +%d", 10, PA, 2),
+                [("DX +1", 20, PA)],
+                list_levels("HT +%d", 10, PA, 2),
+                list_levels("Per +%d", 5, SA, 4),
+                [("Basic Speed +1", 20, SA)],
+                list_levels("Basic Move +%d", 5, SA, 3),
+                [("Absolute Direction", 5, AD)],
+                list_levels("Acute Vision %d", 2, AD, 5),
+                [("Combat Reflexes", 15, AD)],
+                [("Danger Sense", 15, AD)],
+                [("Fit", 5, AD), ("Very Fit", 15, AD)],
+                [("High Pain Threshold", 10, AD)],
+                [("Luck", 15, AD)],
+                list_levels("Night Vision %d", 1, AD, 9),
+                list_levels("Outdoorsman %d", 10, AD, 2, min_level=3),
+                [("Peripheral Vision", 15, AD)],
+                [("Rapid Healing", 5, AD)],
+                list_levels("Signature Gear %d", 1, AD, 10),
+                [("Weapon Bond", 1, AD)],
+                [("Weapon Master (Bow)", 20, AD)],
+            ],
+        ),
+        Stage(
+            "disads1",
+            -15,
+            [
+                list_self_control_levels("Bloodlust", -10),
+                [("Callous (12)", -5, DI)],
+                list_self_control_levels("Greed", -15),
+                list_self_control_levels("Honesty", -10),
+                list_self_control_levels("Overconfidence", -5),
+                [("Sense of Duty (Adventuring companions)", -5, DI)],
+                [("Stubbornness", -5, DI)],
+            ],
+        ),
+        Stage(
+            "disads2",
+            -35,
+            [
+                [
+                    ("Code of Honor (Pirate's)", -5, DI),
+                    ("Code of Honor (Soldier's)", -10, DI),
+                ],
+                [("Intolerance (Urbanites)", -5, DI)],
+                list_self_control_levels("Loner", -5),
+                [("No Sense of Humor", -10, DI)],
+                [("Odious Personal Habit (Unwashed bushwhacker)", -5, DI)],
+                [("Paranoia", -10, DI)],
+                list_self_control_levels("Phobia (Crowds)", -15),
+                [("Social Stigma (Disowned)", -5, DI)],
+                [("Vow (Never Sleep Indoors)", -10, DI)],
+                [("Vow (Own no more than what can be carried)", -10, DI)],
+            ],
+            reuse=("disads1",),
+        ),
+        Stage(
+            "skills4",
+            None,
+            [
+                [("Brawling", 1, SK)],
+                [("Fast-Draw (any other)", 1, SK)],
+                [("Garrote", 1, SK)],
+                [("Jumping", 1, SK)],
+                [("Knife", 1, SK)],
+                [("Knot-Tying", 1, SK)],
+                [("Boating (Unpowered)", 1, SK)],
+                [("Riding (Horse)", 1, SK)],
+                [("Throwing", 1, SK)],
+                [("Wrestling", 1, SK)],
+                [("First Aid", 1, SK)],
+                [("Seamanship", 1, SK)],
+                [("Armoury (Missile Weapons)", 1, SK)],
+                [("Prospecting", 1, SK)],
+                [("Weather Sense", 1, SK)],
+                [("Swimming", 1, SK)],
+                [("Running", 1, SK)],
+                [("Skiing", 1, SK)],
+                [("Search", 1, SK)],
+            ],
+        ),
+        Stage(
+            "skills1",
+            12,
+            [
+                [
+                    ("Broadsword", 12, SK),
+                    ("Shortsword", 12, SK),
+                    ("Spear", 12, SK),
+                    ("Staff", 12, SK),
+                ],
+                [
+                    ("Broadsword", 8, SK),
+                    ("Shortsword", 8, SK),
+                    ("Spear", 8, SK),
+                ],
+                [("Shield", 4, SK)],
+            ],
+        ),
+        Stage(
+            "skills2",
+            1,
+            [[("Navigation (Land)", 1, SK)], [("Navigation (Sea)", 1, SK)]],
+        ),
+        Stage(
+            "skills3",
+            1,
+            [
+                [("Survival (Arctic)", 1, SK)],
+                [("Survival (Desert)", 1, SK)],
+                [("Survival (Island/Beach)", 1, SK)],
+                [("Survival (Jungle)", 1, SK)],
+                [("Survival (Mountain)", 1, SK)],
+                [("Survival (Plains)", 1, SK)],
+                [("Survival (Swampland)", 1, SK)],
+                [("Survival (Woodlands)", 1, SK)],
+            ],
+        ),
+    ],
+    fixed=("fixed_skills",),
+    improve=Improve(
+        8, ("skills1", "skills2", "skills3", "skills4", "fixed_skills")
+    ),
+)
 
-    traits.extend(pick_from_list(skills1, 12))
-    traits.extend(pick_from_list(skills2, 1))
-    traits.extend(pick_from_list(skills3, 1))
 
-    pick_or_improve_skills_from_list(all_skills, 8, traits)
-    return traits
+def generate_scout(
+    context: GenerationContext = None,
+) -> List[Tuple[str, int, TraitType]]:
+    return template_to_compiled["scout"].generate(context)
 
 
-def generate_swashbuckler() -> List[Tuple[str, int, TraitType]]:
-    traits = [
+swashbuckler_data = TemplateData(
+    traits=[
         ("ST 11", 10, PA),
         ("DX 15", 100, PA),
         ("IQ 10", 0, PA),
@@ -2063,144 +3148,170 @@ def generate_swashbuckler() -> List[Tuple[str, int, TraitType]]:
         ("Wrestling", 2, SK),
         ("Stealth", 1, SK),
         ("Carousing", 1, SK),
-    ]
-
-    ads1 = [
-        list_levels("ST +%d", 10, PA, 6),
-        list_levels("DX +%d", 20, PA, 3),
-        list_levels("Basic Speed +%d", 20, SA, 2),
-        list_levels("Basic Move +%d", 5, SA, 3),
-        [("Alcohol Tolerance", 1, AD)],
-        [("Ambidexterity", 5, AD)],
-        [
-            ("Appearance: Attractive", 4, AD),
-            ("Appearance: Handsome", 12, AD),
-            ("Appearance: Very Handsome", 16, AD),
-        ],
-        list_levels("Charisma %d", 5, AD, 5),
-        [("Daredevil", 15, AD)],
-        [("Enhanced Dodge", 15, AD)],
-        list_levels(
-            "Enhanced Parry %d (Weapon of Choice)", 5, AD, 2, min_level=2
-        ),
-        [("Extra Attack 1", 25, AD)],
-        [("No Hangover", 1, AD)],
-        [("Perfect Balance", 15, AD)],
-        [("Rapier Wit", 5, AD)],
-        list_levels("Serendipity %d", 15, AD, 4),
-        list_levels("Signature Gear %d", 1, AD, 10),
-        list_levels("Striking ST %d", 5, AD, 2),
-        [("Extraordinary Luck", 15, AD), ("Ridiculous Luck", 45, AD)],
-    ]
-    traits.extend(pick_from_list(ads1, 60))
-
-    disads1 = [
-        [
-            ("Code of Honor (Pirate's)", -5, DI),
-            ("Code of Honor (Gentleman's)", -10, DI),
-        ],
-        list_self_control_levels(
-            "Obsession (Become the best swordsman in the world)", -10
-        ),
-        [("Vow (Use only weapon of choice)", -5, DI)],
-        [("Vow (Never resist a challenge to combat)", -10, DI)],
-        [("Vow (Challenge every swordsman to combat)", -15, DI)],
-        [("Vow (Never wear armor)", -15, DI)],
-        [("Wounded", -5, DI)],
-    ]
-    traits.extend(pick_from_list(disads1, -15))
-
-    disads2 = [
-        list_self_control_levels("Impulsiveness", -10),
-        list_self_control_levels("Overconfidence", -5),
-        list_self_control_levels("Short Attention Span", -10),
-        list_self_control_levels("Trickster", -15),
-    ]
-    disads2.extend(disads1)
-    traits.extend(pick_from_list(disads2, -15))
-
-    disads3 = [
-        list_self_control_levels2("Chummy", -5, "Gregarious", -10),
-        list_self_control_levels("Compulsive Carousing", -5),
-        list_self_control_levels("Compulsive Spending", -5),
-        list_self_control_levels("Greed", -15),
-        list_self_control_levels("Jealousy", -10),
-        list_self_control_levels("Lecherousness", -15),
-        [("One Eye", -15, DI)],
-        [("Sense of Duty (Adventuring companions)", -5, DI)],
-        [("Wounded", -5, DI)],
-    ]
-    disads3.extend(disads2)
-    traits.extend(pick_from_list(disads3, -20))
-
-    skills1 = [[("Thrown Weapon (Knife)", 2, SK)], [("Throwing", 2, SK)]]
-    traits.extend(pick_from_list(skills1, 2))
-
-    skills2 = [
-        [
-            ("Broadsword", 20, SK),
-            ("Rapier", 20, SK),
-            ("Saber", 20, SK),
-            ("Shortsword", 20, SK),
-            ("Smallsword", 20, SK),
-        ],
-        [
-            ("Broadsword", 16, SK),
-            ("Rapier", 16, SK),
-            ("Saber", 16, SK),
-            ("Shortsword", 16, SK),
-            ("Smallsword", 16, SK),
-        ],
-        [
-            ("Broadsword", 12, SK),
-            ("Rapier", 12, SK),
-            ("Saber", 12, SK),
-            ("Shortsword", 12, SK),
-            ("Smallsword", 12, SK),
-        ],
-        [
-            ("Shield (Buckler)", 8, SK),
-            ("Cloak", 8, SK),
-            ("Main-Gauche", 8, SK),
-        ],
-        [
-            ("Shield (Buckler)", 4, SK),
-            ("Cloak", 4, SK),
-            ("Main-Gauche", 4, SK),
-        ],
-    ]
-    traits.extend(pick_from_list(skills2, 20))
+    ],
+    stages=[
+        Stage(
+            "ads1",
+            60,
+            [
+                list_levels("ST +%d", 10, PA, 6),
+                list_levels("DX +%d", 20, PA, 3),
+                list_levels("Basic Speed +%d", 20, SA, 2),
+                list_levels("Basic Move +%d", 5, SA, 3),
+                [("Alcohol Tolerance", 1, AD)],
+                [("Ambidexterity", 5, AD)],
+                [
+                    ("Appearance: Attractive", 4, AD),
+                    ("Appearance: Handsome", 12, AD),
+                    ("Appearance: Very Handsome", 16, AD),
+                ],
+                list_levels("Charisma %d", 5, AD, 5),
+                [("Daredevil", 15, AD)],
+                [("Enhanced Dodge", 15, AD)],
+                list_levels(
+                    "Enhanced Parry %d (Weapon of Choice)",
+                    5,
+                    AD,
+                    2,
+                    min_level=2,
+                ),
+                [("Extra Attack 1", 25, AD)],
+                [("No Hangover", 1, AD)],
+                [("Perfect Balance", 15, AD)],
+                [("Rapier Wit", 5, AD)],
+                list_levels("Serendipity %d", 15, AD, 4),
+                list_levels("Signature Gear %d", 1, AD, 10),
+                list_levels("Striking ST %d", 5, AD, 2),
+                [("Extraordinary Luck", 15, AD), ("Ridiculous Luck", 45, AD)],
+            ],
+        ),
+        Stage(
+            "disads1",
+            -15,
+            [
+                [
+                    ("Code of Honor (Pirate's)", -5, DI),
+                    ("Code of Honor (Gentleman's)", -10, DI),
+                ],
+                list_self_control_levels(
+                    "Obsession (Become the best swordsman in the world)", -10
+                ),
+                [("Vow (Use only weapon of choice)", -5, DI)],
+                [("Vow (Never resist a challenge to combat)", -10, DI)],
+                [("Vow (Challenge every swordsman to combat)", -15, DI)],
+                [("Vow (Never wear armor)", -15, DI)],
+                [("Wounded", -5, DI)],
+            ],
+        ),
+        Stage(
+            "disads2",
+            -15,
+            [
+                list_self_control_levels("Impulsiveness", -10),
+                list_self_control_levels("Overconfidence", -5),
+                list_self_control_levels("Short Attention Span", -10),
+                list_self_control_levels("Trickster", -15),
+            ],
+            reuse=("disads1",),
+        ),
+        Stage(
+            "disads3",
+            -20,
+            [
+                list_self_control_levels2("Chummy", -5, "Gregarious", -10),
+                list_self_control_levels("Compulsive Carousing", -5),
+                list_self_control_levels("Compulsive Spending", -5),
+                list_self_control_levels("Greed", -15),
+                list_self_control_levels("Jealousy", -10),
+                list_self_control_levels("Lecherousness", -15),
+                [("One Eye", -15, DI)],
+                [("Sense of Duty (Adventuring companions)", -5, DI)],
+                [("Wounded", -5, DI)],
+            ],
+            reuse=("disads2",),
+        ),
+        Stage(
+            "skills1",
+            2,
+            [[("Thrown Weapon (Knife)", 2, SK)], [("Throwing", 2, SK)]],
+        ),
+        Stage(
+            "skills2",
+            20,
+            [
+                [
+                    ("Broadsword", 20, SK),
+                    ("Rapier", 20, SK),
+                    ("Saber", 20, SK),
+                    ("Shortsword", 20, SK),
+                    ("Smallsword", 20, SK),
+                ],
+                [
+                    ("Broadsword", 16, SK),
+                    ("Rapier", 16, SK),
+                    ("Saber", 16, SK),
+                    ("Shortsword", 16, SK),
+                    ("Smallsword", 16, SK),
+                ],
+                [
+                    ("Broadsword", 12, SK),
+                    ("Rapier", 12, SK),
+                    ("Saber", 12, SK),
+                    ("Shortsword", 12, SK),
+                    ("Smallsword", 12, SK),
+                ],
+                [
+                    ("Shield (Buckler)", 8, SK),
+                    ("Cloak", 8, SK),
+                    ("Main-Gauche", 8, SK),
+                ],
+                [
+                    ("Shield (Buckler)", 4, SK),
+                    ("Cloak", 4, SK),
+                    ("Main-Gauche", 4, SK),
+                ],
+            ],
+        ),
+        Stage("skills3", 2, [[("Brawling", 2, SK)], [("Boxing", 2, SK)]]),
+        Stage(
+            "skills4",
+            2,
+            [
+                [("Savoir-Faire (High Society)", 2, SK)],
+                [("Streetwise", 2, SK)],
+            ],
+        ),
+        Stage(
+            "skills5",
+            7,
+            [
+                [("Fast-Draw (any other)", 1, SK)],
+                [("Climbing", 1, SK)],
+                [("First Aid", 1, SK)],
+                [("Gesture", 1, SK)],
+                [("Seamanship", 1, SK)],
+                [("Connoisseur (any)", 1, SK)],
+                [("Fast-Talk", 1, SK)],
+                [("Gambling", 1, SK)],
+                [("Hiking", 1, SK)],
+                [("Sex Appeal", 1, SK)],
+                [("Intimidation", 1, SK)],
+                [("Scrounging", 1, SK)],
+                [("Search", 1, SK)],
+            ],
+        ),
+    ],
+)
 
-    skills3 = [[("Brawling", 2, SK)], [("Boxing", 2, SK)]]
-    traits.extend(pick_from_list(skills3, 2))
 
-    skills4 = [
-        [("Savoir-Faire (High Society)", 2, SK)],
-        [("Streetwise", 2, SK)],
-    ]
-    traits.extend(pick_from_list(skills4, 2))
-
-    skills5 = [
-        [("Fast-Draw (any other)", 1, SK)],
-        [("Climbing", 1, SK)],
-        [("First Aid", 1, SK)],
-        [("Gesture", 1, SK)],
-        [("Seamanship", 1, SK)],
-        [("Connoisseur (any)", 1, SK)],
-        [("Fast-Talk", 1, SK)],
-        [("Gambling", 1, SK)],
-        [("Hiking", 1, SK)],
-        [("Sex Appeal", 1, SK)],
-        [("Intimidation", 1, SK)],
-        [("Scrounging", 1, SK)],
-        [("Search", 1, SK)],
-    ]
-    traits.extend(pick_from_list(skills5, 7))
-    return traits
+def generate_swashbuckler(
+    context: GenerationContext = None,
+) -> List[Tuple[str, int, TraitType]]:
+    return template_to_compiled["swashbuckler"].generate(context)
 
 
-def generate_thief() -> List[Tuple[str, int, TraitType]]:
-    traits = [
+thief_data = TemplateData(
+    traits=[
         ("ST 11", 10, PA),
         ("DX 15", 100, PA),
         ("IQ 13", 60, PA),
@@ -2214,153 +3325,177 @@ def generate_thief() -> List[Tuple[str, int, TraitType]]:
         ("Flexibility", 5, AD),
         ("High Manual Dexterity 1", 5, AD),
         ("Perfect Balance", 15, AD),
-    ]
-
-    ads1 = [
-        [("DX +1", 20, PA)],
-        [("IQ +1", 20, PA)],
-        list_levels("Per +%d", 5, SA, 6),
-        [("Basic Speed +1", 20, SA)],
-        list_levels("Basic Move +%d", 5, SA, 2),
-        [("Ambidexterity", 5, AD)],
-        [("Catfall", 10, AD)],
-        [("Combat Reflexes", 15, AD)],
-        [("Danger Sense", 15, AD)],
-        list_levels("Enhanced Dodge %d", 15, AD, 2),
-        list_levels("Gizmos %d", 5, AD, 3),
-        list_levels("High Manual Dexterity %d", 5, AD, 3, min_level=2),
-        [("Honest Face", 1, AD)],
-        [("Luck", 15, AD), ("Extraordinary Luck", 30, AD)],
-        list_levels("Night Vision %d", 1, AD, 9),
-        [("Peripheral Vision", 15, AD)],
-        list_levels("Serendipity %d", 15, AD, 2),
-        list_levels("Signature Gear %d", 1, AD, 10),
-        list_levels("Striking ST %d (Only on surprise attack)", 2, AD, 2),
-        [("Wealth (Comfortable)", 10, AD), ("Wealth (Wealthy)", 20, AD)],
-        [("Double-Jointed", 10, AD)],
-    ]
-    traits.extend(pick_from_list(ads1, 30))
-
-    disads1 = [
-        [("Greed (12)", -15, AD)],
-        [("Kleptomania (12)", -15, AD)],
-        [("Trickster (12)", -15, AD)],
-    ]
-    traits.extend(pick_from_list(disads1, -15))
-
-    disads2 = [
-        [("Callous (12)", -5, AD)],
-        [("Code of Honor (Pirate's)", -5, AD)],
-        [("Curious", -5, AD)],
-    ]
-    traits.extend(pick_from_list(disads2, -5))
-
-    disads3 = [
-        list_self_control_levels("Bad Temper", -10),
-        list_self_control_levels("Bloodlust", -10),
-        list_self_control_levels("Compulsive Carousing", -5),
-        list_self_control_levels("Compulsive Gambling", -5),
-        list_self_control_levels("Compulsive Lying", -15),
-        list_self_control_levels("Compulsive Spending", -5),
-        list_self_control_levels("Cowardice", -10),
-        [("Laziness", -10, AD)],
-        list_self_control_levels("Lecherousness", -15),
-        list_self_control_levels("Loner", -5),
-        [("One Eye", -15, AD)],
-        list_self_control_levels("Overconfidence", -5),
-        list_self_control_levels("Post-Combat Shakes", -5),
-        [("Sense of Duty (Adventuring companions)", -5, AD)],
-        [("Skinny", -5, AD)],
-        [("Social Stigma (Criminal Record)", -5, AD)],
-    ]
-    disads3.extend(disads1)
-    disads3.extend(disads2)
-    traits.extend(pick_from_list(disads3, -20))
-
-    fixed_skills = [
-        [("Forced Entry", 1, SK)],
-        [("Climbing", 1, SK)],
-        [("Filch", 2, SK)],
-        [("Stealth", 12, SK)],
-        [("Escape", 1, SK)],
-        [("Pickpocket", 2, SK)],
-        [("Lockpicking", 4, SK)],
-        [("Traps", 4, SK)],
-        [("Acrobatics", 1, SK)],
-        [("Sleight of Hand", 1, SK)],
-        [("Gesture", 1, SK)],
-        [("Holdout", 2, SK)],
-        [("Shadowing", 2, SK)],
-        [("Smuggling", 2, SK)],
-        [("Streetwise", 2, SK)],
-        [("Search", 2, SK)],
-        [("Urban Survival", 2, SK)],
-        [("Brawling", 1, SK)],
-        [("Gambling", 1, SK)],
-        [("Carousing", 1, SK)],
-    ]
-    for fixed_skill in fixed_skills:
-        traits.append(fixed_skill[0])
-
-    skills1 = [
-        [
-            ("Rapier", 2, SK),
-            ("Saber", 2, SK),
-            ("Shortsword", 2, SK),
-            ("Smallsword", 2, SK),
-        ],
-        [
-            ("Rapier", 1, SK),
-            ("Saber", 1, SK),
-            ("Shortsword", 1, SK),
-            ("Smallsword", 1, SK),
-        ],
-        [
-            ("Shield (Buckler, SK)", 1, SK),
-            ("Cloak", 1, SK),
-            ("Main-Gauche", 1, SK),
-        ],
-    ]
-
-    skills2 = [
-        [("Crossbow", 1, SK)],
-        [("Thrown Weapon (Knife)", 1, SK)],
-        [("Bow", 1, SK)],
-        [("Throwing", 1, SK)],
-        [("Sling", 1, SK)],
-    ]
-
-    skills3 = [
-        [("Fast-Draw (any)", 1, SK)],
-        [("Garrote", 1, SK)],
-        [("First Aid", 1, SK)],
-        [("Panhandling", 1, SK)],
-        [("Seamanship", 1, SK)],
-        [("Cartography", 1, SK)],
-        [("Connoisseur (any)", 1, SK)],
-        [("Disguise", 1, SK)],
-        [("Fast-Talk", 1, SK)],
-        [("Merchant", 1, SK)],
-        [("Counterfeiting", 1, SK)],
-        [("Forgery", 1, SK)],
-        [("Poisons", 1, SK)],
-        [("Hiking", 1, SK)],
-        [("Scrounging", 1, SK)],
-        [("Lip Reading", 1, SK)],
-        [("Observation", 1, SK)],
-    ]
-
-    all_skills = set()
-    for lst in [skills1, skills2, skills3, fixed_skills]:
-        for lst2 in lst:
-            for tup in lst2:
-                all_skills.add(tup[0])
+    ],
+    stages=[
+        Stage(
+            "fixed_skills",
+            None,
+            [
+                [("Forced Entry", 1, SK)],
+                [("Climbing", 1, SK)],
+                [("Filch", 2, SK)],
+                [("Stealth", 12, SK)],
+                [("Escape", 1, SK)],
+                [("Pickpocket", 2, SK)],
+                [("Lockpicking", 4, SK)],
+                [("Traps", 4, SK)],
+                [("Acrobatics", 1, SK)],
+                [("Sleight of Hand", 1, SK)],
+                [("Gesture", 1, SK)],
+                [("Holdout", 2, SK)],
+                [("Shadowing", 2, SK)],
+                [("Smuggling", 2, SK)],
+                [("Streetwise", 2, SK)],
+                [("Search", 2, SK)],
+                [("Urban Survival", 2, SK)],
+                [("Brawling", 1, SK)],
+                [("Gambling", 1, SK)],
+                [("Carousing", 1, SK)],
+            ],
+        ),
+        Stage(
+            "ads1",
+            30,
+            [
+                [("DX +1", 20, PA)],
+                [("IQ +1", 20, PA)],
+                list_levels("Per +%d", 5, SA, 6),
+                [("Basic Speed +1", 20, SA)],
+                list_levels("Basic Move +%d", 5, SA, 2),
+                [("Ambidexterity", 5, AD)],
+                [("Catfall", 10, AD)],
+                [("Combat Reflexes", 15, AD)],
+                [("Danger Sense", 15, AD)],
+                list_levels("Enhanced Dodge %d", 15, AD, 2),
+                list_levels("Gizmos %d", 5, AD, 3),
+                list_levels("High Manual Dexterity %d", 5, AD, 3, min_level=2),
+                [("Honest Face", 1, AD)],
+                [("Luck", 15, AD), ("Extraordinary Luck", 30, AD)],
+                list_levels("Night Vision %d", 1, AD, 9),
+                [("Peripheral Vision", 15, AD)],
+                list_levels("Serendipity %d", 15, AD, 2),
+                list_levels("Signature Gear %d", 1, AD, 10),
+                list_levels(
+                    "Striking ST %d (Only on surprise attack)", 2, AD, 2
+                ),
+                [
+                    ("Wealth (Comfortable)", 10, AD),
+                    ("Wealth (Wealthy)", 20, AD),
+                ],
+                [("Double-Jointed", 10, AD)],
+            ],
+        ),
+        Stage(
+            "disads1",
+            -15,
+            [
+                [("Greed (12)", -15, AD)],
+                [("Kleptomania (12)", -15, AD)],
+                [("Trickster (12)", -15, AD)],
+            ],
+        ),
+        Stage(
+            "disads2",
+            -5,
+            [
+                [("Callous (12)", -5, AD)],
+                [("Code of Honor (Pirate's)", -5, AD)],
+                [("Curious", -5, AD)],
+            ],
+        ),
+        Stage(
+            "disads3",
+            -20,
+            [
+                list_self_control_levels("Bad Temper", -10),
+                list_self_control_levels("Bloodlust", -10),
+                list_self_control_levels("Compulsive Carousing", -5),
+                list_self_control_levels("Compulsive Gambling", -5),
+                list_self_control_levels("Compulsive Lying", -15),
+                list_self_control_levels("Compulsive Spending", -5),
+                list_self_control_levels("Cowardice", -10),
+                [("Laziness", -10, AD)],
+                list_self_control_levels("Lecherousness", -15),
+                list_self_control_levels("Loner", -5),
+                [("One Eye", -15, AD)],
+                list_self_control_levels("Overconfidence", -5),
+                list_self_control_levels("Post-Combat Shakes", -5),
+                [("Sense of Duty (Adventuring companions)", -5, AD)],
+                [("Skinny", -5, AD)],
+                [("Social Stigma (Criminal Record)", -5, AD)],
+            ],
+            reuse=(
+                "disads1",
+                "disads2",
+            ),
+        ),
+        Stage(
+            "skills3",
+            None,
+            [
+                [("Fast-Draw (any)", 1, SK)],
+                [("Garrote", 1, SK)],
+                [("First Aid", 1, SK)],
+                [("Panhandling", 1, SK)],
+                [("Seamanship", 1, SK)],
+                [("Cartography", 1, SK)],
+                [("Connoisseur (any)", 1, SK)],
+                [("Disguise", 1, SK)],
+                [("Fast-Talk", 1, SK)],
+                [("Merchant", 1, SK)],
+                [("Counterfeiting", 1, SK)],
+                [("Forgery", 1, SK)],
+                [("Poisons", 1, SK)],
+                [("Hiking", 1, SK)],
+                [("Scrounging", 1, SK)],
+                [("Lip Reading", 1, SK)],
+                [("Observation", 1, SK)],
+            ],
+        ),
+        Stage(
+            "skills1",
+            2,
+            [
+                [
+                    ("Rapier", 2, SK),
+                    ("Saber", 2, SK),
+                    ("Shortsword", 2, SK),
+                    ("Smallsword", 2, SK),
+                ],
+                [
+                    ("Rapier", 1, SK),
+                    ("Saber", 1, SK),
+                    ("Shortsword", 1, SK),
+                    ("Smallsword", 1, SK),
+                ],
+                [
+                    ("Shield (Buckler, SK)", 1, SK),
+                    ("Cloak", 1, SK),
+                    ("Main-Gauche", 1, SK),
+                ],
+            ],
+        ),
+        Stage(
+            "skills2",
+            1,
+            [
+                [("Crossbow", 1, SK)],
+                [("Thrown Weapon (Knife)", 1, SK)],
+                [("Bow", 1, SK)],
+                [("Throwing", 1, SK)],
+                [("Sling", 1, SK)],
+            ],
+        ),
+    ],
+    fixed=("fixed_skills",),
+    improve=Improve(7, ("skills1", "skills2", "skills3", "fixed_skills")),
+)
 
-    traits.extend(pick_from_list(skills1, 2))
-    traits.extend(pick_from_list(skills2, 1))
 
-    pick_or_improve_skills_from_list(all_skills, 7, traits)
-    return traits
+def generate_thief(
+    context: GenerationContext = None,
+) -> List[Tuple[str, int, TraitType]]:
+    return template_to_compiled["thief"].generate(context)
 
 
 # from http://forums.sjgames.com/showthread.php?t=110145
@@ -3107,12 +4242,15 @@ banned_colleges = {
 allowed_bard_colleges = {"Communication", "Mind Control"}
 
 
-# dict of spell name to set of colleges to which it belongs
-spell_to_colleges: Dict[str, Set[str]] = {}
+special_bard_skills = {
+    "Hypnotism",
+    "Musical Influence",
+    "Persuade",
+    "Suggest",
+    "Sway Emotions",
+    "Captivate",
+}
 
-# dict of spell name to text of a function that takes (traits, trait_names) as
-# arguments and returns True iff the prereqs are satisfied
-spell_to_prereq_function: Dict[str, str] = {}
 
 # gcs_library/spell_list/spell/name
 # gcs_library/spell_list/spell/categories/category
@@ -3137,7 +4275,16 @@ spell_to_prereq_function: Dict[str, str] = {}
 #      should be college earth not name earth
 
 
-def count_spell_colleges(traits: List[Tuple[str, int, TraitType]]) -> int:
+def _full_spell_to_colleges() -> Mapping[str, AbstractSet[str]]:
+    return get_spell_library().spell_to_colleges
+
+
+def count_spell_colleges(
+    traits: List[Tuple[str, int, TraitType]],
+    spell_to_colleges: Mapping[str, AbstractSet[str]] = None,
+) -> int:
+    if spell_to_colleges is None:
+        spell_to_colleges = _full_spell_to_colleges()
     colleges: Set[str] = set()
     for tup in traits:
         name = tup[0]
@@ -3147,8 +4294,11 @@ def count_spell_colleges(traits: List[Tuple[str, int, TraitType]]) -> int:
 
 
 def count_spells_from_each_college(
-    traits: List[Tuple[str, int, TraitType]]
+    traits: List[Tuple[str, int, TraitType]],
+    spell_to_colleges: Mapping[str, AbstractSet[str]] = None,
 ) -> typing.Counter[str]:
+    if spell_to_colleges is None:
+        spell_to_colleges = _full_spell_to_colleges()
     college_count: typing.Counter[str] = Counter()
     for tup in traits:
         name = tup[0]
@@ -3158,8 +4308,12 @@ def count_spells_from_each_college(
 
 
 def count_spells_starting_with(
-    traits: List[Tuple[str, int, TraitType]], st: str
+    traits: List[Tuple[str, int, TraitType]],
+    st: str,
+    spell_to_colleges: Mapping[str, AbstractSet[str]] = None,
 ) -> int:
+    if spell_to_colleges is None:
+        spell_to_colleges = _full_spell_to_colleges()
     count = 0
     for tup in traits:
         name = tup[0].title()
@@ -3169,8 +4323,12 @@ def count_spells_starting_with(
 
 
 def count_spells_containing(
-    traits: List[Tuple[str, int, TraitType]], st: str
+    traits: List[Tuple[str, int, TraitType]],
+    st: str,
+    spell_to_colleges: Mapping[str, AbstractSet[str]] = None,
 ) -> int:
+    if spell_to_colleges is None:
+        spell_to_colleges = _full_spell_to_colleges()
     count = 0
     for tup in traits:
         name = tup[0].title()
@@ -3179,7 +4337,12 @@ def count_spells_containing(
     return count
 
 
-def count_spells(traits: List[Tuple[str, int, TraitType]]) -> int:
+def count_spells(
+    traits: List[Tuple[str, int, TraitType]],
+    spell_to_colleges: Mapping[str, AbstractSet[str]] = None,
+) -> int:
+    if spell_to_colleges is None:
+        spell_to_colleges = _full_spell_to_colleges()
     count = 0
     for tup in traits:
         name = tup[0].title()
@@ -3188,851 +4351,1561 @@ def count_spells(traits: List[Tuple[str, int, TraitType]]) -> int:
     return count
 
 
-def _parse_spell_prereq(el: et.Element, function_name: str) -> str:
-    """Parse a <spell_prereq> element and its children.
+def _bare_name(name: str) -> typing.Optional[str]:
+    """Return name without its level, or None if it does not have one."""
+    parsed = _parse_level(name)
+    if parsed is None:
+        return None
+    return parsed[0]
+
 
-    Return a str of Python code that takes traits and trait_names as
-    arguments and evaluates to True iff the prereqs are satisfied.
+class CharacterIndex:
+    """Lookup tables over a character's traits, for evaluating prereqs.
+
+    Names are compared case-insensitively, so everything is stored
+    casefolded.  The tables are kept up to date as traits are added with
+    add(), so prereq checks are lookups rather than scans of the traits.
+    pop() undoes the last add(), for backtracking.
+
+    spell_to_colleges says which traits are spells, and their colleges.
     """
-    if len(el) == 1:
-        child = el[0]
-        if child.tag == "name":
-            if child.get("compare") == "is":
-                return """
-def %s(traits, trait_names):
-    return '''%s''' in trait_names
-""" % (
-                    function_name,
-                    child.text.title(),
-                )
 
-            elif child.get("compare") == "contains":
-                return """
-def %s(traits, trait_names):
-    for trait in trait_names:
-        if '''%s'''.title() in trait.title():
-            return True
-    return False
-""" % (
-                    function_name,
-                    child.text,
+    def __init__(
+        self,
+        traits: typing.Iterable[Tuple[str, int, TraitType]],
+        spell_to_colleges: Mapping[str, AbstractSet[str]],
+    ) -> None:
+        self.spell_to_colleges = spell_to_colleges
+        self.traits: List[Tuple[str, int, TraitType]] = []
+        self.names: Set[str] = set()
+        self.folded_names: Set[str] = set()
+        self._college_counts: typing.Counter[str] = Counter()
+        self._spell_names: List[str] = []
+        # Highest absolute level, and total relative level, by bare name
+        self._absolute_levels: Dict[str, float] = {}
+        self._relative_levels: Dict[str, float] = {}
+        self._levels: Dict[str, float] = {}
+        # What each add() changed, so pop() can undo it
+        self._undo: List[Tuple[bool, typing.Optional[str], typing.Any]] = []
+        for trait in traits:
+            self.add(trait)
+
+    def add(self, trait: Tuple[str, int, TraitType]) -> None:
+        """Add trait to the character."""
+        self.traits.append(trait)
+        name = trait[0]
+        new_name = name not in self.names
+        self.names.add(name)
+        folded = name.casefold()
+        if folded in self.folded_names:
+            self._undo.append((new_name, None, None))
+            return
+        self.folded_names.add(folded)
+        colleges = self.spell_to_colleges.get(name)
+        if colleges is not None:
+            self._spell_names.append(folded)
+            for college in colleges:
+                self._college_counts[college.casefold()] += 1
+        parsed = _parse_level(folded)
+        previous = None
+        if parsed is not None:
+            bare_name, level, relative = parsed
+            previous = (
+                bare_name,
+                self._absolute_levels.get(bare_name),
+                self._relative_levels.get(bare_name),
+                self._levels.get(bare_name),
+            )
+            if relative:
+                self._relative_levels[bare_name] = (
+                    self._relative_levels.get(bare_name, 0) + level
                 )
-
-            elif child.get("compare") == "starts with":
-                return """
-def %s(traits, trait_names):
-    for trait in trait_names:
-        if trait.title().startswith('''%s'''):
-            return True
-    return False
-""" % (
-                    function_name,
-                    child.text.title(),
+            else:
+                self._absolute_levels[bare_name] = max(
+                    self._absolute_levels.get(bare_name, 0), level
                 )
+            self._levels[bare_name] = self._absolute_levels.get(
+                bare_name, 0
+            ) + self._relative_levels.get(bare_name, 0)
+        self._undo.append((new_name, folded, previous))
+
+    def pop(self) -> Tuple[str, int, TraitType]:
+        """Remove the most recently added trait, and return it."""
+        trait = self.traits.pop()
+        new_name, folded, previous = self._undo.pop()
+        if new_name:
+            self.names.discard(trait[0])
+        if folded is None:
+            return trait
+        self.folded_names.discard(folded)
+        colleges = self.spell_to_colleges.get(trait[0])
+        if colleges is not None:
+            self._spell_names.pop()
+            for college in colleges:
+                college = college.casefold()
+                self._college_counts[college] -= 1
+                if not self._college_counts[college]:
+                    del self._college_counts[college]
+        if previous is not None:
+            bare_name = previous[0]
+            for dct, value in zip(
+                (self._absolute_levels, self._relative_levels, self._levels),
+                previous[1:],
+            ):
+                if value is None:
+                    dct.pop(bare_name, None)
+                else:
+                    dct[bare_name] = value
+        return trait
 
-        elif child.tag == "college_count":
-            if child.get("compare") == "at_least":
-                return """
-def %s(traits, trait_names):
-    count = count_spell_colleges(traits)
-    return count >= %d
-""" % (
-                    function_name,
-                    int(child.text),
-                )
+    def college_counts(self) -> typing.Counter[str]:
+        """Return a Counter of casefolded college name to number of
+        spells known from that college."""
+        return self._college_counts
 
-        elif child.tag == "college":
+    def college_count(self) -> int:
+        """Return the number of colleges the character knows spells
+        from."""
+        return len(self._college_counts)
 
-            if child.get("compare") == "contains":
-                return """
-def %s(traits, trait_names):
-    counter = count_spells_from_each_college(traits)
-    for college, quantity in counter.items():
-        if '''%s''' in college.title() and quantity >= 1:
-            return True
-    return False
-""" % (
-                    function_name,
-                    child.text.title(),
-                )
+    def spell_names(self) -> List[str]:
+        """Return the casefolded names of all known spells."""
+        return self._spell_names
 
-            elif child.get("compare") == "is":
-                return """
-def %s(traits, trait_names):
-    counter = count_spells_from_each_college(traits)
-    return counter['''%s'''] >= 1
-""" % (
-                    function_name,
-                    child.text,
-                )
+    def levels(self) -> Dict[str, float]:
+        """Return a dict of casefolded bare trait name to level, for traits
+        like "Magery 3" or "IQ 15".
 
-    elif len(el) == 2:
-        if el.find("college") is not None and el.find("quantity") is not None:
-            college_el = el.find("college")
-            quantity_el = el.find("quantity")
-            if (
-                college_el.get("compare") == "contains"
-                and quantity_el.get("compare") == "at_least"
-            ):
-                return """
-def %s(traits, trait_names):
-    counter = count_spells_from_each_college(traits)
-    return counter['''%s'''] >= %d
-""" % (
-                    function_name,
-                    college_el.text,
-                    int(quantity_el.text),
-                )
+        Relative traits like "IQ +1" add to the level of the base trait.
+        """
+        return self._levels
 
-            elif (
-                college_el.get("compare") == "is"
-                and quantity_el.get("compare") == "at_least"
-            ):
-                return """
-def %s(traits, trait_names):
-    counter = count_spells_from_each_college(traits)
-    return counter['''%s'''] >= %d
-""" % (
-                    function_name,
-                    college_el.text,
-                    int(quantity_el.text),
-                )
 
-        elif el.find("name") is not None and el.find("quantity") is not None:
-            name_el = el.find("name")
-            quantity_el = el.find("quantity")
+class Prereq(abc.ABC):
+    """A node in a tree of prereqs.
 
-            if (
-                name_el.get("compare") == "starts with"
-                and quantity_el.get("compare") == "at_least"
-            ):
-                return """
-def %s(traits, trait_names):
-    return count_spells_starting_with(traits, '''%s''') >= %d
-""" % (
-                    function_name,
-                    name_el.text.title(),
-                    int(quantity_el.text),
-                )
+    evaluate() returns True iff a character, described by a CharacterIndex,
+    satisfies the prereq.  All names are stored casefolded.
 
-            elif (
-                name_el.get("compare") == "is"
-                and quantity_el.get("compare") == "is"
-            ):
-                return """
-def %s(traits, trait_names):
-    return '''%s''' in trait_names
-""" % (
-                    function_name,
-                    name_el.text.title(),
-                )
+    cost is a rough relative cost of evaluate(), used to check cheap
+    prereqs before expensive ones.  Set membership is cheapest; anything
+    that needs college counts or scans every trait name is expensive.
+    """
 
-            elif (
-                name_el.get("compare") == "contains"
-                and quantity_el.get("compare") == "at_least"
-            ):
-                return """
-def %s(traits, trait_names):
-    return count_spells_containing(traits, '''%s''') >= %d
-""" % (
-                    function_name,
-                    name_el.text.title(),
-                    int(quantity_el.text),
-                )
+    __slots__: Tuple[str, ...] = ()
 
-            # XXX This will never be true.  Rider Within (@animal)
-            elif (
-                name_el.get("compare") == "is"
-                and quantity_el.get("compare") == "at_least"
-            ):
-                return """
-def %s(traits, trait_names):
-    count = 0
-    for trait in trait_names:
-        if trait == '''%s''':
-            count += 1
-    return count >= %d
-""" % (
-                    function_name,
-                    name_el.text.title(),
-                    int(quantity_el.text),
-                )
+    @property
+    @abc.abstractmethod
+    def cost(self) -> int:
+        """The relative cost of evaluate()."""
 
-            elif (
-                name_el.get("compare") == "is anything"
-                and quantity_el.get("compare") == "at_least"
-            ):
-                return """
-def %s(traits, trait_names):
-    return count_spells(traits) >= %d
-""" % (
-                    function_name,
-                    int(quantity_el.text),
-                )
+    @abc.abstractmethod
+    def evaluate(self, index: CharacterIndex) -> bool:
+        """Return True iff the character described by index satisfies this
+        prereq."""
 
-        elif el.find("any") is not None and el.find("quantity") is not None:
-            quantity_el = el.find("quantity")
+    def replace_name(self, old: str, new: str) -> "Prereq":
+        """Return a copy of this prereq with trait name old replaced by new."""
+        return self
 
-            if quantity_el.get("compare") == "at_least":
-                return """
-def %s(traits, trait_names):
-    return count_spells(traits) >= %d
-""" % (
-                    function_name,
-                    int(quantity_el.text),
-                )
+    def dependencies(self, names: Mapping[str, AbstractSet[str]]) -> Set[str]:
+        """Return the names whose addition to a character could change
+        whether this prereq is satisfied.
 
-    assert False, "parse_spell_prereq %s" % et.tostring(el)
+        names maps each casefolded trait name that could be added to its
+        casefolded colleges, if it is a spell.
+        """
+        return set()
 
+    def name_keys(self) -> typing.Optional[Set[str]]:
+        """Return casefolded keys for the traits other than spells that
+        could change whether this prereq is satisfied, or None if they
+        cannot be listed.
 
-def _parse_advantage_prereq(el: et.Element, function_name: str) -> str:
-    """Parse a <advantage_prereq> element and its children.
+        A trait matches a key if its whole name, or its name without the
+        level, equals the key or starts with the key and a space.
+        """
+        return set()
 
-    Return a str of Python code that takes traits and trait_names as
-    arguments and evaluates to True iff the prereqs are satisfied.
-    """
-    if el.get("has") == "no":
-        if len(el) == 2:
-            name_el = el.find("name")
-            notes_el = el.find("notes")
-        if (
-            name_el is not None
-            and name_el.get("compare") == "starts with"
-            and notes_el is not None
-            and notes_el.get("compare") == "is anything"
-        ):
-            return """
-def %s(traits, trait_names):
-    for trait_name in trait_names:
-        if trait_name.title().startswith('''%s'''.title()):
-            return False
-    return True
-""" % (
-                function_name,
-                name_el.text.title(),
-            )
+    def _fields(self) -> Tuple:
+        return tuple(getattr(self, slot) for slot in self.__slots__)
 
-        elif (
-            name_el is not None
-            and name_el.get("compare") == "is"
-            and notes_el is not None
-            and notes_el.get("compare") == "is anything"
-        ):
-            return """
-def %s(traits, trait_names):
-    for trait_name in trait_names:
-        if trait_name.title() == '''%s'''.title():
+    def __eq__(self, other: object) -> bool:
+        if type(self) is not type(other):
             return False
-    return True
-""" % (
-                function_name,
-                name_el.text.title(),
-            )
+        return self._fields() == typing.cast(Prereq, other)._fields()
 
-        elif (
-            name_el is not None
-            and name_el.get("compare") == "contains"
-            and notes_el is not None
-            and notes_el.get("compare") == "is anything"
-        ):
-            return """
-def %s(traits, trait_names):
-    for trait_name in trait_names:
-        if '''%s'''.title() in trait_name.title():
-            return False
-    return True
-""" % (
-                function_name,
-                name_el.text.title(),
-            )
+    def __hash__(self) -> int:
+        return hash((type(self).__name__, self._fields()))
 
-    elif len(el) == 3:
-        name_el = el.find("name")
-        level_el = el.find("level")
-        notes_el = el.find("notes")
-        if (
-            name_el is not None
-            and name_el.get("compare") == "is"
-            and level_el is not None
-            and level_el.get("compare") == "at_least"
-            and notes_el is not None
-            and notes_el.get("compare") == "is anything"
-        ):
-            return """
-def %s(traits, trait_names):
-    for trait in trait_names:
-        if trait.startswith('''%s'''):
-            regexp = "(\d+).*$"
-            match = re.search(regexp, trait)
-            if match:
-                level = int(match.group(1))
-                return level >= int('''%s''')
-    return False
-""" % (
-                function_name,
-                name_el.text.title(),
-                level_el.text,
-            )
+    def __repr__(self) -> str:
+        return "%s(%s)" % (
+            type(self).__name__,
+            ", ".join(repr(field) for field in self._fields()),
+        )
 
-        elif (
-            name_el is not None
-            and name_el.get("compare") == "is"
-            and level_el is not None
-            and level_el.get("compare") == "at_least"
-            and notes_el is not None
-            and notes_el.get("compare") == "contains"
-        ):
-            return """
-def %s(traits, trait_names):
-    for trait in trait_names:
-        if trait.startswith('''%s''') and '''%s''' in trait:
-            regexp = "(\d+).*$"
-            match = re.search(regexp, trait)
-            if match:
-                level = int(match.group(1))
-                return level >= int('''%s''')
-    return False
-""" % (
-                function_name,
-                name_el.text.title(),
-                notes_el.text,
-                level_el.text,
-            )
 
-        elif (
-            name_el is not None
-            and name_el.get("compare") == "is"
-            and level_el is not None
-            and level_el.get("compare") == "at_least"
-            and notes_el is not None
-            and notes_el.get("compare") == "does not contain"
-        ):
-            return """
-def %s(traits, trait_names):
-    for trait in trait_names:
-        if trait.startswith('''%s''') and '''%s''' not in trait:
-            regexp = "(\d+).*$"
-            match = re.search(regexp, trait)
-            if match:
-                level = int(match.group(1))
-                return level >= int('''%s''')
-    return False
-""" % (
-                function_name,
-                name_el.text.title(),
-                notes_el.text,
-                level_el.text,
-            )
+class AllOf(Prereq):
+    """Satisfied iff all of children are.  Satisfied if there are none."""
 
-        elif (
-            name_el is not None
-            and name_el.get("compare") == "contains"
-            and level_el is not None
-            and level_el.get("compare") == "at_least"
-            and notes_el is not None
-            and notes_el.get("compare") == "is anything"
-        ):
-            return """
-def %s(traits, trait_names):
-    for trait in trait_names:
-        if '''%s''' in trait:
-            regexp = "(\d+).*$"
-            match = re.search(regexp, trait)
-            if match:
-                level = int(match.group(1))
-                return level >= int('''%s''')
-    return False
-""" % (
-                function_name,
-                name_el.text.title(),
-                level_el.text,
-            )
+    __slots__ = ("children",)
 
-    elif len(el) == 2:
-        name_el = el.find("name")
-        notes_el = el.find("notes")
-        if (
-            name_el is not None
-            and name_el.get("compare") == "is"
-            and notes_el is not None
-            and notes_el.get("compare") == "is anything"
-        ):
-            return """
-def %s(traits, trait_names):
-    return '''%s''' in trait_names
-""" % (
-                function_name,
-                name_el.text.title(),
-            )
+    def __init__(self, children: typing.Iterable[Prereq]) -> None:
+        self.children = tuple(children)
 
-        elif (
-            name_el is not None
-            and name_el.get("compare") == "starts with"
-            and notes_el is not None
-            and notes_el.get("compare") == "contains"
-        ):
-            return """
-def %s(traits, trait_names):
-    for trait_name in trait_names:
-        if (trait_name.title().startswith('''%s'''.title()) and
-          '''%s''' in trait_name.title()):
-            return True
-    return False
-""" % (
-                function_name,
-                name_el.text.title(),
-                notes_el.text,
-            )
+    def evaluate(self, index: CharacterIndex) -> bool:
+        for child in self.children:
+            if not child.evaluate(index):
+                return False
+        return True
 
-        elif (
-            name_el is not None
-            and name_el.get("compare") == "contains"
-            and notes_el is not None
-            and notes_el.get("compare") == "is anything"
-        ):
-            return """
-def %s(traits, trait_names):
-    for trait_name in trait_names:
-        if '''%s'''.title() in trait_name.title():
-            return True
-    return False
-""" % (
-                function_name,
-                name_el.text.title(),
-            )
+    @property
+    def cost(self) -> int:
+        return sum(child.cost for child in self.children)
 
-    assert False, "parse_advantage_prereq %s" % et.tostring(el)
+    def replace_name(self, old: str, new: str) -> Prereq:
+        return AllOf(child.replace_name(old, new) for child in self.children)
 
+    def dependencies(self, names: Mapping[str, AbstractSet[str]]) -> Set[str]:
+        result: Set[str] = set()
+        for child in self.children:
+            result.update(child.dependencies(names))
+        return result
 
-def _parse_attribute_prereq(el: et.Element, function_name: str) -> str:
-    """Parse a <attribute_prereq> element and its children.
+    def name_keys(self) -> typing.Optional[Set[str]]:
+        result: Set[str] = set()
+        for child in self.children:
+            keys = child.name_keys()
+            if keys is None:
+                return None
+            result.update(keys)
+        return result
 
-    Return a str of Python code that takes traits and trait_names as
-    arguments and evaluates to True iff the prereqs are satisfied.
-    """
-    attr = el.get("which")
-    compare = el.get("compare")
-    level = int(el.text)
-    if compare == "at_least":
-        return """
-def %s(traits, trait_names):
-    for trait in trait_names:
-        if trait.startswith('''%s '''):
-            regexp = "(\d+).*$"
-            match = re.search(regexp, trait)
-            if match:
-                level = int(match.group(1))
-                return level >= %d
-    return False
-""" % (
-            function_name,
-            attr.upper(),
-            level,
-        )
-    assert False, "parse_attribute_prereq %s" % et.tostring(el)
 
+class AnyOf(Prereq):
+    """Satisfied iff any of children are.  Never satisfied if there are
+    none."""
 
-def _parse_skill_prereq(el: et.Element, function_name: str) -> str:
-    """Parse a <skill_prereq> element and its children.
+    __slots__ = ("children",)
 
-    Return a str of Python code that takes traits and trait_names as
-    arguments and evaluates to True iff the prereqs are satisfied.
-    """
-    if len(el) == 3:
-        name_el = el.find("name")
-        level_el = el.find("level")
-        specialization_el = el.find("specialization")
-        if (
-            name_el is not None
-            and name_el.get("compare") == "is"
-            and level_el is not None
-            and level_el.get("compare") == "at_least"
-            and specialization_el is not None
-            and specialization_el.get("compare") == "is anything"
-        ):
-            return """
-def %s(traits, trait_names):
-    for trait in trait_names:
-        if trait.startswith('''%s'''):
-            regexp = "(\d+).*$"
-            match = re.search(regexp, trait)
-            if match:
-                level = int(match.group(1))
-                return level >= int('''%s''')
-    return False
-""" % (
-                function_name,
-                name_el.text.title(),
-                level_el.text,
-            )
+    def __init__(self, children: typing.Iterable[Prereq]) -> None:
+        self.children = tuple(children)
 
-    elif len(el) == 2:
-        name_el = el.find("name")
-        specialization_el = el.find("specialization")
-        if (
-            name_el is not None
-            and name_el.get("compare") == "is"
-            and specialization_el is not None
-            and specialization_el.get("compare") == "is anything"
-        ):
-            return """
-def %s(traits, trait_names):
-    return '''%s''' in trait_names
-""" % (
-                function_name,
-                name_el.text.title(),
-            )
+    def evaluate(self, index: CharacterIndex) -> bool:
+        for child in self.children:
+            if child.evaluate(index):
+                return True
+        return False
 
-    assert False, "parse_skill_prereq %s" % et.tostring(el)
+    @property
+    def cost(self) -> int:
+        return sum(child.cost for child in self.children)
 
+    def replace_name(self, old: str, new: str) -> Prereq:
+        return AnyOf(child.replace_name(old, new) for child in self.children)
 
-and_or = """
-def and_(*args):
-    for arg in args:
-        if not arg:
-            return False
-    return True
+    def dependencies(self, names: Mapping[str, AbstractSet[str]]) -> Set[str]:
+        result: Set[str] = set()
+        for child in self.children:
+            result.update(child.dependencies(names))
+        return result
 
+    def name_keys(self) -> typing.Optional[Set[str]]:
+        result: Set[str] = set()
+        for child in self.children:
+            keys = child.name_keys()
+            if keys is None:
+                return None
+            result.update(keys)
+        return result
 
-def or_(*args):
-    for arg in args:
-        if arg:
-            return True
-    return False
-"""
 
+class Not(Prereq):
+    """Satisfied iff child is not."""
 
-function_name_incrementor = 0
+    __slots__ = ("child",)
 
+    def __init__(self, child: Prereq) -> None:
+        self.child = child
 
-def _parse_prereq_list(prereq_list_el: et.Element, top_name: str) -> str:
-    global function_name_incrementor
-    sts = []
-    sts.append(and_or)
-    function_names = []
-    for child in prereq_list_el:
-        if child.tag == "prereq_list":
-            function_name = "top_%d" % function_name_incrementor
-            function_name_incrementor += 1
-            function_names.append(function_name)
-            st = _parse_prereq_list(child, function_name)
-        else:
-            function_name = "ppl_%d" % function_name_incrementor
-            function_name_incrementor += 1
-            function_names.append(function_name)
-            if child.tag == "spell_prereq":
-                st = _parse_spell_prereq(child, function_name)
-            elif child.tag == "advantage_prereq":
-                st = _parse_advantage_prereq(child, function_name)
-            elif child.tag == "attribute_prereq":
-                st = _parse_attribute_prereq(child, function_name)
-            elif child.tag == "skill_prereq":
-                st = _parse_skill_prereq(child, function_name)
-            else:
-                assert False, "unknown child tag %s" % child.tag
-        sts.append(st)
-    if prereq_list_el.get("all") == "yes":
-        joiner = "and_"
-    else:
-        joiner = "or_"
-    function_names_with_args = [
-        function_name
-        if "top" in function_name
-        else "%s(traits, trait_names)" % function_name
-        for function_name in function_names
-    ]
-    call_line = "%s = %s(%s)" % (
-        top_name,
-        joiner,
-        ", ".join(function_names_with_args),
-    )
-    sts.append(call_line)
-    sts.append("")
-    blob = "\n".join(sts)
-    return blob
-
-
-def _parse_no_prereqs(prereq_list_el: et.Element, top_name: str) -> str:
-    """Return the text of a function that always returns True."""
-    global function_name_incrementor
-    function_name = "pnp_%s" % function_name_incrementor
-    function_name_incrementor += 1
-    return """
-def %s(traits, trait_names):
-    return True
+    def evaluate(self, index: CharacterIndex) -> bool:
+        return not self.child.evaluate(index)
 
-%s = True""" % (
-        function_name,
-        top_name,
-    )
+    @property
+    def cost(self) -> int:
+        return self.child.cost
 
+    def replace_name(self, old: str, new: str) -> Prereq:
+        return Not(self.child.replace_name(old, new))
 
-def build_spell_prereqs(allowed_colleges: Set[str] = None) -> None:
-    """Fill in global dicts spell_to_colleges and spell_to_prereq_function."""
-    global spell_to_colleges
-    spell_to_colleges = {}
-    global spell_to_prereq_function
-    spell_to_prereq_function = {}
-    dirname = os.path.dirname(__file__)
-    filename = "Library__L.glb"
-    path = os.path.abspath(os.path.join(dirname, filename))
-    tree = et.parse(path)
-    root_el = tree.getroot()
-    spell_list_el = root_el.find("spell_list")
-    for spell_el in spell_list_el.findall("spell"):
-        name = spell_el.find("name").text
-        if name not in allowed_spells:
-            continue
-        categories_el = spell_el.find("categories")
-        colleges = set()
-        for category_el in categories_el:
-            college = category_el.text
-            colleges.add(college)
-        if allowed_colleges and not colleges.intersection(allowed_colleges):
-            continue
-        spell_to_colleges[name] = colleges
-        prereq_list_el = spell_el.find("prereq_list")
+    def dependencies(self, names: Mapping[str, AbstractSet[str]]) -> Set[str]:
+        return self.child.dependencies(names)
 
-        global function_name_incrementor
-        top_name = "top_%d" % function_name_incrementor
-        function_name_incrementor += 1
+    def name_keys(self) -> typing.Optional[Set[str]]:
+        return self.child.name_keys()
 
-        if prereq_list_el is None:
-            blob = _parse_no_prereqs(prereq_list_el, top_name)
-        else:
-            blob = _parse_prereq_list(prereq_list_el, top_name)
-        spell_to_prereq_function[name] = blob
-
-
-def add_special_bard_skills_to_spell_prereqs() -> None:
-    """Add special bard skills to spell_to_colleges and
-    spell_to_prereq_function."""
-    global spell_to_colleges
-    global spell_to_prereq_function
-    special_skills = {
-        "Hypnotism",
-        "Musical Influence",
-        "Persuade",
-        "Suggest",
-        "Sway Emotions",
-        "Captivate",
-    }
-    dirname = os.path.dirname(__file__)
-    filename = "Library__L.glb"
-    path = os.path.abspath(os.path.join(dirname, filename))
-    tree = et.parse(path)
-    root_el = tree.getroot()
-    skill_list_el = root_el.find("skill_list")
-    for skill_el in skill_list_el.findall("spell"):
-        name = skill_el.find("name").text
-        if name not in special_skills:
-            continue
-        prereq_list_el = skill_el.find("prereq_list")
-        global function_name_incrementor
-        top_name = "top_%d" % function_name_incrementor
-        function_name_incrementor += 1
-        if prereq_list_el is None:
-            blob = _parse_no_prereqs(prereq_list_el, top_name)
-        else:
-            blob = _parse_prereq_list(prereq_list_el, top_name)
-        spell_to_prereq_function[name] = blob
 
+class NameIs(Prereq):
+    """Satisfied iff the character has a trait called name."""
 
-def convert_magery_to_bardic_talent() -> None:
-    """Bards treat Bardic Talent as Magery for their prereqs."""
-    global spell_to_prereq_function
-    for spell, blob in spell_to_prereq_function.items():
-        if "magery" in blob:
-            blob2 = blob.replace("magery", "bardic talent")
-            spell_to_prereq_function[spell] = blob2
+    __slots__ = ("name",)
+    cost = 1
 
+    def __init__(self, name: str) -> None:
+        self.name = name.casefold()
 
-def prereq_satisfied(
-    spell: str, traits: List[Tuple[str, int, TraitType]]
-) -> bool:
-    """Return True iff any prereqs for spell are satisfied."""
-    trait_names = set((trait[0] for trait in traits))
-    blob = spell_to_prereq_function.get(spell)
-    if blob is None:
-        return True
-    lines = blob.strip().split("\n")
-    tokens = lines[-1].strip().split()
-    top_name = tokens[0]
-    nsg = globals()
-    nsl = locals()
-    exec(blob, nsg, nsl)
-    return bool(nsl[top_name])
+    def evaluate(self, index: CharacterIndex) -> bool:
+        return self.name in index.folded_names
 
+    def replace_name(self, old: str, new: str) -> Prereq:
+        if self.name == old.casefold():
+            return NameIs(new)
+        return self
 
-def add_spell(
-    traits: List[Tuple[str, int, TraitType]], trait_names: Set[str]
-) -> None:
-    """Add one spell to traits, at the one-point level."""
-    while True:
-        spell = random.choice(list(spell_to_prereq_function.keys()))
-        if spell in trait_names:
-            continue
-        if prereq_satisfied(spell, traits):
-            traits.append((spell, 1, SP))
-            trait_names.add(spell)
-            return
+    def dependencies(self, names: Mapping[str, AbstractSet[str]]) -> Set[str]:
+        if self.name in names:
+            return {self.name}
+        return set()
 
+    def name_keys(self) -> typing.Optional[Set[str]]:
+        return {self.name}
 
-# TODO support multiple languages
-# Maybe language as leveled 1-30 or 2-30, then split it up
-def generate_wizard() -> List[Tuple[str, int, TraitType]]:
-    traits = [
-        ("ST 10", 0, PA),
-        ("DX 12", 40, PA),
-        ("IQ 15", 100, PA),
-        ("HT 11", 10, PA),
-        ("HP 10", 0, SA),
-        ("Will 15", 0, SA),
-        ("Per 12", -15, SA),
-        ("FP 14", 9, SA),
-        ("Basic Speed 6.0", 5, SA),
-        ("Basic Move 6", 0, SA),
-        ("Magery 3", 35, AD),
-        ("Occultism", 2, SK),
-        ("Alchemy", 8, SK),
-        ("Thaumatology", 1, SK),
-        ("Hazardous Materials (Magical)", 1, SK),
-        ("Research", 1, SK),
-        ("Speed-Reading", 1, SK),
-        ("Teaching", 1, SK),
-        ("Writing", 1, SK),
-        ("Meditation", 2, SK),
-    ]
 
-    build_spell_prereqs()
-
-    ads1 = [
-        [("DX +1", 20, PA)],
-        [("IQ +1", 20, PA)],
-        list_levels("Will +%d", 5, SA, 5),
-        list_levels("FP +%d", 3, SA, 10),
-        [("Eidetic Memory", 5, AD), ("Photographic Memory", 10, AD)],
-        list_levels("Gizmos %d", 5, AD, 3),
-        [("Intuition", 15, AD)],
-        [("Language Talent", 10, AD)],
-        [("Language (Spoken: Broken / Written: None)", 1, AD)],
-        [("Language (Spoken: None / Written: Broken)", 1, AD)],
-        [("Language (Spoken: Accented / Written: None)", 2, AD)],
-        [("Language (Spoken: Broken / Written: Broken)", 2, AD)],
-        [("Language (Spoken: None / Written: Accented)", 2, AD)],
-        [("Language (Spoken: Native / Written: None)", 3, AD)],
-        [("Language (Spoken: Accented / Written: Broken)", 3, AD)],
-        [("Language (Spoken: Broken / Written: Accented)", 3, AD)],
-        [("Language (Spoken: None / Written: Native)", 3, AD)],
-        [("Language (Spoken: Native / Written: Broken)", 4, AD)],
-        [("Language (Spoken: Accented / Written: Accented)", 4, AD)],
-        [("Language (Spoken: Broken / Written: Native)", 4, AD)],
-        [("Language (Spoken: Native / Written: Accented)", 5, AD)],
-        [("Language (Spoken: Accented / Written: Native)", 5, AD)],
-        [("Language (Spoken: Native / Written: Native)", 6, AD)],
-        [("Luck", 15, AD), ("Extraordinary Luck", 30, AD)],
-        list_levels("Magery %d", 10, AD, 3, min_level=4),
-        list_levels("Mind Shield %d", 4, AD, 5),
-        list_levels("Signature Gear %d", 1, AD, 10),
-        [("Spirit Empathy", 10, AD)],
-        [("Wild Talent 1 (Retention, Focused, Magical)", 21, AD)],
-    ]
-    traits.extend(pick_from_list(ads1, 30))
+class NameStartsWith(Prereq):
+    """Satisfied iff the character has a trait whose name starts with prefix
+    and contains contains."""
 
-    fix_language_talent(traits)
-    # TODO If that lowered any costs take more advantages
+    __slots__ = ("prefix", "contains")
+    cost = 6
 
-    disads1 = [
-        list_self_control_levels("Curious", -5),
-        [("Frightens Animals", -10, DI)],
-        list_self_control_levels(
-            "Obsession (Become the world's most powerful wizard, a lich, etc.)",
-            -10,
-        ),
-        list_self_control_levels("Pyromania", -5),
-        [("Skinny", -5, DI)],
-        [("Social Stigma (Excommunicated)", -10, DI)],
-        [("Unfit", -5, DI), ("Very Unfit", -15, DI)],
-        list_levels("Unnatural Features %d", -1, DI, 5),
-        [("Weirdness Magnet", -15, DI)],
-    ]
-    traits.extend(pick_from_list(disads1, -15))
-
-    disads2 = [
-        [("Absent-Mindedness", -15, DI)],
-        list_self_control_levels("Bad Temper", -10),
-        [("Clueless", -10, DI)],
-        [("Combat Paralysis", -15, DI)],
-        list_self_control_levels("Cowardice", -10),
-        [("Hard of Hearing", -15, DI)],
-        [("Klutz", -5, DI), ("Total Klutz", -15, DI)],
-        list_self_control_levels("Loner", -5),
-        [("Low Pain Threshold", -10, DI)],
-        [("Nervous Stomach", -1, DI)],
-        [("Oblivious", -5, DI)],
-        list_self_control_levels("Overconfidence", -5),
-        list_self_control_levels("Post-Combat Shakes", -5),
-        [("Sense of Duty (Adventuring companions)", -5, DI)],
-        [("Stubbornness", -5, DI)],
-    ]
-    disads2.extend(disads1)
-    traits.extend(pick_from_list(disads2, -20))
-
-    skills1 = [
-        [
-            ("Hidden Lore (Demons)", 2, SK),
-            ("Hidden Lore (Magic Items)", 2, SK),
-            ("Hidden Lore (Magical Writings)", 2, SK),
-            ("Hidden Lore (Spirits)", 2, SK),
-        ]
-    ]
-    traits.extend(pick_from_list(skills1, 2))
+    def __init__(self, prefix: str, contains: str = "") -> None:
+        self.prefix = prefix.casefold()
+        self.contains = contains.casefold()
 
-    skills2 = [
-        [("Smallsword", 4, SK)],
-        [("Shield (Buckler)", 4, SK)],
-        [("Staff", 8, SK)],
-    ]
-    traits.extend(pick_from_list(skills2, 8))
+    def evaluate(self, index: CharacterIndex) -> bool:
+        for name in index.folded_names:
+            if name.startswith(self.prefix) and self.contains in name:
+                return True
+        return False
+
+    def dependencies(self, names: Mapping[str, AbstractSet[str]]) -> Set[str]:
+        return set(
+            name
+            for name in names
+            if name.startswith(self.prefix) and self.contains in name
+        )
+
+    def name_keys(self) -> typing.Optional[Set[str]]:
+        return None
+
+
+class NameContains(Prereq):
+    """Satisfied iff the character has a trait whose name contains text."""
+
+    __slots__ = ("text",)
+    cost = 6
+
+    def __init__(self, text: str) -> None:
+        self.text = text.casefold()
+
+    def evaluate(self, index: CharacterIndex) -> bool:
+        for name in index.folded_names:
+            if self.text in name:
+                return True
+        return False
+
+    def dependencies(self, names: Mapping[str, AbstractSet[str]]) -> Set[str]:
+        return set(name for name in names if self.text in name)
+
+    def name_keys(self) -> typing.Optional[Set[str]]:
+        return None
+
+
+class SpellQuantity(Prereq):
+    """Satisfied iff the character knows at least quantity spells whose
+    names start with prefix and contain contains."""
+
+    __slots__ = ("quantity", "prefix", "contains")
+    cost = 6
+
+    def __init__(
+        self, quantity: int, prefix: str = "", contains: str = ""
+    ) -> None:
+        self.quantity = quantity
+        self.prefix = prefix.casefold()
+        self.contains = contains.casefold()
+
+    def evaluate(self, index: CharacterIndex) -> bool:
+        count = 0
+        for name in index.spell_names():
+            if name.startswith(self.prefix) and self.contains in name:
+                count += 1
+                if count >= self.quantity:
+                    return True
+        return count >= self.quantity
+
+    def dependencies(self, names: Mapping[str, AbstractSet[str]]) -> Set[str]:
+        return set(
+            name
+            for name, colleges in names.items()
+            if colleges
+            and name.startswith(self.prefix)
+            and self.contains in name
+        )
+
+
+class CollegeCount(Prereq):
+    """Satisfied iff the character knows spells from at least count
+    different colleges."""
+
+    __slots__ = ("count",)
+    cost = 5
+
+    def __init__(self, count: int) -> None:
+        self.count = count
+
+    def evaluate(self, index: CharacterIndex) -> bool:
+        return index.college_count() >= self.count
+
+    def dependencies(self, names: Mapping[str, AbstractSet[str]]) -> Set[str]:
+        return set(name for name, colleges in names.items() if colleges)
+
+
+class QuantityInCollege(Prereq):
+    """Satisfied iff the character knows at least quantity spells from
+    college.
+
+    If contains is True then any college whose name contains college
+    counts.
+    """
+
+    __slots__ = ("college", "quantity", "contains")
+    cost = 5
+
+    def __init__(
+        self, college: str, quantity: int, contains: bool = False
+    ) -> None:
+        self.college = college.casefold()
+        self.quantity = quantity
+        self.contains = contains
+
+    def evaluate(self, index: CharacterIndex) -> bool:
+        college_counts = index.college_counts()
+        if not self.contains:
+            return college_counts[self.college] >= self.quantity
+        count = 0
+        for college, quantity in college_counts.items():
+            if self.college in college:
+                count += quantity
+        return count >= self.quantity
+
+    def dependencies(self, names: Mapping[str, AbstractSet[str]]) -> Set[str]:
+        if not self.contains:
+            return set(
+                name
+                for name, colleges in names.items()
+                if self.college in colleges
+            )
+        return set(
+            name
+            for name, colleges in names.items()
+            if any(self.college in college for college in colleges)
+        )
+
+
+class LevelAtLeast(Prereq):
+    """Satisfied iff the character has a leveled trait like "Magery 3" of at
+    least level.
+
+    If contains is True then the bare trait name only needs to contain
+    name.  notes_contains and notes_excludes are text that the bare trait
+    name must or must not contain.
+    """
+
+    __slots__ = (
+        "name",
+        "level",
+        "contains",
+        "notes_contains",
+        "notes_excludes",
+    )
+    cost = 2
+
+    def __init__(
+        self,
+        name: str,
+        level: int,
+        contains: bool = False,
+        notes_contains: str = "",
+        notes_excludes: str = "",
+    ) -> None:
+        self.name = name.casefold()
+        self.level = level
+        self.contains = contains
+        self.notes_contains = notes_contains.casefold()
+        self.notes_excludes = notes_excludes.casefold()
+
+    def _matches(self, bare_name: str) -> bool:
+        if self.contains:
+            if self.name not in bare_name:
+                return False
+        elif bare_name != self.name and not bare_name.startswith(
+            self.name + " "
+        ):
+            return False
+        if self.notes_contains not in bare_name:
+            return False
+        if self.notes_excludes and self.notes_excludes in bare_name:
+            return False
+        return True
+
+    def evaluate(self, index: CharacterIndex) -> bool:
+        for bare_name, level in index.levels().items():
+            if level >= self.level and self._matches(bare_name):
+                return True
+        return False
+
+    def dependencies(self, names: Mapping[str, AbstractSet[str]]) -> Set[str]:
+        result = set()
+        for name in names:
+            bare_name = _bare_name(name)
+            if bare_name is not None and self._matches(bare_name):
+                result.add(name)
+        return result
+
+    def name_keys(self) -> typing.Optional[Set[str]]:
+        if self.contains:
+            return None
+        return {self.name}
+
+    def replace_name(self, old: str, new: str) -> Prereq:
+        if self.name == old.casefold():
+            return LevelAtLeast(
+                new,
+                self.level,
+                self.contains,
+                self.notes_contains,
+                self.notes_excludes,
+            )
+        return self
 
-    skills3 = [
-        [("Innate Attack (any)", 4, SK)],
-        [("Thrown Weapon (Dart)", 4, SK)],
-        [("Throwing", 4, SK)],
-        [("Sling", 4, SK)],
-    ]
-    traits.extend(pick_from_list(skills3, 4))
-
-    skills4 = [
-        [("Fast-Draw (Potion)", 1, SK)],
-        [("Climbing", 1, SK)],
-        [("Stealth", 1, SK)],
-        [("Body Sense", 1, SK)],
-        [("First Aid", 1, SK)],
-        [("Gesture", 1, SK)],
-        [("Savoir-Faire (High Society)", 1, SK)],
-        [("Cartography", 1, SK)],
-        [("Hidden Lore (Demons)", 1, SK)],
-        [("Hidden Lore (Magic Items)", 1, SK)],
-        [("Hidden Lore (Magical Writings)", 1, SK)],
-        [("Hidden Lore (Spirits)", 1, SK)],
-        [("Diplomacy", 1, SK)],
-        [("Physiology (monster type)", 1, SK)],
-        [("Strategy", 1, SK)],
-        [("Hiking", 1, SK)],
-        [("Scrounging", 1, SK)],
-    ]
-    # Remove duplicate Hidden Lore
-    trait_names = set((trait[0] for trait in traits))
-    for trait_name in trait_names:
-        if [(trait_name, 1, SK)] in skills4:
-            skills4.remove([(trait_name, 1, SK)])
-    traits.extend(pick_from_list(skills4, 9))
 
+# Relative skill level of each difficulty, at one point
+_difficulty_to_modifier = {"E": 0, "A": -1, "H": -2, "VH": -3}
+
+
+def skill_level(
+    attribute_level: float, difficulty: str, points: int
+) -> float:
+    """Return the level of a skill of difficulty, like "IQ/H", bought with
+    points, for a character with attribute_level in its attribute."""
+    modifier = _difficulty_to_modifier[difficulty.split("/")[1]]
+    if points < 2:
+        bonus = 0
+    elif points < 4:
+        bonus = 1
+    elif points < 8:
+        bonus = 2
+    else:
+        bonus = 3 + (points - 8) // 4
+    return attribute_level + modifier + bonus
+
+
+class SkillLevelAtLeast(Prereq):
+    """Satisfied iff the character has a skill called name, or starting
+    with name if prefix is True, of at least level.
+
+    difficulty is the skill's, like "IQ/H".  The skill's level comes from
+    its points and the level of its attribute, which is 10 if the
+    character does not list it.
+    """
+
+    __slots__ = ("name", "level", "difficulty", "prefix")
+    cost = 6
+
+    def __init__(
+        self, name: str, level: int, difficulty: str, prefix: bool = False
+    ) -> None:
+        self.name = name.casefold()
+        self.level = level
+        self.difficulty = difficulty
+        self.prefix = prefix
+
+    def _matches(self, name: str) -> bool:
+        if self.prefix:
+            return name.startswith(self.name)
+        return name == self.name or name.startswith(self.name + " (")
+
+    def _attribute(self) -> str:
+        return self.difficulty.split("/")[0].casefold()
+
+    def evaluate(self, index: CharacterIndex) -> bool:
+        attribute_level = index.levels().get(self._attribute(), 10)
+        for name, points, unused in index.traits:
+            if self._matches(name.casefold()):
+                level = skill_level(attribute_level, self.difficulty, points)
+                if level >= self.level:
+                    return True
+        return False
+
+    def dependencies(self, names: Mapping[str, AbstractSet[str]]) -> Set[str]:
+        attribute = self._attribute()
+        return set(
+            name
+            for name in names
+            if self._matches(name) or _bare_name(name) == attribute
+        )
+
+    def name_keys(self) -> typing.Optional[Set[str]]:
+        if self.prefix:
+            return None
+        return {self.name, self._attribute()}
+
+
+def _build_spell_prereq(el: et.Element) -> Prereq:
+    """Build a Prereq tree from a <spell_prereq> element and its children."""
+    if len(el) == 1:
+        child = el[0]
+        if child.tag == "name":
+            if child.get("compare") == "is":
+                return NameIs(child.text)
+            elif child.get("compare") == "contains":
+                return NameContains(child.text)
+            elif child.get("compare") == "starts with":
+                return NameStartsWith(child.text)
+
+        elif child.tag == "college_count":
+            if child.get("compare") == "at_least":
+                return CollegeCount(int(child.text))
+
+        elif child.tag == "college":
+            if child.get("compare") == "contains":
+                return QuantityInCollege(child.text, 1, contains=True)
+            elif child.get("compare") == "is":
+                return QuantityInCollege(child.text, 1)
+
+    elif len(el) == 2:
+        if el.find("college") is not None and el.find("quantity") is not None:
+            college_el = el.find("college")
+            quantity_el = el.find("quantity")
+            if quantity_el.get("compare") == "at_least":
+                if college_el.get("compare") == "contains":
+                    return QuantityInCollege(
+                        college_el.text, int(quantity_el.text), contains=True
+                    )
+                elif college_el.get("compare") == "is":
+                    return QuantityInCollege(
+                        college_el.text, int(quantity_el.text)
+                    )
+
+        elif el.find("name") is not None and el.find("quantity") is not None:
+            name_el = el.find("name")
+            quantity_el = el.find("quantity")
+            name_compare = name_el.get("compare")
+            quantity_compare = quantity_el.get("compare")
+
+            if name_compare == "is" and quantity_compare == "is":
+                return NameIs(name_el.text)
+            elif quantity_compare == "at_least":
+                quantity = int(quantity_el.text)
+                if name_compare == "starts with":
+                    return SpellQuantity(quantity, prefix=name_el.text)
+                elif name_compare == "contains":
+                    return SpellQuantity(quantity, contains=name_el.text)
+                elif name_compare == "is anything":
+                    return SpellQuantity(quantity)
+                # XXX This will never be true for quantities above 1.
+                # Rider Within (@animal)
+                elif name_compare == "is":
+                    if quantity <= 1:
+                        return NameIs(name_el.text)
+                    return AnyOf(())
+
+        elif el.find("any") is not None and el.find("quantity") is not None:
+            quantity_el = el.find("quantity")
+            if quantity_el.get("compare") == "at_least":
+                return SpellQuantity(int(quantity_el.text))
+
+    assert False, "build_spell_prereq %s" % et.tostring(el)
+
+
+def _build_advantage_prereq(el: et.Element) -> Prereq:
+    """Build a Prereq tree from an <advantage_prereq> element and its
+    children."""
+    name_el = el.find("name")
+    level_el = el.find("level")
+    notes_el = el.find("notes")
+    name_compare = name_el.get("compare") if name_el is not None else None
+    notes_compare = notes_el.get("compare") if notes_el is not None else None
+
+    if el.get("has") == "no":
+        if len(el) == 2 and notes_compare == "is anything":
+            if name_compare == "starts with":
+                return Not(NameStartsWith(name_el.text))
+            elif name_compare == "is":
+                return Not(NameIs(name_el.text))
+            elif name_compare == "contains":
+                return Not(NameContains(name_el.text))
+
+    elif len(el) == 3:
+        if level_el is not None and level_el.get("compare") == "at_least":
+            level = int(level_el.text)
+            if name_compare == "is":
+                if notes_compare == "is anything":
+                    return LevelAtLeast(name_el.text, level)
+                elif notes_compare == "contains":
+                    return LevelAtLeast(
+                        name_el.text, level, notes_contains=notes_el.text
+                    )
+                elif notes_compare == "does not contain":
+                    return LevelAtLeast(
+                        name_el.text, level, notes_excludes=notes_el.text
+                    )
+            elif name_compare == "contains" and notes_compare == "is anything":
+                return LevelAtLeast(name_el.text, level, contains=True)
+
+    elif len(el) == 2:
+        if name_compare == "is" and notes_compare == "is anything":
+            return NameIs(name_el.text)
+        elif name_compare == "starts with" and notes_compare == "contains":
+            return NameStartsWith(name_el.text, contains=notes_el.text)
+        elif name_compare == "contains" and notes_compare == "is anything":
+            return NameContains(name_el.text)
+
+    assert False, "build_advantage_prereq %s" % et.tostring(el)
+
+
+def _build_attribute_prereq(el: et.Element) -> Prereq:
+    """Build a Prereq tree from an <attribute_prereq> element."""
+    if el.get("compare") == "at_least":
+        return LevelAtLeast(el.get("which"), int(el.text))
+    assert False, "build_attribute_prereq %s" % et.tostring(el)
+
+
+def _build_skill_prereq(
+    el: et.Element, skill_to_difficulty: Mapping[str, str]
+) -> Prereq:
+    """Build a Prereq tree from a <skill_prereq> element and its children.
+
+    skill_to_difficulty maps casefolded skill names to their difficulties,
+    like "IQ/H", for prereqs on a skill's level.
+    """
+    name_el = el.find("name")
+    level_el = el.find("level")
+    specialization_el = el.find("specialization")
+    name_compare = name_el.get("compare") if name_el is not None else None
+    if (
+        name_compare in ("is", "starts with")
+        and specialization_el is not None
+        and (
+            specialization_el.get("compare") == "is anything"
+            or not specialization_el.text
+        )
+    ):
+        if len(el) == 3:
+            difficulty = skill_to_difficulty.get(name_el.text.casefold())
+            if (
+                level_el is not None
+                and level_el.get("compare") == "at_least"
+                and difficulty is not None
+            ):
+                return SkillLevelAtLeast(
+                    name_el.text,
+                    int(level_el.text),
+                    difficulty,
+                    prefix=name_compare == "starts with",
+                )
+        elif len(el) == 2:
+            if name_compare == "is":
+                return NameIs(name_el.text)
+            return NameStartsWith(name_el.text)
+
+    assert False, "build_skill_prereq %s" % et.tostring(el)
+
+
+def _build_prereq_list(
+    prereq_list_el: typing.Optional[et.Element],
+    cost_ordered: bool = True,
+    skill_to_difficulty: Mapping[str, str] = None,
+) -> Prereq:
+    """Build a Prereq tree from a <prereq_list> element and its children.
+
+    A missing prereq_list means no prereqs.
+
+    If cost_ordered is True then children are sorted so that cheap prereqs
+    are evaluated first, and the expensive ones can often be skipped.
+    skill_to_difficulty is passed to _build_skill_prereq().
+    """
+    if prereq_list_el is None:
+        return AllOf(())
+    if skill_to_difficulty is None:
+        skill_to_difficulty = {}
+    children = []
+    for child in prereq_list_el:
+        if child.tag == "prereq_list":
+            children.append(
+                _build_prereq_list(child, cost_ordered, skill_to_difficulty)
+            )
+        elif child.tag == "spell_prereq":
+            children.append(_build_spell_prereq(child))
+        elif child.tag == "advantage_prereq":
+            children.append(_build_advantage_prereq(child))
+        elif child.tag == "attribute_prereq":
+            children.append(_build_attribute_prereq(child))
+        elif child.tag == "skill_prereq":
+            children.append(_build_skill_prereq(child, skill_to_difficulty))
+        else:
+            assert False, "unknown child tag %s" % child.tag
+    if cost_ordered:
+        children.sort(key=lambda prereq: prereq.cost)
+    if prereq_list_el.get("all") == "yes":
+        return AllOf(children)
+    else:
+        return AnyOf(children)
+
+
+class SpellData(typing.NamedTuple):
+    """What dfrandom needs from the spell and skill lists of the library."""
+
+    # dict of spell name to set of colleges to which it belongs
+    spell_to_colleges: Dict[str, Set[str]]
+    # dict of spell name to its Prereq tree
+    spell_to_prereq: Dict[str, Prereq]
+    # dict of special bard skill name to its Prereq tree
+    special_skill_to_prereq: Dict[str, Prereq]
+
+
+# Bump this whenever SpellData or the Prereq classes change shape, so that
+# old cache files are ignored.
+SPELL_CACHE_VERSION = 2
+
+
+def library_path() -> str:
+    """Return the path to the GCS library file."""
+    dirname = os.path.dirname(__file__)
+    filename = "Library__L.glb"
+    return os.path.abspath(os.path.join(dirname, filename))
+
+
+def spell_cache_path(path: str) -> str:
+    """Return the path to the cache file for the library at path.
+
+    It lives under $XDG_CACHE_HOME, or ~/.cache if that is not set.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    path_digest = hashlib.sha1(path.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(
+        cache_home, "dfrandom", "spells-%s.pickle" % path_digest
+    )
+
+
+def _parse_spell_library(path: str) -> SpellData:
+    """Parse the library at path into a SpellData.
+
+    The library is big and we only need its spell and skill lists, so
+    stream through it with iterparse, throw away each element once it has
+    been handled, and stop as soon as both lists are done.  Prereqs can
+    refer to the levels of skills anywhere in the skill list, so they are
+    built at the end, once every skill's difficulty is known.
+    """
+    spell_to_colleges: Dict[str, Set[str]] = {}
+    spell_to_prereq: Dict[str, Prereq] = {}
+    special_skill_to_prereq: Dict[str, Prereq] = {}
+    skill_to_difficulty: Dict[str, str] = {}
+    # (dict to add to, name, prereq_list element)
+    prereq_list_els: List[
+        Tuple[Dict[str, Prereq], str, typing.Optional[et.Element]]
+    ] = []
+    needed_lists = {"spell_list", "skill_list"}
+    depth = 0
+    list_el = None
+    with open(path, "rb") as fil:
+        for event, el in et.iterparse(fil, events=("start", "end")):
+            if event == "start":
+                # gcs_library is depth 0, lists are 1, list items are 2
+                if depth == 1:
+                    list_el = el
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 2:
+                if el.tag == "spell" and list_el.tag == "spell_list":
+                    name = el.find("name").text
+                    if name in allowed_spells:
+                        categories_el = el.find("categories")
+                        colleges = set()
+                        for category_el in categories_el:
+                            college = category_el.text
+                            colleges.add(college)
+                        spell_to_colleges[name] = colleges
+                        prereq_list_els.append(
+                            (spell_to_prereq, name, el.find("prereq_list"))
+                        )
+                elif (
+                    el.tag in ("skill", "spell")
+                    and list_el.tag == "skill_list"
+                ):
+                    name = el.find("name").text
+                    difficulty = el.findtext("difficulty", "")
+                    if "/" in difficulty:
+                        skill_to_difficulty.setdefault(
+                            name.casefold(), difficulty
+                        )
+                    if name in special_bard_skills:
+                        prereq_list_els.append(
+                            (
+                                special_skill_to_prereq,
+                                name,
+                                el.find("prereq_list"),
+                            )
+                        )
+                # Drop this item, and the (already cleared) ones before it.
+                list_el.clear()
+            elif depth == 1:
+                list_el.clear()
+                needed_lists.discard(el.tag)
+                if not needed_lists:
+                    break
+    for dct, name, prereq_list_el in prereq_list_els:
+        dct[name] = _build_prereq_list(
+            prereq_list_el, skill_to_difficulty=skill_to_difficulty
+        )
+    return SpellData(
+        spell_to_colleges, spell_to_prereq, special_skill_to_prereq
+    )
+
+
+def _file_sha256(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fil:
+        hasher.update(fil.read())
+    return hasher.hexdigest()
+
+
+def _read_spell_cache(cache_path: str) -> typing.Optional[Dict]:
+    """Return the contents of the cache file, or None if it is missing or
+    unreadable."""
+    try:
+        with open(cache_path, "rb") as fil:
+            cache = pickle.load(fil)
+    except (
+        OSError,
+        EOFError,
+        pickle.UnpicklingError,
+        AttributeError,
+        ImportError,
+        IndexError,
+        TypeError,
+        ValueError,
+    ):
+        return None
+    if not isinstance(cache, dict):
+        return None
+    return cache
+
+
+def _write_spell_cache(cache_path: str, cache: Dict) -> None:
+    """Write cache to cache_path, atomically.  Failure is not an error;
+    we will just parse the library again next time."""
+    tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, "wb") as fil:
+            pickle.dump(cache, fil, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def load_spell_data(path: str = None, cache_path: str = None) -> SpellData:
+    """Return the SpellData for the library at path.
+
+    The parsed data is cached on disk, keyed by the library's size, mtime,
+    and content hash, so the XML is only parsed when the library changes.
+    """
+    if path is None:
+        path = library_path()
+    if cache_path is None:
+        cache_path = spell_cache_path(path)
+    stat = os.stat(path)
+    # The cached traits are limited to allowed_spells and
+    # special_bard_skills, so changing either invalidates the cache too.
+    spells_digest = hashlib.sha256(
+        "\n".join(
+            [str(SPELL_CACHE_VERSION)]
+            + sorted(allowed_spells)
+            + [""]
+            + sorted(special_bard_skills)
+        ).encode("utf-8")
+    ).hexdigest()
+    cache = _read_spell_cache(cache_path)
+    if (
+        cache is not None
+        and cache.get("version") == SPELL_CACHE_VERSION
+        and cache.get("spells_digest") == spells_digest
+        and cache.get("size") == stat.st_size
+    ):
+        if cache.get("mtime_ns") == stat.st_mtime_ns:
+            return cache["data"]
+        # Touched but maybe not changed.
+        if cache.get("sha256") == _file_sha256(path):
+            cache["mtime_ns"] = stat.st_mtime_ns
+            _write_spell_cache(cache_path, cache)
+            return cache["data"]
+    sha256 = _file_sha256(path)
+    data = _parse_spell_library(path)
+    cache = {
+        "version": SPELL_CACHE_VERSION,
+        "spells_digest": spells_digest,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": sha256,
+        "data": data,
+    }
+    _write_spell_cache(cache_path, cache)
+    return data
+
+
+def _name_prefixes(name: str) -> List[str]:
+    """Return the keys that Prereq.name_keys() could use for a trait
+    called name, which must be casefolded."""
+    result = [name]
+    bare_name = _bare_name(name)
+    if bare_name is not None:
+        result.append(bare_name)
+    words = name.split(" ")
+    for ii in range(1, len(words)):
+        result.append(" ".join(words[:ii]))
+    return result
+
+
+class PrereqGraph:
+    """The dependencies between traits in a set of prereqs.
+
+    requirements() says what a trait's prereqs depend on, and dependents()
+    says which traits' prereqs might change when a character gains a
+    trait.  Spells are resolved when the graph is built; other traits are
+    looked up by the keys from Prereq.name_keys(), and the few prereqs
+    without keys are checked against the name.
+    """
+
+    def __init__(
+        self,
+        spell_to_colleges: Mapping[str, AbstractSet[str]],
+        trait_to_prereq: Mapping[str, Prereq],
+    ) -> None:
+        folded_to_name = {}
+        names: Dict[str, AbstractSet[str]] = {}
+        for name, colleges in spell_to_colleges.items():
+            folded_to_name[name.casefold()] = name
+            names[name.casefold()] = frozenset(
+                college.casefold() for college in colleges
+            )
+        self._trait_to_prereq = trait_to_prereq
+        self._order = dict(
+            (name, ii) for ii, name in enumerate(trait_to_prereq)
+        )
+        self._requirements: Dict[str, typing.FrozenSet[str]] = {}
+        dependents: Dict[str, List[str]] = {}
+        key_to_dependents: Dict[str, List[str]] = {}
+        unkeyed = []
+        for name, prereq in trait_to_prereq.items():
+            spells = set(
+                folded_to_name[folded]
+                for folded in prereq.dependencies(names)
+            )
+            for spell in spells:
+                dependents.setdefault(spell, []).append(name)
+            keys = prereq.name_keys()
+            if keys is None:
+                unkeyed.append(name)
+                keys = set()
+            keys = set(key for key in keys if key not in folded_to_name)
+            for key in keys:
+                key_to_dependents.setdefault(key, []).append(name)
+            self._requirements[name] = frozenset(spells | keys)
+        self._dependents: Dict[str, Tuple[str, ...]] = dict(
+            (name, tuple(lst)) for name, lst in dependents.items()
+        )
+        self._key_to_dependents = key_to_dependents
+        self._unkeyed = tuple(unkeyed)
+
+    def requirements(self, name: str) -> typing.FrozenSet[str]:
+        """Return what the prereqs of trait name depend on: the spells by
+        name, and other traits by their casefolded keys, like "magery"."""
+        return self._requirements.get(name, frozenset())
+
+    def dependents(self, name: str) -> Tuple[str, ...]:
+        """Return the traits whose prereqs could be changed by gaining a
+        trait called name, like a spell or "Magery 3", in prereq order."""
+        result = self._dependents.get(name)
+        if result is not None:
+            return result
+        folded = name.casefold()
+        found = set()
+        for key in _name_prefixes(folded):
+            found.update(self._key_to_dependents.get(key, ()))
+        names: Dict[str, AbstractSet[str]] = {folded: frozenset()}
+        for dependent in self._unkeyed:
+            if self._trait_to_prereq[dependent].dependencies(names):
+                found.add(dependent)
+        return tuple(sorted(found, key=self._order.__getitem__))
+
+
+class SpellSet:
+    """A read-only view of some of the spells in a SpellLibrary.
+
+    spell_to_colleges maps each spell to its colleges.  spell_to_prereq
+    maps each spell, and any other trait that has prereqs (like the special
+    bard skills), to its Prereq tree.  graph is the PrereqGraph over them.
+    """
+
+    def __init__(
+        self,
+        spell_to_colleges: Mapping[str, AbstractSet[str]],
+        spell_to_prereq: Mapping[str, Prereq],
+    ) -> None:
+        self.spell_to_colleges = MappingProxyType(dict(spell_to_colleges))
+        self.spell_to_prereq = MappingProxyType(dict(spell_to_prereq))
+        self.graph = PrereqGraph(self.spell_to_colleges, self.spell_to_prereq)
+
+    def prereq_satisfied(
+        self, spell: str, traits: List[Tuple[str, int, TraitType]]
+    ) -> bool:
+        """Return True iff any prereqs for spell are satisfied."""
+        return self.satisfied(
+            spell, CharacterIndex(traits, self.spell_to_colleges)
+        )
+
+    def satisfied(self, spell: str, index: CharacterIndex) -> bool:
+        """Return True iff any prereqs for spell are satisfied by the
+        character in index."""
+        prereq = self.spell_to_prereq.get(spell)
+        if prereq is None:
+            return True
+        return prereq.evaluate(index)
+
+
+class SpellFrontier:
+    """The spells in a SpellSet that a character does not know yet but
+    could learn now.
+
+    After the first full check, learn() only re-checks the spells that
+    depend on the new one, and choice() is O(1).  Call added() after
+    adding any other trait to traits, so that the spells it affects are
+    re-checked too.  index is a CharacterIndex over traits.
+    """
+
+    def __init__(
+        self, traits: List[Tuple[str, int, TraitType]], spells: SpellSet
+    ) -> None:
+        self.traits = traits
+        self.spells = spells
+        self.index = CharacterIndex(traits, spells.spell_to_colleges)
+        # A list for random.choice, plus each spell's position in it so
+        # that removal is a swap with the last element.
+        self._frontier: List[str] = []
+        self._positions: Dict[str, int] = {}
+        for spell in spells.spell_to_colleges:
+            if spell not in self.index.names:
+                self._check(spell)
+
+    def __len__(self) -> int:
+        return len(self._frontier)
+
+    def __contains__(self, spell: object) -> bool:
+        return spell in self._positions
+
+    def choice(self, rng: random.Random = None) -> str:
+        """Return a random spell from the frontier, chosen with rng.  It
+        must not be empty."""
+        return (_default_rng if rng is None else rng).choice(self._frontier)
+
+    def learn(self, spell: str) -> None:
+        """Add spell to traits, at the one-point level, and update the
+        frontier."""
+        trait = (spell, 1, SP)
+        self.traits.append(trait)
+        self.added(trait)
+
+    def added(self, trait: Tuple[str, int, TraitType]) -> None:
+        """Update the frontier after trait was added to traits."""
+        name = trait[0]
+        self.index.add(trait)
+        self._discard(name)
+        for dependent in self.spells.graph.dependents(name):
+            if (
+                dependent not in self.index.names
+                and dependent in self.spells.spell_to_colleges
+            ):
+                self._check(dependent)
+
+    def _check(self, spell: str) -> None:
+        if self.spells.satisfied(spell, self.index):
+            if spell not in self._positions:
+                self._positions[spell] = len(self._frontier)
+                self._frontier.append(spell)
+        else:
+            self._discard(spell)
+
+    def _discard(self, spell: str) -> None:
+        position = self._positions.pop(spell, None)
+        if position is None:
+            return
+        last = self._frontier.pop()
+        if position < len(self._frontier):
+            self._frontier[position] = last
+            self._positions[last] = position
+
+
+class SpellLibrary:
+    """The spells, and special bard skills, from the GCS library.
+
+    Use get_spell_library() to get the one loaded for this process.  It is
+    never modified; templates use the SpellSet views from spells(), which
+    are built once and cached, so it can be shared between threads.
+    """
+
+    def __init__(self, data: SpellData) -> None:
+        spell_to_colleges = dict(
+            (name, frozenset(colleges))
+            for name, colleges in data.spell_to_colleges.items()
+        )
+        self.spell_to_colleges = MappingProxyType(spell_to_colleges)
+        self.spell_to_prereq = MappingProxyType(dict(data.spell_to_prereq))
+        self.special_skill_to_prereq = MappingProxyType(
+            dict(data.special_skill_to_prereq)
+        )
+        trait_to_prereq = dict(self.spell_to_prereq)
+        trait_to_prereq.update(self.special_skill_to_prereq)
+        self.graph = PrereqGraph(self.spell_to_colleges, trait_to_prereq)
+        self._views: Dict[Tuple[AbstractSet[str], bool, bool], SpellSet] = {}
+        self._views_lock = threading.Lock()
+
+    def spells(
+        self,
+        allowed_colleges: typing.Iterable[str] = None,
+        bardic_talent: bool = False,
+        special_bard_skills: bool = False,
+    ) -> SpellSet:
+        """Return a SpellSet of spells.
+
+        If allowed_colleges is given then only spells from those colleges
+        are included.  If bardic_talent is True then prereqs on Magery are
+        changed to Bardic Talent.  If special_bard_skills is True then the
+        special bard skills' prereqs are included.
+        """
+        key = (
+            frozenset(allowed_colleges or ()),
+            bardic_talent,
+            special_bard_skills,
+        )
+        view = self._views.get(key)
+        if view is None:
+            with self._views_lock:
+                view = self._views.get(key)
+                if view is None:
+                    view = self._build_view(*key)
+                    self._views[key] = view
+        return view
+
+    def _build_view(
+        self,
+        allowed_colleges: AbstractSet[str],
+        bardic_talent: bool,
+        special_bard_skills: bool,
+    ) -> SpellSet:
+        spell_to_colleges = {}
+        spell_to_prereq = {}
+        for name, colleges in self.spell_to_colleges.items():
+            if allowed_colleges and not colleges & allowed_colleges:
+                continue
+            spell_to_colleges[name] = colleges
+            prereq = self.spell_to_prereq[name]
+            if bardic_talent:
+                # Bards treat Bardic Talent as Magery for their prereqs.
+                prereq = prereq.replace_name("Magery", "Bardic Talent")
+            spell_to_prereq[name] = prereq
+        if special_bard_skills:
+            spell_to_prereq.update(self.special_skill_to_prereq)
+        return SpellSet(spell_to_colleges, spell_to_prereq)
+
+    def wizard_spells(self) -> SpellSet:
+        """Return the SpellSet for wizards: all spells."""
+        return self.spells()
+
+    def bard_spells(self) -> SpellSet:
+        """Return the SpellSet for bards: spells from the bard colleges
+        with Bardic Talent standing in for Magery, plus the special bard
+        skills."""
+        return self.spells(
+            allowed_bard_colleges, bardic_talent=True, special_bard_skills=True
+        )
+
+
+_spell_library: typing.Optional[SpellLibrary] = None
+_spell_library_lock = threading.Lock()
+
+
+def get_spell_library() -> SpellLibrary:
+    """Return the SpellLibrary, loading it the first time.
+
+    Threads that ask while it is loading wait for it, so there is only
+    ever one.
+    """
+    if _spell_library is None:
+        _load_spell_library()
+    return _spell_library  # type: ignore
+
+
+def _load_spell_library() -> None:
+    global _spell_library
+    with _spell_library_lock:
+        if _spell_library is None:
+            _spell_library = SpellLibrary(load_spell_data())
+
+
+def prereq_satisfied(
+    spell: str,
+    traits: List[Tuple[str, int, TraitType]],
+    spells: SpellSet = None,
+) -> bool:
+    """Return True iff any prereqs for spell are satisfied.
+
+    spells defaults to the wizard's SpellSet.
+    """
+    if spells is None:
+        spells = get_spell_library().wizard_spells()
+    return spells.prereq_satisfied(spell, traits)
+
+
+def add_spell(
+    traits: List[Tuple[str, int, TraitType]],
+    trait_names: Set[str],
+    spells: SpellSet = None,
+    frontier: SpellFrontier = None,
+    rng: random.Random = None,
+) -> bool:
+    """Add one random spell from spells to traits, at the one-point level,
+    chosen with rng.
+
+    spells defaults to the wizard's SpellSet.  To add several spells, pass
+    the same SpellFrontier over traits each time, so that each pick only
+    re-checks the spells that the last one could have unlocked.
+
+    Return False, without adding anything, if no spell can be learned.
+    """
+    trace = _tracing.trace
+    if trace is not None:
+        if "spells" not in trace.uncounted:
+            trace.uncounted.append("spells")
+        return False
+    if rng is None:
+        rng = _default_rng
+    if frontier is None:
+        if spells is None:
+            spells = get_spell_library().wizard_spells()
+        candidates = [
+            spell
+            for spell in spells.spell_to_colleges
+            if spell not in trait_names
+        ]
+        rng.shuffle(candidates)
+        index = CharacterIndex(traits, spells.spell_to_colleges)
+        for spell in candidates:
+            if spells.satisfied(spell, index):
+                traits.append((spell, 1, SP))
+                trait_names.add(spell)
+                return True
+        return False
+    if not frontier:
+        return False
+    spell = frontier.choice(rng)
+    frontier.learn(spell)
+    trait_names.add(spell)
+    return True
+
+
+# TODO support multiple languages
+# Maybe language as leveled 1-30 or 2-30, then split it up
+wizard_data = TemplateData(
+    traits=[
+        ("ST 10", 0, PA),
+        ("DX 12", 40, PA),
+        ("IQ 15", 100, PA),
+        ("HT 11", 10, PA),
+        ("HP 10", 0, SA),
+        ("Will 15", 0, SA),
+        ("Per 12", -15, SA),
+        ("FP 14", 9, SA),
+        ("Basic Speed 6.0", 5, SA),
+        ("Basic Move 6", 0, SA),
+        ("Magery 3", 35, AD),
+        ("Occultism", 2, SK),
+        ("Alchemy", 8, SK),
+        ("Thaumatology", 1, SK),
+        ("Hazardous Materials (Magical)", 1, SK),
+        ("Research", 1, SK),
+        ("Speed-Reading", 1, SK),
+        ("Teaching", 1, SK),
+        ("Writing", 1, SK),
+        ("Meditation", 2, SK),
+    ],
+    stages=[
+        Stage(
+            "ads1",
+            30,
+            [
+                [("DX +1", 20, PA)],
+                [("IQ +1", 20, PA)],
+                list_levels("Will +%d", 5, SA, 5),
+                list_levels("FP +%d", 3, SA, 10),
+                [("Eidetic Memory", 5, AD), ("Photographic Memory", 10, AD)],
+                list_levels("Gizmos %d", 5, AD, 3),
+                [("Intuition", 15, AD)],
+                [("Language Talent", 10, AD)],
+                [("Language (Spoken: Broken / Written: None)", 1, AD)],
+                [("Language (Spoken: None / Written: Broken)", 1, AD)],
+                [("Language (Spoken: Accented / Written: None)", 2, AD)],
+                [("Language (Spoken: Broken / Written: Broken)", 2, AD)],
+                [("Language (Spoken: None / Written: Accented)", 2, AD)],
+                [("Language (Spoken: Native / Written: None)", 3, AD)],
+                [("Language (Spoken: Accented / Written: Broken)", 3, AD)],
+                [("Language (Spoken: Broken / Written: Accented)", 3, AD)],
+                [("Language (Spoken: None / Written: Native)", 3, AD)],
+                [("Language (Spoken: Native / Written: Broken)", 4, AD)],
+                [("Language (Spoken: Accented / Written: Accented)", 4, AD)],
+                [("Language (Spoken: Broken / Written: Native)", 4, AD)],
+                [("Language (Spoken: Native / Written: Accented)", 5, AD)],
+                [("Language (Spoken: Accented / Written: Native)", 5, AD)],
+                [("Language (Spoken: Native / Written: Native)", 6, AD)],
+                [("Luck", 15, AD), ("Extraordinary Luck", 30, AD)],
+                list_levels("Magery %d", 10, AD, 3, min_level=4),
+                list_levels("Mind Shield %d", 4, AD, 5),
+                list_levels("Signature Gear %d", 1, AD, 10),
+                [("Spirit Empathy", 10, AD)],
+                [("Wild Talent 1 (Retention, Focused, Magical)", 21, AD)],
+            ],
+            after=fix_language_talent,
+            # TODO If that lowered any costs take more advantages
+        ),
+        Stage(
+            "disads1",
+            -15,
+            [
+                list_self_control_levels("Curious", -5),
+                [("Frightens Animals", -10, DI)],
+                list_self_control_levels(
+                    "Obsession (Become the world's most powerful wizard, a lich, etc.)",
+                    -10,
+                ),
+                list_self_control_levels("Pyromania", -5),
+                [("Skinny", -5, DI)],
+                [("Social Stigma (Excommunicated)", -10, DI)],
+                [("Unfit", -5, DI), ("Very Unfit", -15, DI)],
+                list_levels("Unnatural Features %d", -1, DI, 5),
+                [("Weirdness Magnet", -15, DI)],
+            ],
+        ),
+        Stage(
+            "disads2",
+            -20,
+            [
+                [("Absent-Mindedness", -15, DI)],
+                list_self_control_levels("Bad Temper", -10),
+                [("Clueless", -10, DI)],
+                [("Combat Paralysis", -15, DI)],
+                list_self_control_levels("Cowardice", -10),
+                [("Hard of Hearing", -15, DI)],
+                [("Klutz", -5, DI), ("Total Klutz", -15, DI)],
+                list_self_control_levels("Loner", -5),
+                [("Low Pain Threshold", -10, DI)],
+                [("Nervous Stomach", -1, DI)],
+                [("Oblivious", -5, DI)],
+                list_self_control_levels("Overconfidence", -5),
+                list_self_control_levels("Post-Combat Shakes", -5),
+                [("Sense of Duty (Adventuring companions)", -5, DI)],
+                [("Stubbornness", -5, DI)],
+            ],
+            reuse=("disads1",),
+        ),
+        Stage(
+            "skills1",
+            2,
+            [
+                [
+                    ("Hidden Lore (Demons)", 2, SK),
+                    ("Hidden Lore (Magic Items)", 2, SK),
+                    ("Hidden Lore (Magical Writings)", 2, SK),
+                    ("Hidden Lore (Spirits)", 2, SK),
+                ]
+            ],
+        ),
+        Stage(
+            "skills2",
+            8,
+            [
+                [("Smallsword", 4, SK)],
+                [("Shield (Buckler)", 4, SK)],
+                [("Staff", 8, SK)],
+            ],
+        ),
+        Stage(
+            "skills3",
+            4,
+            [
+                [("Innate Attack (any)", 4, SK)],
+                [("Thrown Weapon (Dart)", 4, SK)],
+                [("Throwing", 4, SK)],
+                [("Sling", 4, SK)],
+            ],
+        ),
+        Stage(
+            "skills4",
+            9,
+            [
+                [("Fast-Draw (Potion)", 1, SK)],
+                [("Climbing", 1, SK)],
+                [("Stealth", 1, SK)],
+                [("Body Sense", 1, SK)],
+                [("First Aid", 1, SK)],
+                [("Gesture", 1, SK)],
+                [("Savoir-Faire (High Society)", 1, SK)],
+                [("Cartography", 1, SK)],
+                [("Hidden Lore (Demons)", 1, SK)],
+                [("Hidden Lore (Magic Items)", 1, SK)],
+                [("Hidden Lore (Magical Writings)", 1, SK)],
+                [("Hidden Lore (Spirits)", 1, SK)],
+                [("Diplomacy", 1, SK)],
+                [("Physiology (monster type)", 1, SK)],
+                [("Strategy", 1, SK)],
+                [("Hiking", 1, SK)],
+                [("Scrounging", 1, SK)],
+            ],
+            # Remove duplicate Hidden Lore
+            skip_known=True,
+        ),
+    ],
+)
+
+
+def generate_wizard(
+    context: GenerationContext = None,
+) -> List[Tuple[str, int, TraitType]]:
+    if context is None:
+        context = GenerationContext()
+    traits = template_to_compiled["wizard"].generate(context)
+    spells = get_spell_library().wizard_spells()
     trait_names = set((trait[0] for trait in traits))
+    frontier = SpellFrontier(traits, spells)
     for unused in range(30):
-        add_spell(traits, trait_names)
-
+        if not add_spell(traits, trait_names, spells, frontier, context.rng):
+            break
     return traits
 
 
@@ -4052,6 +5925,640 @@ template_to_fn = {
 
 templates = sorted(template_to_fn.keys())
 
+template_to_data = {
+    "barbarian": barbarian_data,
+    "bard": bard_data,
+    "cleric": cleric_data,
+    "druid": druid_data,
+    "holy_warrior": holy_warrior_data,
+    "knight": knight_data,
+    "martial_artist": martial_artist_data,
+    "scout": scout_data,
+    "swashbuckler": swashbuckler_data,
+    "thief": thief_data,
+    "wizard": wizard_data,
+}
+
+# Compiled once, at import.
+template_to_compiled = dict(
+    (template, CompiledTemplate(data))
+    for template, data in template_to_data.items()
+)
+
+# Templates with random branches, as (keyword arguments, probability)
+template_to_branches: Dict[str, List[Tuple[Dict[str, int], Fraction]]] = {
+    "martial_artist": [
+        ({"melee_option": option}, Fraction(1, 3)) for option in range(3)
+    ],
+}
+
+
+def character_seed(seed: int, index: int) -> str:
+    """Return the seed for character index of a batch with seed seed."""
+    return "%d/%d" % (seed, index)
+
+
+def generate_character(
+    template: str, context: GenerationContext = None
+) -> Tuple[str, List[Tuple[str, int, TraitType]]]:
+    """Return (template, merged traits) for a new character from
+    template, or from a random template if template is "random"."""
+    if context is None:
+        context = GenerationContext()
+    if template == "random":
+        template = context.rng.choice(templates)
+    fn = template_to_fn[template]
+    return template, merge_traits(fn(context=context))  # type: ignore
+
+
+def _generate_batch(
+    template: str,
+    start: int,
+    stop: int,
+    seed: typing.Optional[int],
+    rng: random.Random = None,
+    sampling: str = None,
+) -> typing.Iterator[Tuple[str, List[Tuple[str, int, TraitType]]]]:
+    """Yield generate_character(template) for characters start to stop
+    of a batch, each with its own generator if there is a seed, else all
+    with rng."""
+    context = GenerationContext(rng, sampling)
+    for index in range(start, stop):
+        if seed is not None:
+            context = GenerationContext(
+                random.Random(character_seed(seed, index)), sampling
+            )
+        yield generate_character(template, context)
+
+
+def generate_named(
+    template: str,
+    n: int,
+    *,
+    seed: int = None,
+    rng: random.Random = None,
+    sampling: str = None,
+) -> typing.Iterator[Tuple[str, List[Tuple[str, int, TraitType]]]]:
+    """Like generate_many(), but yield (template, traits), so random
+    templates can be told apart."""
+    if template != "random" and template not in templates:
+        raise ValueError(
+            "unknown template %r; must be one of %s"
+            % (template, ", ".join(templates + ["random"]))
+        )
+    return _generate_batch(template, 0, n, seed, rng, sampling)
+
+
+def generate_many(
+    template: str,
+    n: int,
+    *,
+    seed: int = None,
+    rng: random.Random = None,
+    sampling: str = None,
+) -> typing.Iterator[List[Tuple[str, int, TraitType]]]:
+    """Yield the merged traits of n new characters from template, or from
+    a random template each if template is "random".
+
+    Characters are made one at a time as they are asked for, reusing the
+    spell library and compiled templates, so memory does not grow with n.
+    With a seed, each character is made with a random.Random seeded with
+    character_seed(seed, index), so each one is the same however many are
+    made.  Without one, they are all made with rng, by default the random
+    module's generator.  sampling is the mode pick_from_list uses, by
+    default default_sampling.
+
+    Nothing is shared between calls but read-only data, so several
+    threads can each generate their own characters at once.
+    """
+    return (
+        traits
+        for unused, traits in generate_named(
+            template, n, seed=seed, rng=rng, sampling=sampling
+        )
+    )
+
+
+def _init_worker() -> None:
+    """Set up a generate_parallel() worker process."""
+    get_spell_library()
+
+
+# Whether _worker_pool() has run _preload() in this process yet.
+_preloaded = False
+
+
+def _preload() -> None:
+    """Load the spell library and build everything the templates read
+    from it, and the option tables they use, in this process."""
+    for compiled in template_to_compiled.values():
+        for stage in compiled.stages:
+            if stage.spells:
+                compiled.spell_groups(stage.spells)
+    rng = random.Random(0)
+    for template in templates:
+        generate_character(template, GenerationContext(rng))
+
+
+def _worker_pool(
+    jobs: int, start_method: typing.Optional[str]
+) -> concurrent.futures.ProcessPoolExecutor:
+    """Return a pool of jobs worker processes for generate_parallel(),
+    started with start_method.
+
+    By default that is "fork" on Linux when this is the only thread
+    running, and otherwise multiprocessing's default.  Forking is not
+    safe on macOS, or while another thread could be holding a lock the
+    workers need, so pass "fork" in those cases only if you know better.
+
+    Forked workers are started at once, from this process with
+    everything generation reads already loaded and frozen by gc.freeze(),
+    so they share it copy-on-write instead of each loading their own.
+    The freeze is undone once they are forked, unless something was
+    already frozen: gc.unfreeze() cannot undo just this one, so then what
+    was frozen here stays frozen too.  Other workers load everything in
+    _init_worker().
+    """
+    if start_method is None:
+        if sys.platform.startswith("linux") and threading.active_count() == 1:
+            start_method = "fork"
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=multiprocessing.get_context(start_method),
+        initializer=_init_worker,
+    )
+    if start_method == "fork":
+        global _preloaded
+        if not _preloaded:
+            _preload()
+            _preloaded = True
+        # Frozen objects are never visited by the collector, so
+        # collections in the workers do not write to, and so copy, the
+        # pages they share with this process.
+        gc.collect()
+        frozen = gc.get_freeze_count()
+        gc.freeze()
+        try:
+            # A fork pool forks all its workers on the first submit.
+            executor.submit(_init_worker)
+        finally:
+            if not frozen:
+                gc.unfreeze()
+    return executor
+
+
+def _generate_chunk(
+    template: str,
+    start: int,
+    stop: int,
+    seed: int,
+    sampling: typing.Optional[str],
+) -> List[Tuple[str, List[Tuple[str, int, TraitType]]]]:
+    """Return characters start to stop of a batch, in a worker."""
+    return list(
+        _generate_batch(template, start, stop, seed, sampling=sampling)
+    )
+
+
+def generate_parallel(
+    template: str,
+    n: int,
+    *,
+    seed: int = None,
+    jobs: int = None,
+    chunk_size: int = 32,
+    rng: random.Random = None,
+    sampling: str = None,
+    start_method: str = None,
+) -> typing.Iterator[Tuple[str, List[Tuple[str, int, TraitType]]]]:
+    """Like generate_named(), but spread over jobs worker processes.
+
+    Each character is seeded from seed and its index, as in
+    generate_named(), so the characters are the same as its, however many
+    workers there are.  Without a seed one is drawn from rng, by default
+    the random module's generator.  Workers make
+    chunk_size characters at a time, and at most two chunks per worker
+    are in flight, so results come back in order without piling up.
+
+    start_method is the multiprocessing start method for the workers.
+    The default, "fork" on Linux when no other threads are running, loads
+    the spell library once here and shares it with every worker; see
+    _worker_pool().
+    """
+    if template != "random" and template not in templates:
+        raise ValueError(
+            "unknown template %r; must be one of %s"
+            % (template, ", ".join(templates + ["random"]))
+        )
+    if seed is None:
+        seed = (_default_rng if rng is None else rng).randrange(1 << 64)
+    return _generate_parallel(
+        template, n, seed, jobs, chunk_size, sampling, start_method
+    )
+
+
+def _generate_parallel(
+    template: str,
+    n: int,
+    seed: int,
+    jobs: typing.Optional[int],
+    chunk_size: int,
+    sampling: typing.Optional[str],
+    start_method: typing.Optional[str],
+) -> typing.Iterator[Tuple[str, List[Tuple[str, int, TraitType]]]]:
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    with _worker_pool(jobs, start_method) as executor:
+        starts = iter(range(0, n, chunk_size))
+        # Futures in batch order.  The oldest is waited on first, so
+        # chunks that finish early wait here for their turn.
+        pending: typing.Deque[concurrent.futures.Future] = deque()
+
+        def submit_next() -> None:
+            start = next(starts, None)
+            if start is not None:
+                pending.append(
+                    executor.submit(
+                        _generate_chunk,
+                        template,
+                        start,
+                        min(start + chunk_size, n),
+                        seed,
+                        sampling,
+                    )
+                )
+
+        for unused in range(2 * jobs):
+            submit_next()
+        while pending:
+            characters = pending.popleft().result()
+            submit_next()
+            yield from characters
+
+
+def list_probabilities(
+    lst: typing.Sequence[typing.Sequence[Tuple[str, int, TraitType]]],
+    points: int,
+) -> Dict[str, Fraction]:
+    """Return a dict of trait name to the exact probability that
+    pick_from_list in "uniform" mode picks it from lst."""
+    table = option_table(_option_costs(lst), points)
+    total = table.ways(table.counts, table.offset, points)
+    if not total:
+        raise ValueError("no traits from list total %d points" % points)
+    probabilities: Dict[str, Fraction] = {}
+    for ii, group in enumerate(lst):
+        counts, offset = table.without(table.counts, table.offset, ii)
+        for name, cost, unused in group:
+            ways = table.ways(counts, offset, points - cost)
+            probabilities[name] = probabilities.get(name, 0) + Fraction(
+                ways, total
+            )
+    return probabilities
+
+
+def _trace_template(template: str, kwargs: Dict[str, int]) -> _Trace:
+    """Run template's generator with kwargs, picking nothing, and return
+    what it tried to pick."""
+    trace = _tracing.trace = _Trace()
+    try:
+        template_to_fn[template](**kwargs)
+        return trace
+    finally:
+        _tracing.trace = None
+
+
+# template_probabilities() follows how lists that share groups pick from
+# them while the earlier lists can leave at most this many different sets
+# of shared groups unpicked.
+_MAX_SHARED_STATES = 4096
+
+
+def _used_group_counts(
+    lst: typing.Sequence[typing.Sequence[Tuple[str, int, TraitType]]],
+    points: int,
+    keep: AbstractSet[int],
+) -> typing.Optional[Dict[typing.FrozenSet[int], int]]:
+    """Return a dict of the set of groups in keep, by id, that a selection
+    totaling points from lst picks from, to the number of selections that
+    do; or None if partial selections need more than _MAX_SHARED_STATES
+    sets to tell apart."""
+    table = option_table(_option_costs(lst), points)
+    suffixes = table.suffixes()
+    # (groups in keep picked from, points so far) to number of ways, for
+    # the partial selections that can still total points.
+    partial: Dict[Tuple[typing.FrozenSet[int], int], int] = {
+        (frozenset(), 0): 1
+    }
+    for ii, group in enumerate(lst):
+        counts, offset = suffixes[ii + 1]
+        step: Dict[Tuple[typing.FrozenSet[int], int], int] = {}
+        for (used, total), ways in partial.items():
+            options = [(used, total)]
+            picked = used | {id(group)} if id(group) in keep else used
+            options.extend((picked, total + tup[1]) for tup in group)
+            for key in options:
+                if table.ways(counts, offset, points - key[1]):
+                    step[key] = step.get(key, 0) + ways
+        if len(step) > _MAX_SHARED_STATES:
+            return None
+        partial = step
+    return dict((used, ways) for (used, unused), ways in partial.items())
+
+
+def _shared_list_probabilities(
+    lists: List[
+        Tuple[
+            typing.Sequence[typing.Sequence[Tuple[str, int, TraitType]]], int
+        ]
+    ]
+) -> typing.Optional[List[Dict[str, Fraction]]]:
+    """Return list_probabilities() for each of lists, in order, where
+    each list is picked from after the ones before it and loses the
+    groups they picked from.
+
+    Each list is weighed up once for each set of groups the earlier ones
+    can leave it, by the chance they leave it that set.  Return None if
+    there are more than _MAX_SHARED_STATES such sets.
+    """
+    results: List[Dict[str, Fraction]] = [{} for unused in lists]
+    # Set of picked groups, by id, that later lists have, to its chance.
+    states: Dict[typing.FrozenSet[int], Fraction] = {frozenset(): Fraction(1)}
+    for jj, (lst, points) in enumerate(lists):
+        later = set(
+            id(group) for lst2, unused in lists[jj + 1 :] for group in lst2
+        )
+        next_states: Dict[typing.FrozenSet[int], Fraction] = {}
+        for used, chance in states.items():
+            left = [group for group in lst if id(group) not in used]
+            for name, probability in list_probabilities(left, points).items():
+                results[jj][name] = (
+                    results[jj].get(name, 0) + chance * probability
+                )
+            if not later:
+                continue
+            counts = _used_group_counts(left, points, later)
+            if counts is None:
+                return None
+            total = sum(counts.values())
+            for picked, ways in counts.items():
+                key = (used & later) | picked
+                next_states[key] = next_states.get(key, 0) + chance * Fraction(
+                    ways, total
+                )
+            if len(next_states) > _MAX_SHARED_STATES:
+                return None
+        states = next_states
+    return results
+
+
+def template_probabilities(
+    template: str,
+) -> List[Tuple[Fraction, int, Dict[str, Fraction], bool]]:
+    """Return the probability of each trait in each of template's option
+    lists, with "uniform" sampling.
+
+    Return a list of (probability the list is used, points, dict of trait
+    name to probability it is picked from the list, whether that is
+    exact).  Branches in template_to_branches are mixed by their
+    probabilities.
+
+    Lists that reuse the unpicked groups of earlier ones are worked out
+    with the earlier ones, for every set of groups those can leave.  When
+    there are more than _MAX_SHARED_STATES such sets, as with the cleric's
+    spells, the later lists are instead taken as declared, with none of
+    their groups picked, and are not exact.
+
+    The template is traced with pick_from_list picking nothing, so lists
+    only added after a particular pick are missing.  Picks made with
+    prereqs, and wizard spells, are not option lists and are left out.
+    """
+    branches = template_to_branches.get(template, [({}, Fraction(1))])
+    keys: List[Tuple[Tuple[Tuple[str, ...], ...], int]] = []
+    key_to_stage: Dict[
+        Tuple[Tuple[Tuple[str, ...], ...], int],
+        Tuple[Fraction, int, Dict[str, Fraction], bool],
+    ] = {}
+    for kwargs, branch_probability in branches:
+        lists = _trace_template(template, kwargs).lists
+        list_to_probabilities: List[Dict[str, Fraction]] = [
+            {} for unused in lists
+        ]
+        exact = [True] * len(lists)
+        for component in _stage_components(lists):
+            shared = _shared_list_probabilities(
+                [lists[ii] for ii in component]
+            )
+            for jj, ii in enumerate(component):
+                if shared is None:
+                    list_to_probabilities[ii] = list_probabilities(*lists[ii])
+                    # The first list loses no groups to earlier ones.
+                    exact[ii] = jj == 0
+                else:
+                    list_to_probabilities[ii] = shared[jj]
+        for ii, (lst, points) in enumerate(lists):
+            key = (
+                tuple(tuple(tup[0] for tup in group) for group in lst),
+                points,
+            )
+            probabilities = list_to_probabilities[ii]
+            if key in key_to_stage:
+                weight, unused, old, old_exact = key_to_stage[key]
+                for name, probability in probabilities.items():
+                    old[name] += branch_probability * probability
+                key_to_stage[key] = (
+                    weight + branch_probability,
+                    points,
+                    old,
+                    old_exact and exact[ii],
+                )
+            else:
+                keys.append(key)
+                key_to_stage[key] = (
+                    branch_probability,
+                    points,
+                    dict(
+                        (name, branch_probability * probability)
+                        for name, probability in probabilities.items()
+                    ),
+                    exact[ii],
+                )
+    return [key_to_stage[key] for key in keys]
+
+
+def _stage_components(
+    lists: List[
+        Tuple[
+            typing.Sequence[typing.Sequence[Tuple[str, int, TraitType]]], int
+        ]
+    ]
+) -> List[List[int]]:
+    """Return the indexes of lists, split into components that share
+    groups.
+
+    Templates pass the unpicked groups of one list on to a later one, so a
+    group object found in several lists can only be picked in one of them.
+    """
+    parent = list(range(len(lists)))
+
+    def find(ii: int) -> int:
+        while parent[ii] != ii:
+            parent[ii] = parent[parent[ii]]
+            ii = parent[ii]
+        return ii
+
+    group_to_stage: Dict[int, int] = {}
+    for ii, (lst, unused) in enumerate(lists):
+        for group in lst:
+            jj = group_to_stage.setdefault(id(group), ii)
+            parent[find(ii)] = find(jj)
+    components: Dict[int, List[int]] = {}
+    for ii in range(len(lists)):
+        components.setdefault(find(ii), []).append(ii)
+    return list(components.values())
+
+
+def count_shared_lists(
+    lists: List[
+        Tuple[
+            typing.Sequence[typing.Sequence[Tuple[str, int, TraitType]]], int
+        ]
+    ]
+) -> int:
+    """Return the number of ways to pick exactly points from each of
+    lists, at most one trait from each group, where a group that is in
+    several lists is picked from in at most one of them.
+
+    This is one polynomial in a variable per list, multiplied out a group
+    at a time.  Its coefficients, up to each list's points, are packed
+    into the bits of one int, so each step is a few big-int operations.
+    """
+    signs = [-1 if points < 0 else 1 for unused, points in lists]
+    limits = [points * sign for (unused, points), sign in zip(lists, signs)]
+    # Slot strides: the coefficient of x1**u1 * x2**u2 ... is in slot
+    # u1 * strides[0] + u2 * strides[1] + ...
+    strides = []
+    num_slots = 1
+    for limit in limits:
+        strides.append(num_slots)
+        num_slots *= limit + 1
+    # Each group's costs, by list, counted by cost.
+    group_costs: Dict[int, Dict[int, Dict[int, int]]] = {}
+    group_order: List[int] = []
+    for ii, (lst, unused) in enumerate(lists):
+        for group in lst:
+            if id(group) not in group_costs:
+                group_costs[id(group)] = {}
+                group_order.append(id(group))
+            cost_counts = group_costs[id(group)].setdefault(ii, {})
+            for tup in group:
+                cost = tup[1] * signs[ii]
+                if cost < 0:
+                    raise ValueError("list mixes costs of both signs")
+                if cost <= limits[ii]:
+                    cost_counts[cost] = cost_counts.get(cost, 0) + 1
+    # No count can pass the number of selections ignoring points.
+    bound = 1
+    for by_list in group_costs.values():
+        bound *= 1 + sum(
+            sum(cost_counts.values()) for cost_counts in by_list.values()
+        )
+    slot_bytes = (bound.bit_length() + 8) // 8
+    width = slot_bytes * 8
+    masks: Dict[Tuple[int, int], int] = {}
+
+    def mask(ii: int, cost: int) -> int:
+        """Return the slots whose exponent for list ii is at most
+        limits[ii] - cost."""
+        if (ii, cost) not in masks:
+            run = strides[ii] * slot_bytes
+            period = b"\xff" * (run * (limits[ii] - cost + 1)) + b"\x00" * (
+                run * cost
+            )
+            masks[ii, cost] = int.from_bytes(
+                period * (num_slots // (strides[ii] * (limits[ii] + 1))),
+                "little",
+            )
+        return masks[ii, cost]
+
+    state = 1
+    for group_id in group_order:
+        new_state = state
+        for ii, cost_counts in group_costs[group_id].items():
+            for cost, count in cost_counts.items():
+                shifted = (state & mask(ii, cost)) << (
+                    cost * strides[ii] * width
+                )
+                new_state += shifted * count if count != 1 else shifted
+        state = new_state
+    final_slot = sum(
+        limit * stride for limit, stride in zip(limits, strides)
+    )
+    return (state >> (final_slot * width)) & ((1 << width) - 1)
+
+
+def count_template_space(template: str) -> Tuple[int, List[str]]:
+    """Return the number of distinct selections template's option lists
+    can make, and a list of the picks that were not counted.
+
+    Each way to pick from every pick_from_list list counts once; branches
+    in template_to_branches are added up.  Lists that reuse the unpicked
+    groups of earlier ones are counted jointly, and the rest multiply.
+    Picks made with prereqs, wizard spells, skill improvements, and other
+    random choices in the generator are not counted, so the true number
+    of distinct characters is at least this many times as large.
+    Selections that merge to the same traits are counted separately.
+    """
+    total = 0
+    uncounted: List[str] = []
+    branches = template_to_branches.get(template, [({}, Fraction(1))])
+    for kwargs, unused in branches:
+        trace = _trace_template(template, kwargs)
+        for description in trace.uncounted:
+            if description not in uncounted:
+                uncounted.append(description)
+        product = 1
+        for component in _stage_components(trace.lists):
+            if len(component) == 1:
+                lst, points = trace.lists[component[0]]
+                table = option_table(_option_costs(lst), points)
+                product *= table.ways(table.counts, table.offset, points)
+            else:
+                product *= count_shared_lists(
+                    [trace.lists[ii] for ii in component]
+                )
+        total += product
+    return total, uncounted
+
+
+def print_count_space(template: str) -> None:
+    """Print the number of distinct selections from template's option
+    lists, and what was not counted."""
+    count, uncounted = count_template_space(template)
+    line = "%s: %d (about 10**%d)" % (template, count, len(str(count)) - 1)
+    if uncounted:
+        line += "; not counted: %s" % ", ".join(uncounted)
+    print(line)
+
+
+def print_probabilities(template: str) -> None:
+    """Print the probability of each trait in each of template's option
+    lists."""
+    for ii, (weight, points, probabilities, exact) in enumerate(
+        template_probabilities(template)
+    ):
+        print()
+        line = "list %d: %d points" % (ii + 1, points)
+        if weight != 1:
+            line += ", used %.1f%% of the time" % (100 * float(weight))
+        if not exact:
+            line += ", approximate: earlier lists' picks are not removed"
+        print(line)
+        for name, probability in sorted(
+            probabilities.items(), key=lambda item: (-item[1], item[0])
+        ):
+            print("%6.2f%% %s" % (100 * float(probability), name))
+
 
 def main() -> None:
     parser = argparse.ArgumentParser(
@@ -4065,20 +6572,101 @@ def main() -> None:
         "thief, wizard)",
         default="random",
     )
+    parser.add_argument(
+        "--sampling",
+        choices=SAMPLING_MODES,
+        default=default_sampling,
+        help="How to pick traits from each list: greedy picks from lists "
+        "in random order, uniform makes every valid pick equally likely",
+    )
+    parser.add_argument(
+        "--probabilities",
+        action="store_true",
+        help="Instead of generating a character, print the chance of each "
+        "trait in each of the template's lists with uniform sampling; "
+        "exact except for lists marked approximate",
+    )
+    parser.add_argument(
+        "--count-space",
+        action="store_true",
+        help="Instead of generating a character, print the number of "
+        "distinct selections from the template's lists (every template's "
+        "if none is given)",
+    )
+    parser.add_argument(
+        "--count",
+        "-n",
+        type=int,
+        default=1,
+        help="Number of characters to generate",
+    )
+    parser.add_argument(
+        "--seed",
+        "-s",
+        type=int,
+        help="Random seed; the same seed gives the same characters",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        help="File to write the characters to, instead of standard output",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of processes to generate characters in",
+    )
+    parser.add_argument(
+        "--start-method",
+        choices=multiprocessing.get_all_start_methods(),
+        help="How to start the --jobs processes; default fork on Linux, "
+        "which loads the spell library once for all of them, else the "
+        "platform's default",
+    )
     args = parser.parse_args()
+    if args.count < 0:
+        parser.error("--count must not be negative")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
     template = args.template.lower()
-    if template == "random":
-        template = random.choice(templates)
-    if template not in templates:
+    if args.count_space and template == "random":
+        for template in templates:
+            print_count_space(template)
+        return
+    if template != "random" and template not in templates:
         raise argparse.ArgumentTypeError(
             "Invalid template; must be one of %s"
             % ", ".join(templates + ["random"])
         )
-    print(template.title())
-    fn = template_to_fn[template]
-    traits = fn()
-    traits = merge_traits(traits)
-    print_traits(traits)
+    if args.count_space:
+        print_count_space(template)
+        return
+    if args.probabilities:
+        if template == "random":
+            template = random.choice(templates)
+        print(template.title())
+        print_probabilities(template)
+        return
+    if args.jobs > 1:
+        characters = generate_parallel(
+            template,
+            args.count,
+            seed=args.seed,
+            jobs=args.jobs,
+            sampling=args.sampling,
+            start_method=args.start_method,
+        )
+    else:
+        characters = generate_named(
+            template, args.count, seed=args.seed, sampling=args.sampling
+        )
+    if args.output is None:
+        write_characters(characters, sys.stdout)
+    else:
+        with open(args.output, "w", buffering=1 << 16) as out:
+            write_characters(characters, out)
 
 
 if __name__ == "__main__":
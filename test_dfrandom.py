@@ -1,42 +1,55 @@
 # /usr/bin/env pytest-3
 
+import collections
+import concurrent.futures
+from fractions import Fraction
+import gc
+import itertools
+import os
+import pickle
+import shutil
+import sys
+import tracemalloc
 import xml.etree.ElementTree as et
 
+import pytest
+
 import dfrandom
 
 
-def test_parse_spell_prereq_name_is():
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    """Keep the spell library cache out of the real ~/.cache."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache_home"))
+
+
+def _index(traits):
+    spell_to_colleges = dfrandom.get_spell_library().spell_to_colleges
+    return dfrandom.CharacterIndex(traits, spell_to_colleges)
+
+
+def test_build_spell_prereq_name_is():
     xml = """
 <spell_prereq has="yes">
     <name compare="is">light</name>
 </spell_prereq>"""
     el = et.fromstring(xml)
-    assert (
-        dfrandom._parse_spell_prereq(el, "f1")
-        == """
-def f1(traits, trait_names):
-    return '''Light''' in trait_names
-"""
-    )
+    prereq = dfrandom._build_spell_prereq(el)
+    assert prereq == dfrandom.NameIs("Light")
+    assert prereq.evaluate(_index([("Light", 1, dfrandom.SP)]))
+    assert not prereq.evaluate(_index([("Darkness", 1, dfrandom.SP)]))
 
 
-def test_parse_spell_prereq_name_college_count():
+def test_build_spell_prereq_college_count():
     xml = """<spell_prereq has="yes">
     <college_count compare="at_least">10</college_count>
 </spell_prereq>
 """
     el = et.fromstring(xml)
-    assert (
-        dfrandom._parse_spell_prereq(el, "f1")
-        == """
-def f1(traits, trait_names):
-    count = count_spell_colleges(traits)
-    return count >= 10
-"""
-    )
+    assert dfrandom._build_spell_prereq(el) == dfrandom.CollegeCount(10)
 
 
-def test_parse_advantage_prereq():
+def test_build_advantage_prereq():
     xml = """<advantage_prereq has="yes">
     <name compare="is">Magery</name>
     <notes compare="is anything"></notes>
@@ -44,42 +57,22 @@ def test_parse_advantage_prereq():
 </advantage_prereq>
 """
     el = et.fromstring(xml)
-    assert (
-        dfrandom._parse_advantage_prereq(el, "f1")
-        == """
-def f1(traits, trait_names):
-    for trait in trait_names:
-        if trait.startswith('''Magery'''):
-            regexp = "(\d+).*$"
-            match = re.search(regexp, trait)
-            if match:
-                level = int(match.group(1))
-                return level >= int('''3''')
-    return False
-"""
-    )
+    prereq = dfrandom._build_advantage_prereq(el)
+    assert prereq == dfrandom.LevelAtLeast("magery", 3)
+    assert prereq.evaluate(_index([("Magery 3", 35, dfrandom.AD)]))
+    assert not prereq.evaluate(_index([("Magery 2", 25, dfrandom.AD)]))
 
 
-def test_parse_attribute_prereq():
+def test_build_attribute_prereq():
     xml = '<attribute_prereq has="yes" which="iq" compare="at_least">13</attribute_prereq>'
     el = et.fromstring(xml)
-    assert (
-        dfrandom._parse_attribute_prereq(el, "f1")
-        == """
-def f1(traits, trait_names):
-    for trait in trait_names:
-        if trait.startswith('''IQ '''):
-            regexp = "(\d+).*$"
-            match = re.search(regexp, trait)
-            if match:
-                level = int(match.group(1))
-                return level >= 13
-    return False
-"""
-    )
+    prereq = dfrandom._build_attribute_prereq(el)
+    assert prereq == dfrandom.LevelAtLeast("iq", 13)
+    assert prereq.evaluate(_index([("IQ 13", 60, dfrandom.PA)]))
+    assert not prereq.evaluate(_index([("IQ 12", 40, dfrandom.PA)]))
 
 
-def test_parse_prereq_list():
+def test_build_prereq_list_any_of():
     xml = """
 <prereq_list all="no">
     <advantage_prereq has="yes">
@@ -94,59 +87,401 @@ def test_parse_prereq_list():
     </advantage_prereq>
 </prereq_list>"""
     el = et.fromstring(xml)
-    top_name = "top_0"
-    dfrandom.function_name_incrementor = 1
+    prereq = dfrandom._build_prereq_list(el)
+    assert prereq == dfrandom.AnyOf(
+        [
+            dfrandom.LevelAtLeast(
+                "magery", 2, notes_contains="one college (gate)"
+            ),
+            dfrandom.LevelAtLeast("magery", 2, notes_excludes="one college"),
+        ]
+    )
+    assert prereq.evaluate(_index([("Magery 2", 25, dfrandom.AD)]))
+    traits = [("Magery (One College (Gate)) 2", 15, dfrandom.AD)]
+    assert prereq.evaluate(_index(traits))
+    traits = [("Magery (One College (Fire)) 2", 15, dfrandom.AD)]
+    assert not prereq.evaluate(_index(traits))
+    assert not prereq.evaluate(_index([("Magery 1", 15, dfrandom.AD)]))
+
+
+def test_add_spell():
+    traits = [("IQ 15", 100), ("Magery 3", 35)]
+    trait_names = set([trait[0] for trait in traits])
+    NUM_SPELLS = 425
+    for unused in range(NUM_SPELLS):
+        dfrandom.add_spell(traits, trait_names)
+    assert len(traits) == len(trait_names) == NUM_SPELLS + 2
+
+
+def test_pick_from_list():
+    for seed in range(50):
+        rng = dfrandom.random.Random(seed)
+        lst = [
+            [("Bad Temper (12)", -10, dfrandom.DI)],
+            [("Greed (12)", -15, dfrandom.DI)],
+            dfrandom.list_self_control_levels("Honesty", -10),
+            [("Wealth (Poor)", -15, dfrandom.DI)],
+        ]
+        groups = [list(group) for group in lst]
+        traits = dfrandom.pick_from_list(lst, -25, rng=rng)
+        assert lst == groups
+        assert sum(trait[1] for trait in traits) == -25
+        for group in groups:
+            assert len(set(group) & set(traits)) <= 1
+        unpicked = dfrandom.unpicked_groups(lst, traits)
+        assert len(unpicked) == len(lst) - len(traits)
+        assert not set(traits) & set(sum(unpicked, []))
+    with pytest.raises(ValueError):
+        dfrandom.pick_from_list([[("Greed (12)", -15, dfrandom.DI)]], -10)
+
+
+def test_option_table():
+    costs = ((-5, -10, -15, -20), (-10,), (-15,), (-15,))
+    table = dfrandom.option_table(costs, -25)
+    ways = dict(
+        (total, table.ways(table.counts, table.offset, total))
+        for total in range(-25, 6)
+    )
+    # -25 is -10 from the first group with either -15 group, -15 from the
+    # first group with the -10 group, or the -10 group with either -15
+    # group.
+    assert ways[-25] == 5
+    assert ways[0] == 1
+    assert ways[-20] == 4
+    assert ways[5] == 0
+    counts, offset = table.without(table.counts, table.offset, 0)
+    assert table.ways(counts, offset, -25) == 2
+    assert table.ways(counts, offset, -15) == 2
+    # Dividing out a weighted group leaves the other groups' weights.
+    weighted = dfrandom.option_table(
+        ((-5, 10), (10,)), 5, (Fraction(1, 2), Fraction(3, 10))
+    )
+    counts, offset = weighted.without(weighted.counts, weighted.offset, 0)
+    assert weighted.ways(counts, offset, 0) == 1
+    assert weighted.ways(counts, offset, 10) == Fraction(3, 10)
+    info = dfrandom.option_table.cache_info()
+    assert dfrandom.option_table(costs, -25) is table
+    assert dfrandom.option_table.cache_info().hits == info.hits + 1
+
+
+def test_pick_from_list_uniform():
+    lst = [
+        [("A", 1, dfrandom.AD)],
+        [("B", 1, dfrandom.AD)],
+        dfrandom.list_levels("C %d", 1, dfrandom.AD, 2),
+    ]
+    rng = dfrandom.random.Random(0)
+    for weights, expected in [
+        (None, [0.25, 0.25, 0.25, 0.25]),
+        ([1, 1, 3], [0.1, 0.3, 0.3, 0.3]),
+    ]:
+        counter = collections.Counter(
+            tuple(sorted(trait[0] for trait in traits))
+            for traits in (
+                dfrandom.pick_from_list(lst, 2, "uniform", weights, rng)
+                for unused in range(4000)
+            )
+        )
+        keys = [("A", "B"), ("A", "C 1"), ("B", "C 1"), ("C 2",)]
+        assert sorted(counter) == keys
+        for key, probability in zip(keys, expected):
+            assert abs(counter[key] / 4000 - probability) < 0.03
+    with pytest.raises(ValueError):
+        dfrandom.pick_from_list(lst, 2, "fair")
+    with pytest.raises(ValueError):
+        dfrandom.pick_from_list(lst, 2, "greedy", [1, 1, 3])
+
+
+def test_list_probabilities():
+    lst = [
+        dfrandom.list_self_control_levels("Greed", -15),
+        [("Bad Temper (12)", -10, dfrandom.DI)],
+        [("Honesty (12)", -10, dfrandom.DI)],
+        dfrandom.list_levels("Wealth %d", -5, dfrandom.DI, 3),
+    ]
+    selections = [
+        [tup for tup in selection if tup is not None]
+        for selection in itertools.product(*([None] + group for group in lst))
+    ]
+    selections = [
+        selection
+        for selection in selections
+        if sum(tup[1] for tup in selection) == -25
+    ]
+    expected = collections.Counter(
+        tup[0] for selection in selections for tup in selection
+    )
+    probabilities = dfrandom.list_probabilities(lst, -25)
+    assert probabilities == dict(
+        (name, Fraction(expected[name], len(selections)))
+        for group in lst
+        for name, unused, unused2 in group
+    )
+
+    stages = dfrandom.template_probabilities("martial_artist")
+    knife = [stage for stage in stages if "Knife" in stage[2]]
+    assert [stage[0] for stage in knife] == [Fraction(1, 3)] * 2
+    assert sum(stage[2]["Knife"] for stage in knife) < Fraction(1, 3)
+    assert stages[0][0] == 1
+
+
+def test_template_probabilities_shared():
+    groups = [
+        [("A", 1, dfrandom.SK), ("A+1", 2, dfrandom.SK)],
+        [("B", 1, dfrandom.SK)],
+        [("C", 1, dfrandom.SK)],
+    ]
+    # The first list picks A or B.  After A the second must pick B and C;
+    # after B it picks A+1 alone or A and C.
+    assert dfrandom._shared_list_probabilities(
+        [(groups[:2], 1), (groups, 2)]
+    ) == [
+        {"A": Fraction(1, 2), "A+1": 0, "B": Fraction(1, 2)},
+        {
+            "A": Fraction(1, 4),
+            "A+1": Fraction(1, 4),
+            "B": Fraction(1, 2),
+            "C": Fraction(3, 4),
+        },
+    ]
+    stages = dfrandom.template_probabilities("barbarian")
+    assert all(exact for unused, unused2, unused3, exact in stages)
+    disadvantages = [
+        probabilities
+        for unused, points, probabilities, unused2 in stages
+        if "Phobia (Machinery) (15)" in probabilities
+    ]
+    # Only one level of a disadvantage can be picked, in either list.
+    for name in ["Phobia (Machinery) (%d)" % level for level in [15, 12]]:
+        assert 0 < sum(stage[name] for stage in disadvantages) < 1
     assert (
-        dfrandom._parse_prereq_list(el, top_name)
-        == """
-def and_(*args):
-    for arg in args:
-        if not arg:
-            return False
-    return True
-
-
-def or_(*args):
-    for arg in args:
-        if arg:
-            return True
-    return False
-
-
-def ppl_1(traits, trait_names):
-    for trait in trait_names:
-        if trait.startswith('''Magery''') and '''one college (gate)''' in trait:
-            regexp = "(\d+).*$"
-            match = re.search(regexp, trait)
-            if match:
-                level = int(match.group(1))
-                return level >= int('''2''')
-    return False
-
-
-def ppl_2(traits, trait_names):
-    for trait in trait_names:
-        if trait.startswith('''Magery''') and '''one college''' not in trait:
-            regexp = "(\d+).*$"
-            match = re.search(regexp, trait)
-            if match:
-                level = int(match.group(1))
-                return level >= int('''2''')
-    return False
-
-top_0 = or_(ppl_1(traits, trait_names), ppl_2(traits, trait_names))
-"""
+        sum(
+            stage[name]
+            for stage in disadvantages
+            for name in stage
+            if name.startswith("Phobia (Machinery)")
+        )
+        <= 1
+    )
+    stages = dfrandom.template_probabilities("cleric")
+    assert not all(exact for unused, unused2, unused3, exact in stages)
+
+
+def test_count_shared_lists():
+    groups = [
+        [("A", 1, dfrandom.SK), ("A+1", 2, dfrandom.SK)],
+        [("B", 1, dfrandom.SK)],
+        [("C", 2, dfrandom.SK), ("C+1", 3, dfrandom.SK)],
+        [("D", -5, dfrandom.DI), ("D+1", -10, dfrandom.DI)],
+        [("E", -5, dfrandom.DI)],
+    ]
+    lists = [(groups[:3], 3), (groups[:3], 2), ([groups[3], groups[4]], -10)]
+    brute = 0
+    # Each group is skipped, or picked from in one of its lists.
+    for choices in itertools.product(
+        *[
+            [None]
+            + [
+                (ii, tup)
+                for ii, (lst, unused) in enumerate(lists)
+                if group in lst
+                for tup in group
+            ]
+            for group in groups
+        ]
+    ):
+        totals = [0] * len(lists)
+        for choice in choices:
+            if choice is not None:
+                totals[choice[0]] += choice[1][1]
+        if totals == [points for unused, points in lists]:
+            brute += 1
+    assert brute == 8
+    components = dfrandom._stage_components(lists)
+    assert sorted(components) == [[0, 1], [2]]
+    joint = dfrandom.count_shared_lists(lists[:2])
+    assert joint * dfrandom.count_shared_lists(lists[2:]) == brute
+    for template in dfrandom.templates:
+        count, unused = dfrandom.count_template_space(template)
+        assert count > 0
+
+
+def test_compiled_template():
+    data = dfrandom.TemplateData(
+        traits=[("ST 10", 0, dfrandom.PA)],
+        stages=[
+            dfrandom.Stage("fixed", None, [[("Knife", 1, dfrandom.SK)]]),
+            dfrandom.Stage(
+                "ads1",
+                10,
+                [[("Luck", 10, dfrandom.AD)], [("Fit", 5, dfrandom.AD)]],
+            ),
+            dfrandom.Stage(
+                "ads2",
+                5,
+                [[("Luck", 5, dfrandom.AD)]],
+                reuse=("ads1",),
+                skip_known=True,
+            ),
+        ],
+        fixed=("fixed",),
+        improve=dfrandom.Improve(1, ("fixed",)),
+    )
+    template = dfrandom.CompiledTemplate(data)
+    assert template.traits[-1] == ("Knife", 1, dfrandom.SK)
+    assert isinstance(template.stages[1].groups[0], tuple)
+    for seed in range(10):
+        context = dfrandom.GenerationContext(dfrandom.random.Random(seed))
+        traits = template.generate(context)
+        assert sum(trait[1] for trait in traits) == 17
+        assert ("Fit", 5, dfrandom.AD) in traits
+        assert ("Knife", 2, dfrandom.SK) in traits
+    with pytest.raises(ValueError):
+        dfrandom.CompiledTemplate(
+            data._replace(stages=list(reversed(data.stages)))
+        )
+    # Each template is compiled once, and picks from the same groups.
+    template = dfrandom.template_to_compiled["barbarian"]
+    lists = {}
+    traits = list(template.traits)
+    template.pick("ads1", traits, lists)
+    assert lists["ads1"][0] is template.stages[0].groups[0]
+
+
+def test_compiled_template_weights():
+    groups = [[(name, 5, dfrandom.AD)] for name in "ABC"]
+    data = dfrandom.TemplateData(
+        traits=[],
+        stages=[
+            dfrandom.Stage("ads1", 5, groups, weights=(1, 0, 3)),
+            dfrandom.Stage("ads2", 5, reuse=("ads1",)),
+        ],
+    )
+    template = dfrandom.CompiledTemplate(data)
+    names = collections.Counter()
+    for seed in range(50):
+        context = dfrandom.GenerationContext(
+            dfrandom.random.Random(seed), "uniform"
+        )
+        traits = template.generate(context)
+        assert sorted(trait[0] for trait in traits) == ["A", "C"]
+        names[traits[0][0]] += 1
+    assert names["C"] > names["A"]
+    # Greedy sampling has no use for the weights.
+    names = set()
+    for seed in range(50):
+        context = dfrandom.GenerationContext(dfrandom.random.Random(seed))
+        names.update(trait[0] for trait in template.generate(context))
+    assert names == {"A", "B", "C"}
+    with pytest.raises(ValueError):
+        dfrandom.CompiledTemplate(
+            data._replace(
+                stages=[dfrandom.Stage("ads1", 5, groups, weights=(1, 2))]
+            )
+        )
+
+
+def test_pick_from_list_enforcing_prereqs():
+    spells = dfrandom.SpellSet(
+        {"A": {"X"}, "B": {"X"}, "C": {"X"}},
+        {
+            "A": dfrandom.AllOf(()),
+            "B": dfrandom.NameIs("A"),
+            "C": dfrandom.NameIs("D"),
+        },
+    )
+    lst = [[(name, 1, dfrandom.SP)] for name in "ABC"]
+    for seed in range(20):
+        traits = dfrandom.pick_from_list_enforcing_prereqs(
+            lst, 2, [], spells, rng=dfrandom.random.Random(seed)
+        )
+        assert sorted(traits) == [("A", 1, dfrandom.SP), ("B", 1, dfrandom.SP)]
+    traits = dfrandom.pick_from_list_enforcing_prereqs(
+        lst, 1, [("D", 1, dfrandom.SP)], spells
     )
+    assert traits[0][0] in {"A", "C"}
+    with pytest.raises(ValueError):
+        dfrandom.pick_from_list_enforcing_prereqs(lst, 3, [], spells)
+
+
+def test_character_index_pop():
+    spell_to_colleges = dfrandom.get_spell_library().spell_to_colleges
+    index = dfrandom.CharacterIndex(
+        [("IQ 14", 80, dfrandom.PA)], spell_to_colleges
+    )
+    before = (dict(index.levels()), set(index.names), index.college_count())
+    for trait in [
+        ("IQ +1", 20, dfrandom.PA),
+        ("Magery 2", 25, dfrandom.AD),
+        ("Light", 1, dfrandom.SP),
+        ("Light", 1, dfrandom.SP),
+    ]:
+        index.add(trait)
+    assert index.levels() == {"iq": 15, "magery": 2}
+    for unused in range(4):
+        index.pop()
+    assert (dict(index.levels()), index.names, index.college_count()) == (
+        before
+    )
+    assert index.traits == [("IQ 14", 80, dfrandom.PA)]
+
+
+def test_merge_traits_attr():
+    traits = [("ST 14", 40, dfrandom.PA), ("ST +2", 20, dfrandom.PA)]
+    assert dfrandom.merge_traits(traits) == [("ST 16", 60, dfrandom.PA)]
+
+
+def test_merge_traits_advantage():
+    traits = [("Magery 3", 35, dfrandom.AD), ("Magery 4", 10, dfrandom.AD)]
+    assert dfrandom.merge_traits(traits) == [("Magery 4", 45, dfrandom.AD)]
 
 
-def test_parse_prereq_list2():
+def test_merge_traits_fractional_level():
+    traits = [
+        ("Basic Speed 6.5", 10, dfrandom.SA),
+        ("Luck", 15, dfrandom.AD),
+        ("Basic Speed +1", 20, dfrandom.SA),
+    ]
+    assert dfrandom.merge_traits(traits) == [
+        ("Basic Speed 7.5", 30, dfrandom.SA),
+        ("Luck", 15, dfrandom.AD),
+    ]
+    traits = dfrandom.list_levels("HT +%d", 10, dfrandom.PA, 2)
+    traits.append(("HT 12", 20, dfrandom.PA))
+    assert dfrandom.merge_traits(traits) == [("HT 15", 50, dfrandom.PA)]
+    # Whole levels print as they did before levels could be fractional.
+    traits = [("Basic Speed 6.0", 0, dfrandom.SA)]
+    assert dfrandom.merge_traits(traits) == [("Basic Speed 6", 0, dfrandom.SA)]
+    traits = [
+        ("Basic Speed 6.5", 0, dfrandom.SA),
+        ("Basic Speed +0.5", 10, dfrandom.SA),
+    ]
+    assert dfrandom.merge_traits(traits) == [
+        ("Basic Speed 7", 10, dfrandom.SA)
+    ]
+
+
+def test_prereq_evaluate():
     xml = """
 <prereq_list all="yes">
     <spell_prereq has="yes">
-        <college_count compare="at_least">10</college_count>
+        <name compare="is">light</name>
     </spell_prereq>
+    <attribute_prereq has="yes" which="iq" compare="at_least">13</attribute_prereq>
+</prereq_list>"""
+    el = et.fromstring(xml)
+    prereq = dfrandom._build_prereq_list(el)
+    traits = [("IQ 14", 80, dfrandom.PA), ("Light", 1, dfrandom.SP)]
+    assert prereq.evaluate(_index(traits))
+    traits = [("IQ 12", 40, dfrandom.PA), ("Light", 1, dfrandom.SP)]
+    assert not prereq.evaluate(_index(traits))
+
+
+def test_build_prereq_list():
+    xml = """
+<prereq_list all="yes">
     <spell_prereq has="yes">
-        <college_count compare="at_least">10</college_count>
+        <college_count compare="at_least">2</college_count>
     </spell_prereq>
     <attribute_prereq has="yes" which="iq" compare="at_least">13</attribute_prereq>
     <prereq_list all="no">
@@ -164,103 +499,423 @@ def test_parse_prereq_list2():
 </prereq_list>
 """
     el = et.fromstring(xml)
-    top_name = "top_0"
-    dfrandom.function_name_incrementor = 1
-    assert (
-        dfrandom._parse_prereq_list(el, top_name)
-        == """
-def and_(*args):
-    for arg in args:
-        if not arg:
-            return False
-    return True
-
-
-def or_(*args):
-    for arg in args:
-        if arg:
-            return True
-    return False
-
-
-def ppl_1(traits, trait_names):
-    count = count_spell_colleges(traits)
-    return count >= 10
-
-
-def ppl_2(traits, trait_names):
-    count = count_spell_colleges(traits)
-    return count >= 10
-
-
-def ppl_3(traits, trait_names):
-    for trait in trait_names:
-        if trait.startswith('''IQ '''):
-            regexp = "(\d+).*$"
-            match = re.search(regexp, trait)
-            if match:
-                level = int(match.group(1))
-                return level >= 13
-    return False
-
-
-def and_(*args):
-    for arg in args:
-        if not arg:
-            return False
-    return True
-
-
-def or_(*args):
-    for arg in args:
-        if arg:
-            return True
-    return False
-
-
-def ppl_5(traits, trait_names):
-    for trait in trait_names:
-        if trait.startswith('''Magery''') and '''one college (gate)''' in trait:
-            regexp = "(\d+).*$"
-            match = re.search(regexp, trait)
-            if match:
-                level = int(match.group(1))
-                return level >= int('''2''')
-    return False
-
-
-def ppl_6(traits, trait_names):
-    for trait in trait_names:
-        if trait.startswith('''Magery''') and '''one college''' not in trait:
-            regexp = "(\d+).*$"
-            match = re.search(regexp, trait)
-            if match:
-                level = int(match.group(1))
-                return level >= int('''2''')
-    return False
-
-top_4 = or_(ppl_5(traits, trait_names), ppl_6(traits, trait_names))
-
-top_0 = and_(ppl_1(traits, trait_names), ppl_2(traits, trait_names), ppl_3(traits, trait_names), top_4)
+    prereq = dfrandom._build_prereq_list(el)
+    # Cheap prereqs are sorted first.
+    assert prereq == dfrandom.AllOf(
+        [
+            dfrandom.LevelAtLeast("iq", 13),
+            dfrandom.AnyOf(
+                [
+                    dfrandom.LevelAtLeast(
+                        "magery", 2, notes_contains="one college (gate)"
+                    ),
+                    dfrandom.LevelAtLeast(
+                        "magery", 2, notes_excludes="one college"
+                    ),
+                ]
+            ),
+            dfrandom.CollegeCount(2),
+        ]
+    )
+    assert dfrandom._build_prereq_list(el, cost_ordered=False).children[
+        0
+    ] == dfrandom.CollegeCount(2)
+    assert pickle.loads(pickle.dumps(prereq)) == prereq
+
+    spell_to_colleges = dfrandom.get_spell_library().spell_to_colleges
+
+    def index(traits):
+        return dfrandom.CharacterIndex(traits, spell_to_colleges)
+
+    traits = [
+        ("IQ 12", 40, dfrandom.PA),
+        ("IQ +1", 20, dfrandom.PA),
+        ("Magery 2", 25, dfrandom.AD),
+        ("Light", 1, dfrandom.SP),
+    ]
+    assert not prereq.evaluate(index(traits))
+    traits.append(("Shape Fire", 1, dfrandom.SP))
+    assert prereq.evaluate(index(traits))
+    bard_prereq = prereq.replace_name("Magery", "Bardic Talent")
+    assert not bard_prereq.evaluate(index(traits))
+    traits.append(("Bardic Talent 2", 16, dfrandom.AD))
+    assert bard_prereq.evaluate(index(traits))
+
+
+def test_load_spell_data_cache(tmp_path, monkeypatch):
+    path = str(tmp_path / "Library__L.glb")
+    shutil.copy(dfrandom.library_path(), path)
+    cache_path = str(tmp_path / "cache" / "spells.pickle")
+    data = dfrandom.load_spell_data(path, cache_path)
+    assert os.path.exists(cache_path)
+    assert "Light" in data.spell_to_colleges
+
+    def fail(path):
+        raise AssertionError("parsed the library despite the cache")
+
+    with monkeypatch.context() as mp:
+        mp.setattr(dfrandom, "_parse_spell_library", fail)
+        assert dfrandom.load_spell_data(path, cache_path) == data
+        # Touching the library without changing it keeps the cache.
+        os.utime(path, ns=(0, 0))
+        assert dfrandom.load_spell_data(path, cache_path) == data
+
+    # Changing the library rebuilds the cache.
+    with open(path) as fil:
+        text = fil.read()
+    with open(path, "w") as fil:
+        fil.write(text.replace("<name>Light</name>", "<name>Lite</name>"))
+    data2 = dfrandom.load_spell_data(path, cache_path)
+    assert "Light" not in data2.spell_to_colleges
+    assert dfrandom.load_spell_data(path, cache_path) == data2
+
+    # So does changing the special bard skills, or the cache version.
+    with monkeypatch.context() as mp:
+        mp.setattr(dfrandom, "special_bard_skills", {"Persuade"})
+        data3 = dfrandom.load_spell_data(path, cache_path)
+        assert set(data3.special_skill_to_prereq) == {"Persuade"}
+    with monkeypatch.context() as mp:
+        mp.setattr(dfrandom, "_parse_spell_library", fail)
+        mp.setattr(dfrandom, "SPELL_CACHE_VERSION", -1)
+        with pytest.raises(AssertionError):
+            dfrandom.load_spell_data(path, cache_path)
+
+
+def test_parse_spell_library_memory():
+    path = dfrandom.library_path()
+    tracemalloc.start()
+    try:
+        et.parse(path)
+        unused, full_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        data = dfrandom._parse_spell_library(path)
+        unused, streaming_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert len(data.spell_to_colleges) > 600
+    assert streaming_peak < full_peak / 4
+
+
+def test_trait_registry():
+    registry = dfrandom.TraitRegistry()
+    assert registry.intern("ST +2") == 0
+    assert registry.intern("Luck") == 1
+    assert registry.intern("ST +2") == 0
+    assert registry.levels == [("ST", 2, True), None]
+
+
+def test_character_batch():
+    characters = list(dfrandom.generate_many("barbarian", 200, seed=0))
+    tracemalloc.start()
+    try:
+        before, unused = tracemalloc.get_traced_memory()
+        copies = [
+            [(name, cost, tt) for name, cost, tt in traits]
+            for traits in characters
+        ]
+        middle, unused = tracemalloc.get_traced_memory()
+        batch = dfrandom.CharacterBatch(characters)
+        after, unused = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert after - middle < (middle - before) / 4
+    assert len(batch) == 200
+    assert list(batch) == copies
+    assert batch[-1] == copies[-1]
+    with pytest.raises(IndexError):
+        batch[200]
+
+    # Traits are compared by their interned IDs.
+    registry = batch.registry
+    assert list(batch.trait_ids(0)) == [
+        registry.lookup(name) for name, unused, unused2 in copies[0]
+    ]
+    assert registry.names[batch.trait_ids(0)[0]] == copies[0][0][0]
+    name = copies[0][-1][0]
+    assert batch.has_trait(0, name)
+    assert not batch.has_trait(0, "No Such Trait")
+    assert batch.count_with(name) == sum(
+        1 for traits in copies if name in (trait[0] for trait in traits)
+    )
+    assert batch.count_with("No Such Trait") == 0
+
+
+def test_generate_many():
+    first = list(dfrandom.generate_many("random", 6, seed=5))
+    assert list(dfrandom.generate_many("random", 6, seed=5)) == first
+    assert list(dfrandom.generate_many("random", 3, seed=5)) == first[:3]
+    assert list(dfrandom.generate_many("random", 6, seed=6)) != first
+    named = list(dfrandom.generate_named("random", 6, seed=5))
+    assert [traits for unused, traits in named] == first
+    for template, traits in named:
+        assert sum(trait[1] for trait in traits) <= 250
+    with pytest.raises(ValueError):
+        dfrandom.generate_many("paladin", 1)
+    # Nothing is kept from one character to the next.
+    for unused in dfrandom.generate_many("barbarian", 200, seed=1):
+        pass
+    retained = []
+    for n in [200, 400]:
+        tracemalloc.start()
+        try:
+            for unused in dfrandom.generate_many("barbarian", n, seed=2):
+                pass
+            gc.collect()
+            retained.append(tracemalloc.get_traced_memory()[0])
+        finally:
+            tracemalloc.stop()
+    # Keeping even one trait tuple per character would add more than this.
+    assert retained[1] - retained[0] < 200 * 50
+
+
+def test_generation_context():
+    results = []
+    for unused in range(2):
+        context = dfrandom.GenerationContext(dfrandom.random.Random(8))
+        characters = []
+        for template in dfrandom.templates:
+            # Draws from the module's generator do not disturb context's.
+            dfrandom.random.random()
+            characters.append(dfrandom.generate_character(template, context))
+        results.append(characters)
+    assert results[0] == results[1]
+    lst = [[("A", 1, dfrandom.SK), ("B", 2, dfrandom.SK)]] * 3
+    for sampling in dfrandom.SAMPLING_MODES:
+        picks = [
+            dfrandom.pick_from_list(
+                lst, 3, sampling, rng=dfrandom.random.Random(seed)
+            )
+            for seed in [1, 1]
+        ]
+        assert picks[0] == picks[1]
+    rng = dfrandom.random.Random(2)
+    first = list(dfrandom.generate_many("thief", 3, rng=rng))
+    rng.seed(2)
+    assert list(dfrandom.generate_many("thief", 3, rng=rng)) == first
+
+
+def test_tracing_draws_nothing():
+    state = dfrandom._default_rng.getstate()
+    dfrandom.template_probabilities("martial_artist")
+    dfrandom.count_template_space("martial_artist")
+    assert dfrandom._default_rng.getstate() == state
+
+
+def test_generate_parallel():
+    serial = list(dfrandom.generate_named("random", 25, seed=4))
+    for jobs, chunk_size in [(1, 25), (2, 3), (3, 1)]:
+        parallel = dfrandom.generate_parallel(
+            "random", 25, seed=4, jobs=jobs, chunk_size=chunk_size
+        )
+        assert list(parallel) == serial
+    assert len(list(dfrandom.generate_parallel("knight", 5, jobs=2))) == 5
+
+
+def test_generate_parallel_start_methods():
+    serial = list(dfrandom.generate_named("random", 12, seed=6))
+    methods = set(["fork", "spawn"]) & set(
+        dfrandom.multiprocessing.get_all_start_methods()
+    )
+    for method in sorted(methods):
+        parallel = dfrandom.generate_parallel(
+            "random", 12, seed=6, jobs=2, chunk_size=2, start_method=method
+        )
+        assert list(parallel) == serial
+    # A fork pool's gc.freeze() is undone once its workers are forked.
+    assert dfrandom.gc.get_freeze_count() == 0
+
+
+def test_threaded_generation():
+    def generate(index):
+        template = dfrandom.templates[index % len(dfrandom.templates)]
+        context = dfrandom.GenerationContext(
+            dfrandom.random.Random(dfrandom.character_seed(5, index)),
+            dfrandom.SAMPLING_MODES[index % 2],
+        )
+        return dfrandom.generate_character(template, context)
+
+    def task(index):
+        # Tracing a template in one thread must not stop the others
+        # picking.
+        if index % 8 == 7:
+            return dfrandom.template_probabilities("knight")
+        return generate(index)
+
+    serial = [task(index) for index in range(160)]
+    registry = dfrandom.TraitRegistry()
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(16) as executor:
+            assert list(executor.map(task, range(160))) == serial
+            names = ["Threaded Trait %d" % (ii % 40) for ii in range(640)]
+            ids = list(executor.map(registry.intern, names))
+    finally:
+        sys.setswitchinterval(interval)
+    assert len(registry) == 40
+    for name, trait_id in zip(names, ids):
+        assert registry.names[trait_id] == name
+        assert registry.lookup(name) == trait_id
+
+
+def test_main_count_seed_output(tmp_path, monkeypatch, capsys):
+    paths = [str(tmp_path / "a.txt"), str(tmp_path / "b.txt")]
+    for path in paths:
+        monkeypatch.setattr(
+            dfrandom.sys,
+            "argv",
+            ["dfrandom.py", "-n", "5", "--seed", "3", "--output", path],
+        )
+        dfrandom.main()
+    with open(paths[0]) as file1, open(paths[1]) as file2:
+        text = file1.read()
+        assert text == file2.read()
+    assert text.count("total points") == 5
+    template, traits = next(dfrandom.generate_named("random", 1, seed=3))
+    assert text.startswith(
+        template.title() + "\n" + dfrandom.format_traits(traits) + "\n"
+    )
+    dfrandom.print_traits(traits)
+    assert capsys.readouterr().out == dfrandom.format_traits(traits)
+    for args in [["-n", "-1"], ["-j", "0"]]:
+        monkeypatch.setattr(dfrandom.sys, "argv", ["dfrandom.py"] + args)
+        with pytest.raises(SystemExit):
+            dfrandom.main()
+
+
+def test_spell_library_views():
+    library = dfrandom.get_spell_library()
+    assert dfrandom.get_spell_library() is library
+    wizard_spells = library.wizard_spells()
+    bard_spells = library.bard_spells()
+    assert library.wizard_spells() is wizard_spells
+    assert library.bard_spells() is bard_spells
+    assert len(bard_spells.spell_to_colleges) < len(
+        wizard_spells.spell_to_colleges
+    )
+    for colleges in bard_spells.spell_to_colleges.values():
+        assert colleges & dfrandom.allowed_bard_colleges
+    with pytest.raises(TypeError):
+        wizard_spells.spell_to_prereq["Light"] = dfrandom.AllOf(())
+
+    # Bards' prereqs use Bardic Talent but wizards' still use Magery.
+    traits = [("Foolishness", 1, dfrandom.SP)]
+    bardic = traits + [("Bardic Talent 1", 8, dfrandom.AD)]
+    magery = traits + [("Magery 1", 15, dfrandom.AD)]
+    assert bard_spells.prereq_satisfied("Forgetfulness", bardic)
+    assert not bard_spells.prereq_satisfied("Forgetfulness", magery)
+    assert wizard_spells.prereq_satisfied("Forgetfulness", magery)
+    assert not wizard_spells.prereq_satisfied("Forgetfulness", bardic)
+
+
+def test_build_skill_prereq():
+    xml = """<skill_prereq has="yes">
+    <name compare="is">public speaking</name>
+    <specialization compare="is"></specialization>
+    <level compare="at_least">12</level>
+</skill_prereq>
 """
+    el = et.fromstring(xml)
+    prereq = dfrandom._build_skill_prereq(el, {"public speaking": "IQ/A"})
+    assert prereq == dfrandom.SkillLevelAtLeast("Public Speaking", 12, "IQ/A")
+    skill = ("Public Speaking", 1, dfrandom.SK)
+    assert prereq.evaluate(_index([("IQ 13", 60, dfrandom.PA), skill]))
+    assert not prereq.evaluate(_index([("IQ 12", 40, dfrandom.PA), skill]))
+    assert prereq.evaluate(
+        _index(
+            [("IQ 12", 40, dfrandom.PA), ("Public Speaking", 2, dfrandom.SK)]
+        )
     )
-
-
-def test_add_spell():
-    traits = [("IQ 15", 100), ("Magery 3", 35)]
+    assert not prereq.evaluate(_index([("IQ 13", 60, dfrandom.PA)]))
+
+
+def test_special_bard_skills():
+    library = dfrandom.get_spell_library()
+    assert set(library.special_skill_to_prereq) == dfrandom.special_bard_skills
+    bard_spells = library.bard_spells()
+    traits = [
+        ("IQ 14", 80, dfrandom.PA),
+        ("Will 14", 0, dfrandom.SA),
+        ("Charisma 1", 5, dfrandom.AD),
+        ("Public Speaking", 1, dfrandom.SK),
+    ]
+    assert bard_spells.prereq_satisfied("Sway Emotions", traits)
+    assert bard_spells.prereq_satisfied("Persuade", traits)
+    assert not bard_spells.prereq_satisfied("Suggest", traits)
+    assert not bard_spells.prereq_satisfied("Captivate", traits)
+    traits.append(("Persuade", 1, dfrandom.SK))
+    assert bard_spells.prereq_satisfied("Suggest", traits)
+    assert not bard_spells.prereq_satisfied("Captivate", traits)
+    assert not bard_spells.prereq_satisfied("Persuade", traits[1:])
+
+    # The bard's special skills list gets them, as skills.
+    lst = dfrandom.template_to_compiled["bard"].spell_groups("bard_spells")
+    assert [("Captivate", 1, dfrandom.SK)] in [list(group) for group in lst]
+
+
+def test_spell_frontier():
+    spells = dfrandom.get_spell_library().wizard_spells()
+    traits = [("IQ 15", 100, dfrandom.PA), ("Magery 3", 35, dfrandom.AD)]
     trait_names = set([trait[0] for trait in traits])
-    dfrandom.build_spell_prereqs()
-    NUM_SPELLS = 425
-    for unused in range(NUM_SPELLS):
-        dfrandom.add_spell(traits, trait_names)
-    assert len(traits) == len(trait_names) == NUM_SPELLS + 2
-
-
-def test_merge_traits_attr():
-    traits = [("ST 14", 40, dfrandom.PA), ("ST +2", 20, dfrandom.PA)]
-    assert dfrandom.merge_traits(traits) == [("ST 16", 60, dfrandom.PA)]
-
-
-def test_merge_traits_advantage():
-    traits = [("Magery 3", 35, dfrandom.AD), ("Magery 4", 10, dfrandom.AD)]
-    assert dfrandom.merge_traits(traits) == [("Magery 4", 45, dfrandom.AD)]
+    frontier = dfrandom.SpellFrontier(traits, spells)
+    while dfrandom.add_spell(traits, trait_names, spells, frontier):
+        if len(traits) % 50:
+            continue
+        learnable = set(
+            spell
+            for spell in spells.spell_to_colleges
+            if spell not in trait_names
+            and spells.prereq_satisfied(spell, traits)
+        )
+        assert learnable == set(
+            spell for spell in spells.spell_to_colleges if spell in frontier
+        )
+    assert not frontier
+    assert len(traits) == len(trait_names) > 400
+    assert not dfrandom.add_spell(traits, trait_names, spells)
+
+
+def test_prereq_graph():
+    library = dfrandom.get_spell_library()
+    graph = library.graph
+    assert graph.requirements("Fireball") == {
+        "Create Fire",
+        "Shape Fire",
+        "magery",
+    }
+    assert "Fireball" in graph.dependents("Create Fire")
+    assert "Fireball" in graph.dependents("Magery 3")
+    assert "Mass Daze" in graph.dependents("IQ +1")
+    assert "Fireball" not in graph.dependents("Bardic Talent 2")
+    assert graph.dependents("Acrobatics") == ()
+
+    spells = library.wizard_spells()
+    traits = [("IQ 15", 100, dfrandom.PA)]
+    frontier = dfrandom.SpellFrontier(traits, spells)
+    assert "Detect Magic" not in frontier
+    traits.append(("Magery 3", 35, dfrandom.AD))
+    frontier.added(traits[-1])
+    assert "Detect Magic" in frontier
+    for spell in spells.spell_to_colleges:
+        assert (spell in frontier) == spells.prereq_satisfied(spell, traits)
+
+
+def test_character_index_add():
+    spell_to_colleges = dfrandom.get_spell_library().spell_to_colleges
+    index = dfrandom.CharacterIndex(
+        [("IQ 14", 80, dfrandom.PA), ("Magery 2", 25, dfrandom.AD)],
+        spell_to_colleges,
+    )
+    assert index.levels() == {"iq": 14, "magery": 2}
+    assert index.college_count() == 0
+    index.add(("IQ +1", 20, dfrandom.PA))
+    index.add(("Ignite Fire", 1, dfrandom.SP))
+    index.add(("Create Fire", 1, dfrandom.SP))
+    index.add(("Light", 1, dfrandom.SP))
+    assert index.levels() == {"iq": 15, "magery": 2}
+    assert index.college_counts() == {"fire": 2, "light": 1}
+    assert index.college_count() == 2
+    assert index.spell_names() == ["ignite fire", "create fire", "light"]
+    assert "Light" in index.names and "light" in index.folded_names
+    assert dfrandom.LevelAtLeast("IQ", 15).evaluate(index)
+    assert dfrandom.QuantityInCollege("Fire", 2).evaluate(index)